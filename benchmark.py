@@ -0,0 +1,143 @@
+import argparse
+import contextlib
+import os
+import pickle
+import random
+import socket
+import timeit
+
+import config as c
+from utils import generate_map_grid, get_center, get_player_view
+from codec import encode_player_view, encode_player_view_delta, decode_view, encode_stats
+from tile import get_map_version
+from network import send_frame, send_msg, send_stats, send_player_view_update
+from player import Player
+import status_codes as sc
+
+# ==== Benchmarks ====
+#
+# Run with: python benchmark.py [benchmark ...]
+# Every benchmark prints its results and does not need a running server.
+
+def print_result(name: str, seconds: float, count: int, size=None):
+    """Prints the time per operation (and the size of the output if given) of a benchmark"""
+    result = f"{name:<40} {seconds / count * 1e6:10.2f} us/op"
+    if size is not None:
+        result += f" {size:8} bytes"
+    print(result)
+
+def bench_views(count: int):
+    """Compares the pickled Tile grid format of player views with the compact format from codec.py"""
+    random.seed(0)
+    map_grid = generate_map_grid(c.MAP_SIZE)
+    player_x, player_y = get_center(map_grid)
+    map_grid[player_y][player_x].add_player(1)
+
+    pickled = pickle.dumps(get_player_view(map_grid, player_x, player_y, 1))
+    encoded = encode_player_view(map_grid, player_x, player_y)
+
+    print(f"\nPlayer view ({c.PLAYER_VIEW_X}x{c.PLAYER_VIEW_Y}), {count} iterations")
+    seconds = timeit.timeit(lambda: pickle.dumps(get_player_view(map_grid, player_x, player_y, 1)), number=count)
+    print_result("server: get_player_view + pickle", seconds, count, len(pickled))
+    seconds = timeit.timeit(lambda: encode_player_view(map_grid, player_x, player_y), number=count)
+    print_result("server: encode_player_view", seconds, count, len(encoded))
+
+    # A view delta after one tile in the view changed
+    base_version = get_map_version()
+    map_grid[player_y][player_x].mark_changed()
+    version = get_map_version()
+    delta = encode_player_view_delta(map_grid, player_x, player_y, base_version, version)
+    seconds = timeit.timeit(lambda: encode_player_view_delta(map_grid, player_x, player_y, base_version, version), number=count)
+    print_result("server: encode_player_view_delta", seconds, count, len(delta))
+
+    seconds = timeit.timeit(lambda: pickle.loads(pickled), number=count)
+    print_result("client: unpickle", seconds, count)
+    seconds = timeit.timeit(lambda: decode_view(encoded), number=count)
+    print_result("client: decode_view", seconds, count)
+
+def bench_messages(count: int):
+    """Compares sending status codes, bools and stats through the frame cache and typed paths with building every frame"""
+    server_sock, client_sock = socket.socketpair()
+    stats = {"extra_power": 3, "base_moves": 2, "extra_moves": 1, "health": 5}
+
+    def send_and_drain(send):
+        send()
+        client_sock.recv(65536)
+
+    print(f"\nControl messages, {count} iterations")
+    seconds = timeit.timeit(lambda: send_and_drain(lambda: send_frame(c.MSG_TYPE_STR, sc.CONTINUE.encode(), server_sock)), number=count)
+    print_result("status code: send_frame", seconds, count)
+    seconds = timeit.timeit(lambda: send_and_drain(lambda: send_msg(sc.CONTINUE, server_sock)), number=count)
+    print_result("status code: send_msg (cached frame)", seconds, count)
+    seconds = timeit.timeit(lambda: send_and_drain(lambda: send_msg(True, server_sock)), number=count)
+    print_result("bool: send_msg (cached frame)", seconds, count)
+    seconds = timeit.timeit(lambda: send_and_drain(lambda: send_frame(c.MSG_TYPE_OBJ, pickle.dumps(stats), server_sock)), number=count)
+    print_result("stats: pickle", seconds, count, len(pickle.dumps(stats)))
+    seconds = timeit.timeit(lambda: send_and_drain(lambda: send_msg(stats, server_sock)), number=count)
+    print_result("stats: send_msg (struct)", seconds, count, len(encode_stats(stats)))
+    seconds = timeit.timeit(lambda: send_and_drain(lambda: send_stats(stats, server_sock)), number=count)
+    print_result("stats: send_stats (struct)", seconds, count, len(encode_stats(stats)))
+
+    server_sock.close()
+    client_sock.close()
+
+def bench_broadcast(count: int):
+    """Compares sending full player views to 4 players standing on the same tile with and without sharing the encoded views"""
+    random.seed(0)
+    map_grid = generate_map_grid(c.MAP_SIZE)
+    center = get_center(map_grid)
+
+    socket_pairs = [socket.socketpair() for _ in range(4)]
+    players = [Player(number + 1, server_sock, None, center) for number, (server_sock, _) in enumerate(socket_pairs)]
+
+    def broadcast(encoded_views):
+        for player, (_, client_sock) in zip(players, socket_pairs):
+            # Force a full player view
+            player.view_origin = None
+            send_player_view_update(map_grid, player, encoded_views if encoded_views is not None else {})
+            client_sock.recv(65536)
+
+    print(f"\nBroadcast of full player views to {len(players)} players on one tile, {count} iterations")
+    seconds = timeit.timeit(lambda: broadcast(None), number=count)
+    print_result("encoded for every player", seconds, count)
+    seconds = timeit.timeit(lambda: broadcast({}), number=count)
+    print_result("encoded once per distinct view", seconds, count)
+
+    for server_sock, client_sock in socket_pairs:
+        server_sock.close()
+        client_sock.close()
+
+# Map sizes of the map generation benchmark
+GENERATION_SIZES = (c.MAP_SIZE, 64, 256, 1024, 4096)
+# Most tiles generated for one map size, smaller maps are generated several times (but at most count times)
+GENERATION_TILES = 250000
+
+def bench_generation(count: int):
+    """Times the generation of maps from MAP_SIZE up to 4096 tiles wide. The time per tile stays about the same for all map sizes
+       because generation takes linear time"""
+    print("\nMap generation")
+    for size in GENERATION_SIZES:
+        number = max(1, min(count, GENERATION_TILES // (size * size)))
+        random.seed(0)
+        # Don't show the output of generate_map_grid
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            seconds = timeit.timeit(lambda: generate_map_grid(size, compact=True), number=number)
+        print_result(f"{size}x{size}: per tile ({seconds / number:.2f} s/map)", seconds, number * size * size)
+
+BENCHMARKS = {
+    "views": bench_views,
+    "messages": bench_messages,
+    "broadcast": bench_broadcast,
+    "generation": bench_generation
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Qaraq benchmarks")
+    parser.add_argument("benchmarks", nargs="*", help=f"benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("-n", "--count", type=int, default=1000, help="number of iterations")
+    args = parser.parse_args()
+
+    for name in args.benchmarks or BENCHMARKS:
+        if name not in BENCHMARKS:
+            parser.error(f"unknown benchmark: {name}")
+        BENCHMARKS[name](args.count)
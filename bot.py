@@ -0,0 +1,284 @@
+import random
+import socket
+import time
+
+from codec import ViewDelta, apply_view_delta
+from network import connect_socket, recv_init_msg, recv_msg, send_msg, start_heartbeat, resume_session, session_tokens
+
+import config as c
+import status_codes as sc
+
+# ==== Bots ====
+#
+# Headless clients speaking the same protocol as client.py, used by loadtest.py to put load on a server.
+# A bot plays every turn right away with the moves its strategy picks and answers every sc.AYSREQUEST itself.
+# Bots can drop their connection after a turn and resume their session, like players on a bad mobile connection.
+
+DIRECTION_OFFSETS = {
+    "left":  (-1, 0),
+    "up":    (0, -1),
+    "right": (1, 0),
+    "down":  (0, 1)
+}
+
+class TurnTimeout(Exception):
+    """Raised when the server ended the bot's turn because it ran out of time"""
+
+class CountingSocket(socket.socket):
+    """Socket counting the bytes sent and received through it"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def sendmsg(self, buffers, *args):
+        sent = super().sendmsg(buffers, *args)
+        self.bytes_sent += sent
+        return sent
+
+    def recv_into(self, buffer, *args):
+        received = super().recv_into(buffer, *args)
+        self.bytes_received += received
+        return received
+
+def get_center_tile(player_view):
+    """Returns the tile the player stands on, the center of their player view"""
+    return player_view[c.PLAYER_VIEW_Y // 2][c.PLAYER_VIEW_X // 2]
+
+def get_neighbour_tile(player_view, move: str):
+    """Returns the tile of a player view a move (key of c.KEY_DIRECTIONS) leads to"""
+    dx, dy = DIRECTION_OFFSETS[c.KEY_DIRECTIONS[move]]
+    return player_view[c.PLAYER_VIEW_Y // 2 + dy][c.PLAYER_VIEW_X // 2 + dx]
+
+def get_possible_moves(player_view):
+    """Returns the moves (keys of c.KEY_DIRECTIONS) the tile the player stands on can be exited by"""
+    tile = get_center_tile(player_view)
+    return [move for move, direction in c.KEY_DIRECTIONS.items() if direction in tile.directions]
+
+# ==== Strategies ====
+
+def choose_random_move(bot, moves: list):
+    return bot.rng.choice(moves)
+
+def choose_greedy_move(bot, moves: list):
+    """Steps onto an entity next to the bot if there is one, otherwise onto a tile the bot has not visited yet"""
+    entity_moves = [move for move in moves if get_neighbour_tile(bot.view, move).entity]
+    if entity_moves:
+        return bot.rng.choice(entity_moves)
+
+    new_moves = []
+    for move in moves:
+        tile = get_neighbour_tile(bot.view, move)
+        if (tile.coordinate_x, tile.coordinate_y) not in bot.visited:
+            new_moves.append(move)
+    return bot.rng.choice(new_moves or moves)
+
+# Move picking function and the chance of attacking an enemy of every strategy
+STRATEGIES = {
+    "random": (choose_random_move, 0.5),
+    "greedy": (choose_greedy_move, 1.0)
+}
+
+class Bot:
+    """Headless player. Connects to a server, plays until the game is over for it or it made max_moves moves
+       and records the latency of every move and the bytes it sent and received. After every turn it drops its connection
+       and resumes its session with a chance of drop_chance"""
+
+    def __init__(self, strategy="random", max_moves=None, seed=None, drop_chance=0):
+        self.choose_move, self.attack_chance = STRATEGIES[strategy]
+        self.max_moves = max_moves
+        self.rng = random.Random(seed)
+        self.drop_chance = drop_chance
+
+        self.addr = None
+        self.port = None
+        self.sock = None
+        self.length_prefix_size = c.LENGTH_PREFIX_SIZE
+        self.number = None
+        self.view = None
+        self.stats = None
+        # Coordinates of every tile the bot stood on
+        self.visited = set()
+        # Set when a received view delta did not match the player view, a full view is requested on the next turn
+        self.view_out_of_sync = False
+
+        self.moves = 0
+        # Seconds between sending a move and receiving its result, for every move
+        self.latencies = []
+        # Sessions resumed after a lost connection and the bytes of the connections before
+        self.resumes = 0
+        self.previous_bytes = 0
+        # "win", "dead", "done" (max_moves reached) or "closed" (connection lost) once the bot stopped playing
+        self.result = None
+
+    def open_socket(self, timeout: float):
+        """Connects to the server, retries for up to timeout seconds. Returns the socket or None on failure"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return connect_socket(self.addr, self.port, CountingSocket)
+            except OSError:
+                if time.monotonic() > deadline:
+                    return None
+                time.sleep(0.1)
+
+    def connect(self, addr, port=None, timeout=10):
+        """Connects to a server (see connect_socket for addr and port) and receives the player number and player view.
+           Retries for up to timeout seconds while the server is starting. Returns 0 on success or -1 on failure"""
+        self.addr = addr
+        self.port = port
+        sock = self.open_socket(timeout)
+        if sock is None:
+            return -1
+        self.sock = sock
+
+        self.length_prefix_size = recv_init_msg(sock)
+        if self.length_prefix_size == -1:
+            return -1
+        start_heartbeat(sock, self.length_prefix_size)
+
+        self.number = recv_msg(sock, self.length_prefix_size)
+        player_view = recv_msg(sock, self.length_prefix_size)
+        if not isinstance(player_view, list):
+            return -1
+        self.set_view(player_view)
+        return 0
+
+    def resume(self):
+        """Closes the connection and resumes the session on a new one. Returns 0 on success or -1 on failure"""
+        token = session_tokens.get(self.sock)
+        self.previous_bytes = self.get_bytes()
+        self.sock.close()
+        if token is None:
+            return -1
+
+        sock = self.open_socket(1)
+        if sock is None:
+            return -1
+        result = resume_session(sock, token)
+        if result == -1:
+            sock.close()
+            return -1
+
+        self.sock = sock
+        self.length_prefix_size, snapshot = result
+        start_heartbeat(sock, self.length_prefix_size)
+        self.stats = snapshot.stats
+        self.set_view(snapshot.view)
+        self.view_out_of_sync = False
+        self.resumes += 1
+        return 0
+
+    def get_bytes(self):
+        """Returns the number of bytes sent and received by the bot"""
+        if self.sock is None:
+            return self.previous_bytes
+        return self.previous_bytes + self.sock.bytes_sent + self.sock.bytes_received
+
+    def set_view(self, player_view):
+        self.view = player_view
+        tile = get_center_tile(player_view)
+        self.visited.add((tile.coordinate_x, tile.coordinate_y))
+
+    def play(self):
+        """Plays until the game is over for the bot and closes the connection, returns the result"""
+        while self.result is None:
+            try:
+                msg = recv_msg(self.sock, self.length_prefix_size)
+                if msg is None:
+                    # The server ends the session when the match ended
+                    if self.resume() == -1:
+                        self.result = "closed"
+                elif msg == sc.START:
+                    self.on_turn_start()
+                elif msg == sc.PVUPDATE:
+                    self.on_view_update()
+                elif msg == sc.WIN:
+                    self.result = "win"
+                # Turns and timeouts of other players need no answer
+            except ConnectionError:
+                if self.resume() == -1:
+                    self.result = "closed"
+
+        self.sock.close()
+        return self.result
+
+    def recv_turn_msg(self):
+        """Receives a message during the bot's turn, raises TurnTimeout if the server ended the turn"""
+        msg = recv_msg(self.sock, self.length_prefix_size)
+        if msg is None:
+            raise ConnectionError("server closed the connection")
+        if msg == sc.TIMEOUT:
+            raise TurnTimeout()
+        return msg
+
+    def on_turn_start(self):
+        try:
+            self.play_turn()
+        except TurnTimeout:
+            # Tell the server the bot knows its turn is over
+            send_msg(sc.TIMEOUT, self.sock, self.length_prefix_size)
+
+        if self.result is None and self.max_moves is not None and self.moves >= self.max_moves:
+            self.result = "done"
+        elif self.result is None and self.rng.random() < self.drop_chance:
+            if self.resume() == -1:
+                self.result = "closed"
+
+    def play_turn(self):
+        """Follows the same message flow as play_my_turn of client.py"""
+        self.stats = self.recv_turn_msg()
+
+        if self.view_out_of_sync:
+            send_msg(sc.VIEWREQUEST, self.sock, self.length_prefix_size)
+            self.set_view(self.recv_turn_msg())
+            self.view_out_of_sync = False
+
+        while True:
+            moves = get_possible_moves(self.view)
+            move = self.choose_move(self, moves) if moves else self.rng.choice(list(c.KEY_DIRECTIONS))
+
+            sent_at = time.perf_counter()
+            send_msg(move, self.sock, self.length_prefix_size)
+            move_result = self.recv_turn_msg()
+            self.latencies.append(time.perf_counter() - sent_at)
+            self.moves += 1
+
+            # If the move was invalid. A bot on a tile without exits would keep trying forever
+            if move_result == sc.NEXT:
+                if self.max_moves is not None and self.moves >= self.max_moves:
+                    self.result = "done"
+                    return
+                continue
+
+            # If the bot stepped on an enemy
+            if move_result == sc.AYSREQUEST:
+                self.set_view(self.recv_turn_msg())
+
+                attack = self.rng.random() < self.attack_chance
+                send_msg(attack, self.sock, self.length_prefix_size)
+                if not attack:
+                    self.set_view(self.recv_turn_msg())
+                    continue
+
+                # Fight result
+                self.recv_turn_msg()
+                player_view = self.recv_turn_msg()
+                if player_view == sc.DEAD:
+                    self.result = "dead"
+                    return
+                self.set_view(player_view)
+                self.stats = self.recv_turn_msg()
+                return
+
+            self.set_view(move_result)
+            if self.recv_turn_msg() == sc.STOP:
+                return
+
+    def on_view_update(self):
+        player_view_update = recv_msg(self.sock, self.length_prefix_size)
+        if type(player_view_update) == ViewDelta:
+            if not apply_view_delta(self.view, player_view_update):
+                self.view_out_of_sync = True
+        elif isinstance(player_view_update, list):
+            self.set_view(player_view_update)
@@ -0,0 +1,223 @@
+import argparse
+import select
+import socket
+import time
+
+from network import (
+    CAPTURE_RECEIVED, CAPTURE_SENT, CAPTURE_INIT, read_capture, recv_init_msg, recv_msg, get_recv_buffer,
+    send_frame, connect_socket, compressions, choose_compression
+)
+from protocol import MESSAGE_SCHEMAS, decode_capabilities
+
+import config as c
+
+# ==== Capture Replay ====
+#
+# Run with: python capture.py dump|decode|live FILE ...
+# Capture files are recorded by start_capture in network.py (see server.py --capture).
+#   dump   - prints every frame of a capture
+#   decode - feeds the frames back through recv_msg and the codec as fast as possible, without a server
+#   live   - plays the client's side of a capture against a running server as fast as possible. The server only answers
+#            like in the capture if it was started with the same --seed as the captured one and runs a single match
+
+MESSAGE_NAMES = {schema.msg_type: schema.name for schema in MESSAGE_SCHEMAS}
+
+class ReplaySocket:
+    """Stands in for the socket of a captured connection. recv_into returns the captured bytes, everything sent is dropped"""
+    def __init__(self, data: bytes):
+        self.data = memoryview(data)
+        self.position = 0
+
+    def recv_into(self, buffer):
+        size = min(len(buffer), len(self.data) - self.position)
+        buffer[:size] = self.data[self.position:self.position + size]
+        self.position += size
+        return size
+
+    def sendmsg(self, buffers):
+        return sum(len(buf) for buf in buffers)
+
+def split_capture(path: str):
+    """Reads a capture and returns the frames sent by the server and by the client as lists of (message type, data).
+       The frames of the server start with the CAPTURE_INIT record. Returns -1 if the file is not a capture file"""
+    capture = read_capture(path)
+    if capture == -1:
+        return -1
+    is_server, records = capture
+
+    server_direction = CAPTURE_SENT if is_server else CAPTURE_RECEIVED
+    server_frames = []
+    client_frames = []
+    for direction, _, msg_type, data in records:
+        if direction == server_direction:
+            server_frames.append((msg_type, data))
+        else:
+            client_frames.append((msg_type, data))
+    return server_frames, client_frames
+
+def build_stream(frames: list, length_prefix_size: int):
+    """Returns the bytes the frames were sent as"""
+    stream = bytearray()
+    for msg_type, data in frames:
+        if msg_type == CAPTURE_INIT:
+            stream += data
+            continue
+        stream.append(msg_type)
+        stream += len(data).to_bytes(length_prefix_size, "big")
+        stream += data
+    return bytes(stream)
+
+def dump(path: str):
+    capture = read_capture(path)
+    if capture == -1:
+        print(f"{path}: not a capture file")
+        return
+    is_server, records = capture
+
+    print(f"{path}: recorded by the {'server' if is_server else 'client'}, {len(records)} frames")
+    for direction, timestamp, msg_type, data in records:
+        arrow = "->" if direction == CAPTURE_SENT else "<-"
+        if msg_type == CAPTURE_INIT:
+            name = "init"
+        else:
+            name = MESSAGE_NAMES.get(msg_type & ~c.MSG_FLAG_COMPRESSED, "unknown")
+            if msg_type & c.MSG_FLAG_COMPRESSED:
+                name += " (compressed)"
+        print(f"{timestamp:12.6f} {arrow} {name:<28} {len(data):8} bytes")
+
+def decode(paths: list, count: int):
+    """Decodes the frames of every capture count times the way the client and the server receive them"""
+    total_frames = 0
+    total_bytes = 0
+    total_seconds = 0
+    for path in paths:
+        frames = split_capture(path)
+        if frames == -1:
+            print(f"{path}: not a capture file")
+            continue
+        server_frames, client_frames = frames
+        if not server_frames or server_frames[0][0] != CAPTURE_INIT:
+            print(f"{path}: the capture does not start with the handshake")
+            continue
+
+        length_prefix_size = server_frames[0][1][0]
+        # The client's answer to the handshake tells which capabilities were used
+        answer = decode_capabilities(client_frames[0][1]) if client_frames else None
+        wanted_capabilities = answer.flags if answer else 0
+        server_stream = build_stream(server_frames, length_prefix_size)
+        client_stream = build_stream(client_frames, length_prefix_size)
+
+        started = time.perf_counter()
+        for _ in range(count):
+            # The client's side, including the map cache
+            sock = ReplaySocket(server_stream)
+            recv_init_msg(sock, wanted_capabilities)
+            while recv_msg(sock, length_prefix_size) is not None:
+                pass
+
+            # The server's side
+            sock = ReplaySocket(client_stream)
+            compressions[sock] = choose_compression(wanted_capabilities)
+            while recv_msg(sock, length_prefix_size) is not None:
+                pass
+        seconds = time.perf_counter() - started
+
+        frames = len(server_frames) + len(client_frames) - 1
+        size = len(server_stream) + len(client_stream)
+        print(f"{path}: {frames} frames, {size} bytes, {seconds / count * 1e3:.3f} ms per replay")
+        total_frames += frames * count
+        total_bytes += size * count
+        total_seconds += seconds
+
+    if total_seconds:
+        print(f"total: {total_frames / total_seconds:.0f} frames/s, {total_bytes / total_seconds / 1e6:.2f} MB/s")
+
+def live(path: str, addr: str, port, timeout: float):
+    """Sends the client's frames of a capture to a server as fast as possible. Before every frame it waits (up to timeout seconds)
+       until the server sent as many frames as it did at that point of the capture"""
+    capture = read_capture(path)
+    if capture == -1:
+        print(f"{path}: not a capture file")
+        return
+    is_server, records = capture
+
+    server_direction = CAPTURE_SENT if is_server else CAPTURE_RECEIVED
+    # Frames of the client with the number of frames the server sent before each of them
+    client_frames = []
+    server_frame_count = 0
+    for direction, _, msg_type, data in records:
+        if direction == server_direction:
+            if msg_type != CAPTURE_INIT:
+                server_frame_count += 1
+        else:
+            client_frames.append((server_frame_count, msg_type, data))
+
+    sock = connect_socket(addr, port)
+    buffer = get_recv_buffer(sock)
+    data = buffer.recv_exact(sock, 1)
+    if data is None:
+        print("The server closed the connection")
+        return
+    buffer.length_prefix_size = data[0]
+
+    received = 0
+    diverged = 0
+
+    def receive_until(expected: int):
+        """Receives frames until the server sent expected frames, returns False when the connection was closed"""
+        nonlocal received, diverged
+        while received < expected:
+            frame = buffer.next_frame()
+            if frame == -1:
+                return False
+            if frame is not None:
+                received += 1
+                continue
+            # The server may answer differently than in the capture, see the --seed option of server.py
+            if not select.select([sock], [], [], timeout)[0]:
+                diverged += 1
+                return True
+            if buffer.fill(sock) == 0:
+                return False
+        return True
+
+    started = time.perf_counter()
+    sent = 0
+    for expected, msg_type, data in client_frames:
+        if not receive_until(expected):
+            break
+        # The frames are sent as they were captured, already compressed if they were
+        if send_frame(msg_type, data, sock, buffer.length_prefix_size) == -1:
+            break
+        sent += 1
+    else:
+        receive_until(server_frame_count)
+    seconds = time.perf_counter() - started
+    sock.close()
+
+    print(f"{path}: sent {sent} of {len(client_frames)} frames, received {received} of {server_frame_count} frames in {seconds:.3f} s")
+    if diverged:
+        print(f"the server did not answer like in the capture {diverged} times")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Qaraq capture replay")
+    parser.add_argument("command", choices=("dump", "decode", "live"))
+    parser.add_argument("files", nargs="+", help="capture files")
+    parser.add_argument("-n", "--count", type=int, default=100, help="replays of every capture (decode)")
+    parser.add_argument("-a", "--addr", default=socket.gethostbyname(socket.gethostname()), help="server address (live)")
+    parser.add_argument("-p", "--port", type=int, default=c.SERVER_PORT, help="server port (live)")
+    parser.add_argument("-u", "--unix", metavar="PATH", help="server's Unix domain socket, used instead of the address and port (live)")
+    parser.add_argument("-t", "--timeout", type=float, default=1, help="seconds to wait for every expected answer of the server (live)")
+    args = parser.parse_args()
+
+    if args.command == "dump":
+        for path in args.files:
+            dump(path)
+    elif args.command == "decode":
+        decode(args.files, args.count)
+    else:
+        for path in args.files:
+            if args.unix is not None:
+                live(path, args.unix, None, args.timeout)
+            else:
+                live(path, args.addr, args.port, args.timeout)
@@ -1,13 +1,19 @@
 import curses
 from curses import wrapper
 import socket
+import time
 
 from utils import load_language, print_to_log_file
 from network import *
 from ui import UI
+from codec import PlayerView, ViewDelta, apply_view_delta
 
+import config as c
 import status_codes as sc
 
+class TurnTimeout(Exception):
+    """Raised when the server ended my turn because I ran out of time"""
+
 def main(stdscr):
     # Default language is English
     messages = load_language("en.json")
@@ -21,6 +27,9 @@ def main(stdscr):
     ui.lang = lang_file.split('.')[0]
 
     i_am_dead = False
+
+    # Set when a received view delta did not match my player view, a full view is requested on my next turn
+    view_out_of_sync = False
     
     while True:
         server_addr, server_port = ui.get_server_info()
@@ -37,220 +46,403 @@ def main(stdscr):
             continue
         break
 
+    set_nodelay(my_sock)
     ui.print_msg(messages["status_messages"]["connected"])
 
     # Receive length_prefix_size form server
-    length_prefix_size = int.from_bytes(my_sock.recv(1), "big")
+    length_prefix_size = recv_init_msg(my_sock)
 
-    # Receive my player number from server
-    my_number = recv_msg(my_sock, length_prefix_size)
+    # Tell the server I'm alive while I wait for my turn or for the user
+    server_heartbeats = start_heartbeat(my_sock, length_prefix_size) is not None
+    if server_heartbeats:
+        # The server sends heartbeats too, receiving fails once it was silent for HEARTBEAT_TIMEOUT seconds
+        my_sock.settimeout(c.HEARTBEAT_TIMEOUT)
+
+    # Receive my player number from server, it is sent as a string but players_present holds ints
+    my_number = int(recv_msg(my_sock, length_prefix_size))
 
     # Receive my player view
     my_view = recv_msg(my_sock, length_prefix_size)
-    ui.update_player_view(my_view)
+    ui.update_player_view(my_view, my_number)
 
     ui.initialize_panel_menu()
     ui.main_menu.update()
 
-    # Game Loop
-    while True:
+    # The player whose turn it currently is
+    turn_taker = None
 
-        if i_am_dead:
-            break
-    
-        msg = recv_msg(my_sock, length_prefix_size)
+    # ==== Message Handlers ====
+    #
+    # Every message the server sends between my turns is handled by the handler of its code (see handlers).
+    # A handler returns True when the game is over for me
 
-        # If it is not my turn and I'm getting a message saying who's turn it is
-        if msg in sc.PLAYERS.values():
-            p = msg[1:]
-            ui.print_msg(messages["status_messages"]["player_turn"].format(p))
+    def on_player_turn(msg):
+        """Another player's turn started"""
+        nonlocal turn_taker
+        p = msg[1:]
+        turn_taker = p
+        ui.print_msg(messages["status_messages"]["player_turn"].format(p))
 
-        # If I won the game
-        elif msg == sc.WIN:
-            ui.display_end_screen("win")
-            ui.display_info_menu(messages["status_messages"]["you_win"])
-            break
-        
-        # If it is my turn
-        elif msg == sc.START:
+    def on_turn_timeout(msg):
+        """Another player ran out of time"""
+        ui.print_msg(messages["status_messages"]["turn_timeout"].format(turn_taker))
 
-            my_stats = recv_msg(my_sock, length_prefix_size)
-            ui.update_player_stats(my_stats)
-            
-            ui.print_msg(messages["status_messages"]["turn_start"])
-            while True: # Do until server tells me to STOP
-                ui.flush_window_input(ui.stdscr)
-                my_move = ui.stdscr.getkey()
-
-                # ==== Menu Navigation ====
-
-                # If Tab was pressed
-                if my_move == '\t':
-                    ui.current_menu.navigate(1)
-                    # If inventory_menu was selected, request inventory contents
-                    if ui.current_menu == ui.inventory_menu:
-                        # Request my inventory from server
-                        my_inventory = get_inventory(my_sock, length_prefix_size)
-                        ui.current_menu.update(my_inventory)
-                        item = ui.current_menu.items[ui.current_menu.position]
-                        ui.display_item_desc(item)
-                    else:
-                        ui.current_menu.update()
-                    continue
+    def on_win(msg):
+        ui.display_end_screen("win")
+        ui.display_info_menu(messages["status_messages"]["you_win"])
+        return True
 
-                # If Shift+Tab was pressed
-                elif my_move == "KEY_BTAB":
-                    ui.current_menu.navigate(-1)
-                    if ui.current_menu == ui.inventory_menu:
-                        # Request my inventory from server
-                        my_inventory = get_inventory(my_sock, length_prefix_size)
-                        ui.current_menu.update(my_inventory)
-                        item = ui.current_menu.items[ui.current_menu.position]
-                        ui.display_item_desc(item)
-                    else:
-                        ui.current_menu.update()
+    def recv_turn_msg():
+        """Receives a message during my turn, raises TurnTimeout if the server ended my turn and ConnectionError if the connection was lost"""
+        msg = recv_msg(my_sock, length_prefix_size)
+        if msg is None:
+            raise ConnectionError("connection lost")
+        if msg == sc.TIMEOUT:
+            raise TurnTimeout()
+        return msg
+
+    def wait_for_key():
+        """Waits for my next key press during my turn. Raises TurnTimeout as soon as the server ends my turn, not only after
+           the next key press, and ConnectionError if the connection was lost or the server stopped sending heartbeats"""
+        ui.stdscr.timeout(c.KEY_POLL_INTERVAL)
+        try:
+            while True:
+                try:
+                    return ui.stdscr.getkey()
+                except curses.error:
+                    # No key was pressed in time
+                    pass
+
+                msg = recv_msg(my_sock, length_prefix_size, False)
+                if msg is NOT_RECEIVED:
+                    if server_heartbeats and time.monotonic() - get_recv_buffer(my_sock).last_received > c.HEARTBEAT_TIMEOUT:
+                        # The server is gone, the game loop resumes my session
+                        my_sock.close()
+                        raise ConnectionError("no heartbeat")
                     continue
+                if msg is None:
+                    raise ConnectionError("connection lost")
+                if msg == sc.TIMEOUT:
+                    raise TurnTimeout()
+                print_to_log_file(f"Received unexpected message: {msg}")
+        finally:
+            ui.stdscr.timeout(-1)
+
+    def on_turn_start(msg):
+        """Plays my turn until the server tells me to stop or I run out of time"""
+        try:
+            return play_my_turn()
+        except TurnTimeout:
+            # Tell the server I know my turn is over, it ignores everything I sent before this
+            send_msg(sc.TIMEOUT, my_sock, length_prefix_size)
+            ui.print_msg(messages["status_messages"]["turn_timeout"].format(f"P{my_number}"))
+        except ConnectionError:
+            # The game loop resumes my session
+            pass
+
+    def reconnect():
+        """Resumes my session on a new connection after the old one was lost, returns True on success"""
+        nonlocal my_sock, length_prefix_size, my_view, turn_taker, view_out_of_sync, server_heartbeats
+        token = session_tokens.get(my_sock)
+        my_sock.close()
+        if token is None:
+            return False
+
+        ui.print_msg(messages["status_messages"]["connection_lost"])
+        deadline = time.monotonic() + c.RESUME_GRACE
+        while True:
+            new_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            try:
+                new_sock.connect((server_addr, server_port))
+                break
+            except OSError:
+                new_sock.close()
+                if time.monotonic() > deadline:
+                    return False
+                time.sleep(1)
+
+        set_nodelay(new_sock)
+        result = resume_session(new_sock, token)
+        if result == -1:
+            new_sock.close()
+            return False
+
+        my_sock = new_sock
+        length_prefix_size, snapshot = result
+        server_heartbeats = start_heartbeat(my_sock, length_prefix_size) is not None
+        if server_heartbeats:
+            my_sock.settimeout(c.HEARTBEAT_TIMEOUT)
+
+        my_view = snapshot.view
+        view_out_of_sync = False
+        ui.update_player_view(my_view, my_number)
+        ui.update_player_stats(snapshot.stats)
+        if snapshot.turn_taker:
+            turn_taker = f"P{snapshot.turn_taker}"
+        ui.print_msg(messages["status_messages"]["reconnected"])
+        return True
+
+    # ==== Move Result Handlers ====
+    #
+    # The server answers every move I make during my turn with a status code or my new player view, handled by the handler
+    # of its code or of its type (see get_move_result_handler). After a valid move it sends the status of my turn, handled
+    # by the handler of its code (see turn_status_handlers). A handler returns True when my turn is over
+
+    def on_invalid_move(move_result):
+        ui.print_msg(messages["status_messages"]["invalid_move"])
+
+    def on_attack_request(move_result):
+        """I stepped on an enemy, the server asks if I want to fight it"""
+        nonlocal my_view, i_am_dead
+        my_view = recv_turn_msg()
+        ui.update_player_view(my_view, my_number)
+
+        response = ui.are_you_sure("attack", wait_for_key)
+
+        send_msg(response, my_sock, length_prefix_size)
+        print_to_log_file(f"Sent my response: {response}")
+        # If I changed my mind
+        if response != True:
+            my_view = recv_turn_msg()
+            ui.update_player_view(my_view, my_number)
+
+            ui.clear_msg_win
+
+            ui.main_menu.update()
+            return False
+
+        fight_result = recv_turn_msg()
+
+        new_player_view = recv_turn_msg()
+
+        # If I died in battle
+        if new_player_view == sc.DEAD:
+            ui.display_end_screen("die")
+            ui.display_info_menu(messages["status_messages"]["you_died"])
+            i_am_dead = True
+            return True
+
+        ui.display_fight_result_info_menu(fight_result)
+
+        my_view = new_player_view
+        ui.update_player_view(my_view, my_number)
+
+        new_stats = recv_turn_msg()
+        ui.update_player_stats(new_stats)
+
+        ui.main_menu.update()
+        return True
+
+    def on_moved(move_result):
+        """My move was valid, shows my new player view and handles the status of my turn"""
+        nonlocal my_view
+        my_view = move_result
+        ui.update_player_view(my_view, my_number)
+
+        turn_status = recv_turn_msg()
+        handler = turn_status_handlers.get(turn_status) if type(turn_status) == str else None
+        if handler is None:
+            print_to_log_file(f"Received unexpected turn status: {turn_status}")
+            return False
+        return handler(turn_status)
+
+    def on_turn_continue(turn_status):
+        """I have moves left"""
+
+    def on_turn_stop(turn_status):
+        ui.print_msg(messages["status_messages"]["turn_end"])
+        return True
+
+    move_result_handlers = {
+        sc.NEXT: on_invalid_move,
+        sc.AYSREQUEST: on_attack_request
+    }
+    # Handlers of the move results that are not status codes by their type
+    move_result_type_handlers = {
+        PlayerView: on_moved,
+        list: on_moved
+    }
+    turn_status_handlers = {
+        sc.CONTINUE: on_turn_continue,
+        sc.STOP: on_turn_stop
+    }
+
+    def get_move_result_handler(move_result):
+        """Returns the handler of a move result or None if there is none"""
+        if type(move_result) == str:
+            return move_result_handlers.get(move_result)
+        return move_result_type_handlers.get(type(move_result))
+
+    def play_my_turn():
+        nonlocal my_view, view_out_of_sync
+
+        my_stats = recv_turn_msg()
+        ui.update_player_stats(my_stats)
+
+        if view_out_of_sync:
+            send_msg(sc.VIEWREQUEST, my_sock, length_prefix_size)
+            my_view = recv_turn_msg()
+            ui.update_player_view(my_view, my_number)
+            view_out_of_sync = False
+        
+        ui.print_msg(messages["status_messages"]["turn_start"])
+        while True: # Do until server tells me to STOP
+            ui.flush_window_input(ui.stdscr)
+            my_move = wait_for_key()
+
+            # ==== Menu Navigation ====
+
+            # If Tab was pressed
+            if my_move == '\t':
+                ui.current_menu.navigate(1)
+                # If inventory_menu was selected, request inventory contents
+                if ui.current_menu == ui.inventory_menu:
+                    # Request my inventory from server
+                    my_inventory = get_inventory(my_sock, length_prefix_size)
+                    ui.current_menu.update(my_inventory)
+                    item = ui.current_menu.items[ui.current_menu.position]
+                    ui.display_item_desc(item)
+                else:
+                    ui.current_menu.update()
+                continue
+
+            # If Shift+Tab was pressed
+            elif my_move == "KEY_BTAB":
+                ui.current_menu.navigate(-1)
+                if ui.current_menu == ui.inventory_menu:
+                    # Request my inventory from server
+                    my_inventory = get_inventory(my_sock, length_prefix_size)
+                    ui.current_menu.update(my_inventory)
+                    item = ui.current_menu.items[ui.current_menu.position]
+                    ui.display_item_desc(item)
+                else:
+                    ui.current_menu.update()
+                continue
 
-                # If Enter was pressed
-                elif my_move == '\n':
-                    # I assume that menu hasn't changed
-                    menu_changed = False
-                    
-                    old_menu = ui.current_menu
-                    result = ui.current_menu.run()
-
-                    # If a new menu was selected (ui.current_menu was updated)
-                    if ui.current_menu != old_menu:
-                        menu_changed = True
-
-                    # If the Exit option was entered
-                    if result == -1:
-                        if ui.current_menu != ui.main_menu:
-                            ui.current_menu = ui.main_menu
+            # If Enter was pressed
+            elif my_move == '\n':
+                # I assume that menu hasn't changed
+                menu_changed = False
+                
+                old_menu = ui.current_menu
+                result = ui.current_menu.run()
+
+                # If a new menu was selected (ui.current_menu was updated)
+                if ui.current_menu != old_menu:
+                    menu_changed = True
+
+                # If the Exit option was entered
+                if result == -1:
+                    if ui.current_menu != ui.main_menu:
+                        ui.current_menu = ui.main_menu
+                        ui.current_menu.position = 0
+                        ui.current_menu.update()
+                    else:
+                        if ui.are_you_sure("exit", wait_for_key):
+                            my_sock.close()
+                            return True
+                        else:
                             ui.current_menu.position = 0
                             ui.current_menu.update()
-                        else:
-                            if ui.are_you_sure("exit"):
-                                my_sock.close()
-                                return
-                            else:
-                                ui.current_menu.position = 0
-                                ui.current_menu.update()
-
-                    # If the inventory_menu was opened
-                    if ui.current_menu == ui.inventory_menu and menu_changed:
-                        # Request my inventory from server
-                        my_inventory = get_inventory(my_sock, length_prefix_size)
-                        # Display the inventory
-                        ui.current_menu.update(my_inventory)
-                        item = ui.current_menu.items[ui.current_menu.position]
-                        ui.display_item_desc(item)
-                        
 
-                    # If an item in the inventory_menu was selected
-                    if ui.current_menu == ui.inventory_menu and not menu_changed:
-                        # If an empty inventory slot was selected
-                        if not result:
-                            continue
-
-                        # send itemrequest to server
-                        send_msg(sc.ITEMREQUEST, my_sock, length_prefix_size)
-                        
-                        # Send the items index
-                        send_msg(str(result), my_sock, length_prefix_size)
-
-                        server_response = recv_msg(my_sock, length_prefix_size)
-                        if server_response == sc.AYSREQUEST:
-                            action = recv_msg(my_sock, length_prefix_size)
-
-                            response = ui.are_you_sure(action)
+                # If the inventory_menu was opened
+                if ui.current_menu == ui.inventory_menu and menu_changed:
+                    # Request my inventory from server
+                    my_inventory = get_inventory(my_sock, length_prefix_size)
+                    # Display the inventory
+                    ui.current_menu.update(my_inventory)
+                    item = ui.current_menu.items[ui.current_menu.position]
+                    ui.display_item_desc(item)
+                    
 
-                            send_msg(response, my_sock, length_prefix_size)
+                # If an item in the inventory_menu was selected
+                if ui.current_menu == ui.inventory_menu and not menu_changed:
+                    # If an empty inventory slot was selected
+                    if not result:
+                        continue
 
-                            if response == True:
-                                new_stats = recv_msg(my_sock, length_prefix_size)
-                                ui.update_player_stats(new_stats)
-                            
-                            ui.current_menu = ui.main_menu
-                            ui.main_menu.update()
+                    # send itemrequest to server
+                    send_msg(sc.ITEMREQUEST, my_sock, length_prefix_size)
                     
-                    continue
+                    # Send the items index
+                    send_msg(str(result), my_sock, length_prefix_size)
 
-                # =======================
-                
-                send_msg(my_move, my_sock, length_prefix_size)
-
-                move_result = recv_msg(my_sock, length_prefix_size)
-                # If a status message was received
-                if type(move_result) == str:
-                    # If my move was invalid
-                    if move_result == sc.NEXT:
-                        ui.print_msg(messages["status_messages"]["invalid_move"])
-                        continue
-                    elif move_result == sc.AYSREQUEST:
-                        new_player_view = recv_msg(my_sock, length_prefix_size)
-                        ui.update_player_view(new_player_view)
+                    server_response = recv_turn_msg()
+                    if server_response == sc.AYSREQUEST:
+                        action = recv_turn_msg()
 
-                        response = ui.are_you_sure("attack")
+                        response = ui.are_you_sure(action, wait_for_key)
 
                         send_msg(response, my_sock, length_prefix_size)
-                        print_to_log_file(f"Sent my response: {response}")
+
                         if response == True:
-                            fight_result = recv_msg(my_sock, length_prefix_size)
-                            
-                            new_player_view = recv_msg(my_sock, length_prefix_size);
-
-                            # If I died in battle
-                            if new_player_view == sc.DEAD:
-                                ui.display_end_screen("die")
-                                ui.display_info_menu(messages["status_messages"]["you_died"])
-                                i_am_dead = True
-                                break
-
-                            ui.display_fight_result_info_menu(fight_result) 
-                            
-                            ui.update_player_view(new_player_view)
-
-                            new_stats = recv_msg(my_sock, length_prefix_size)
+                            new_stats = recv_turn_msg()
                             ui.update_player_stats(new_stats)
+                        
+                        ui.current_menu = ui.main_menu
+                        ui.main_menu.update()
+                
+                continue
 
-                            ui.main_menu.update()
-                            break
-                        # If I changed my mind
-                        else:
-                            new_player_view = recv_msg(my_sock, length_prefix_size);
-                            ui.update_player_view(new_player_view)
+            # =======================
+            
+            send_msg(my_move, my_sock, length_prefix_size)
+
+            move_result = recv_turn_msg()
+            handler = get_move_result_handler(move_result)
+            if handler is None:
+                # SOMETHING WENT WRONG
+                print_to_log_file(f"Received unexpected move result: {move_result}")
+                continue
+
+            if handler(move_result):
+                break
+
+    def on_view_update(msg):
+        """Updates my player view based on the moves of the player whose turn it currently is"""
+        nonlocal my_view, view_out_of_sync
+        player_view_update = recv_msg(my_sock, length_prefix_size)
+        if type(player_view_update) == ViewDelta:
+            # Only the changed tiles were sent
+            if apply_view_delta(my_view, player_view_update):
+                ui.update_player_view(my_view, my_number)
+            else:
+                print_to_log_file("Received view delta does not match my player view")
+                view_out_of_sync = True
+        else:
+            my_view = player_view_update
+            ui.update_player_view(my_view, my_number)
+
+    handlers = {
+        sc.WIN: on_win,
+        sc.START: on_turn_start,
+        sc.PVUPDATE: on_view_update,
+        sc.TIMEOUT: on_turn_timeout
+    }
+    for code in sc.PLAYERS.values():
+        handlers[code] = on_player_turn
+
+    # Game Loop
+    while True:
 
-                            ui.clear_msg_win
+        if i_am_dead:
+            break
+    
+        msg = recv_msg(my_sock, length_prefix_size)
 
-                            ui.main_menu.update()
-                            continue
-                    else:
-                        # SOMETHING WENT WRONG
-                        print_to_log_file("move_result received unexpected str value")
-                        continue
-                
-                # If a player_view grid was received
-                elif type(move_result) == list:
-                    # Update my player_view with the received new one
-                    ui.update_player_view(move_result)
-                else:
-                    # SOMETHING WENT WRONG
-                    print_to_log_file("move_result is of unexpected type")
-                    continue
+        # If the connection was lost or the server closed it
+        if msg is None:
+            if reconnect():
+                continue
+            break
 
-                # If my move was valid
-                turn_status = recv_msg(my_sock, length_prefix_size)
-                if turn_status == sc.CONTINUE:
-                    continue
-                elif turn_status == sc.STOP:
-                    ui.print_msg(messages["status_messages"]["turn_end"])
-                    break
-                
-        # If it is not my turn and I'm getting updates based on other players' moves
-        elif msg == sc.PVUPDATE:
-            player_view_update = recv_msg(my_sock, length_prefix_size)
-            ui.update_player_view(player_view_update)
+        handler = handlers.get(msg) if type(msg) == str else None
+        if handler is None:
+            print_to_log_file(f"Received unexpected message: {msg}")
+            continue
+
+        if handler(msg):
+            break
 
 if __name__ == "__main__":
     wrapper(main)
@@ -0,0 +1,366 @@
+import struct
+import operator
+
+import config as c
+from tile import Tile, TILE_IDS, TILE_TYPES
+from entities import ENTITY_CODES, create_entity
+
+# ==== Player View Encoding ====
+#
+# A player view is sent as a header followed by one fixed size cell per tile, row by row.
+#   header - number of rows, number of collumns, the x and y coordinates of the top left tile and the map version
+#   cell   - tile type ID, entity code (low 4 bits) and entity tier (high 4 bits), entity power, players present
+#
+# A view delta only contains the cells that changed since the view the player received last (the base version).
+#   header - the x and y coordinates of the top left tile, the base version, the new version and the number of cells
+#   cell   - row and collumn of the cell in the view followed by the same cell as above
+#
+# The players present byte is a bitmask of every player on the tile, bit 0 is player 1, bit 1 is player 2 and so on.
+# Views don't depend on who receives them so one encoded view can be sent to every player with the same view,
+# the client picks which of the players present to show (see UI.update_player_view).
+# The client rebuilds the tile art from its own tiles/ directory.
+
+VIEW_HEADER = struct.Struct(">BBhhI")
+CELL = struct.Struct(">BBBB")
+# Most rows and collumns of a view, they are sent as one byte each
+MAX_VIEW_SIZE = 255
+
+DELTA_HEADER = struct.Struct(">hhIIH")
+DELTA_CELL_POSITION = struct.Struct(">BB")
+DELTA_CELL_SIZE = DELTA_CELL_POSITION.size + CELL.size
+
+EMPTY_TILE_ID = TILE_IDS["empty"]
+
+class PlayerView(list):
+    """A decoded player view (2D grid of tiles) which remembers its position and map version so deltas can be applied to it"""
+    def __init__(self, rows, origin_x, origin_y, version):
+        super().__init__(rows)
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.version = version
+
+class ViewDelta:
+    """A decoded view delta, cells is a list of (row, collumn, tile) tuples"""
+    def __init__(self, origin_x, origin_y, base_version, version, cells):
+        self.origin_x = origin_x
+        self.origin_y = origin_y
+        self.base_version = base_version
+        self.version = version
+        self.cells = cells
+
+def get_view_origin(player_x: int, player_y: int):
+    """Returns the coordinates of the top left tile of the player view of a player at a given position"""
+    return (player_x - c.PLAYER_VIEW_X // 2, player_y - c.PLAYER_VIEW_Y // 2)
+
+def encode_players(players_present: list):
+    """Returns a bitmask representing the given list of player numbers"""
+    mask = 0
+    for number in players_present:
+        mask |= 1 << (number - 1)
+    return mask
+
+def decode_players(mask: int):
+    """Returns a list of player numbers from a bitmask created by encode_players"""
+    return [bit + 1 for bit in range(8) if mask & (1 << bit)]
+
+def encode_entity(entity):
+    """Returns the entity byte and the power byte of a given entity"""
+    if not entity:
+        return 0, 0
+    tier = getattr(entity, "tier", None) or 0
+    power = getattr(entity, "power", 0)
+    return ENTITY_CODES[type(entity)] | (tier << 4), power
+
+def pack_cell(buf, offset, tile):
+    """Writes the cell of a given tile into buf at offset. Tile can be None for tiles outside of the map"""
+    if tile is None:
+        CELL.pack_into(buf, offset, EMPTY_TILE_ID, 0, 0, 0)
+        return
+
+    entity_byte, power = encode_entity(tile.entity)
+    CELL.pack_into(buf, offset, TILE_IDS[tile.tile_type], entity_byte, power, encode_players(tile.players_present))
+
+def encode_view(player_view: list, version=0):
+    """Encodes a 2D grid of tiles (as returned by get_player_view) and returns the bytes"""
+    rows = len(player_view)
+    cols = len(player_view[0])
+    origin = player_view[0][0]
+
+    buf = bytearray(VIEW_HEADER.size + rows * cols * CELL.size)
+    VIEW_HEADER.pack_into(buf, 0, rows, cols, origin.coordinate_x, origin.coordinate_y, version)
+
+    offset = VIEW_HEADER.size
+    for row in player_view:
+        for tile in row:
+            pack_cell(buf, offset, tile)
+            offset += CELL.size
+    return bytes(buf)
+
+def encode_area(map_grid: list, origin_x: int, origin_y: int, rows: int, cols: int, version=0):
+    """Encodes an area of the map_grid like a player view, straight from the map_grid without copying any tiles.
+       Tiles outside of the map are sent as empty tiles. rows and cols can't be more than MAX_VIEW_SIZE"""
+    map_height = len(map_grid)
+    map_width = len(map_grid[0])
+
+    buf = bytearray(VIEW_HEADER.size + rows * cols * CELL.size)
+    VIEW_HEADER.pack_into(buf, 0, rows, cols, origin_x, origin_y, version)
+
+    offset = VIEW_HEADER.size
+    for tile_y in range(origin_y, origin_y + rows):
+        for tile_x in range(origin_x, origin_x + cols):
+            # Tiles outside of the map are sent as empty tiles
+            if 0 <= tile_x < map_width and 0 <= tile_y < map_height:
+                pack_cell(buf, offset, map_grid[tile_y][tile_x])
+            else:
+                pack_cell(buf, offset, None)
+            offset += CELL.size
+    return bytes(buf)
+
+def encode_player_view(map_grid: list, player_x: int, player_y: int, version=0):
+    """Encodes the player view of a player at a given position straight from the map_grid, without copying any tiles.
+       Unlike get_player_view it keeps all players present on every tile"""
+    origin_x, origin_y = get_view_origin(player_x, player_y)
+    return encode_area(map_grid, origin_x, origin_y, c.PLAYER_VIEW_Y, c.PLAYER_VIEW_X, version)
+
+def encode_player_view_delta(map_grid: list, player_x: int, player_y: int, base_version: int, version: int):
+    """Encodes only the tiles of the player view that changed after base_version. Returns None if no tile changed.
+       The player view must not have moved since the view with base_version was sent"""
+    origin_x, origin_y = get_view_origin(player_x, player_y)
+    # Tiles outside of the map never change so only the part of the view inside the map is checked
+    first_x = max(origin_x, 0)
+    first_y = max(origin_y, 0)
+    last_x = min(origin_x + c.PLAYER_VIEW_X, len(map_grid[0]))
+    last_y = min(origin_y + c.PLAYER_VIEW_Y, len(map_grid))
+
+    changed_tiles = []
+    for tile_y in range(first_y, last_y):
+        row = map_grid[tile_y]
+        for tile_x in range(first_x, last_x):
+            if row[tile_x].version > base_version:
+                changed_tiles.append(row[tile_x])
+
+    if not changed_tiles:
+        return None
+
+    buf = bytearray(DELTA_HEADER.size + len(changed_tiles) * DELTA_CELL_SIZE)
+    DELTA_HEADER.pack_into(buf, 0, origin_x, origin_y, base_version, version, len(changed_tiles))
+
+    offset = DELTA_HEADER.size
+    for tile in changed_tiles:
+        DELTA_CELL_POSITION.pack_into(buf, offset, tile.coordinate_y - origin_y, tile.coordinate_x - origin_x)
+        pack_cell(buf, offset + DELTA_CELL_POSITION.size, tile)
+        offset += DELTA_CELL_SIZE
+    return bytes(buf)
+
+# ==== Player Stats Encoding ====
+#
+# Player stats (see Player.get_stats) are sent as one signed 16 bit integer per stat in the order of STAT_NAMES
+
+STATS = struct.Struct(">hhhh")
+STAT_NAMES = ("extra_power", "base_moves", "extra_moves", "health")
+STAT_NAMES_SET = frozenset(STAT_NAMES)
+# Returns the stats of a stats dictionary in the order of STAT_NAMES
+get_stat_values = operator.itemgetter(*STAT_NAMES)
+
+def is_player_stats(msg):
+    """Returns True if msg is a stats dictionary as returned by Player.get_stats"""
+    return type(msg) == dict and msg.keys() == STAT_NAMES_SET
+
+def encode_stats(stats: dict):
+    """Encodes a stats dictionary and returns the bytes, returns None if a stat does not fit"""
+    try:
+        return STATS.pack(*get_stat_values(stats))
+    except struct.error:
+        return None
+
+def decode_stats(data):
+    """Decodes stats encoded by encode_stats and returns them as a dictionary"""
+    return dict(zip(STAT_NAMES, STATS.unpack(data)))
+
+def unpack_cell(data, offset, tile_x, tile_y):
+    """Rebuilds a Tile object from the cell at offset in data"""
+    tile_id, entity_byte, power, players_mask = CELL.unpack_from(data, offset)
+    return build_tile(tile_id, entity_byte, power, players_mask, tile_x, tile_y)
+
+def build_tile(tile_id, entity_byte, power, players_mask, tile_x, tile_y):
+    """Rebuilds a Tile object from the values of a cell"""
+    tile = Tile(TILE_TYPES[tile_id], tile_x, tile_y)
+    tile.players_present = decode_players(players_mask)
+
+    entity = create_entity(entity_byte & 0x0F, entity_byte >> 4, power)
+    if entity:
+        tile.add_entity(entity)
+    return tile
+
+def decode_view(data):
+    """Decodes a player view encoded by encode_view or encode_player_view and returns it as a PlayerView"""
+    rows, cols, origin_x, origin_y, version = VIEW_HEADER.unpack_from(data, 0)
+
+    player_view = PlayerView([[None for _ in range(cols)] for _ in range(rows)], origin_x, origin_y, version)
+    offset = VIEW_HEADER.size
+    for i in range(rows):
+        for j in range(cols):
+            player_view[i][j] = unpack_cell(data, offset, origin_x + j, origin_y + i)
+            offset += CELL.size
+    return player_view
+
+def decode_view_delta(data):
+    """Decodes a view delta encoded by encode_player_view_delta and returns it as a ViewDelta"""
+    origin_x, origin_y, base_version, version, count = DELTA_HEADER.unpack_from(data, 0)
+
+    cells = []
+    offset = DELTA_HEADER.size
+    for _ in range(count):
+        row, col = DELTA_CELL_POSITION.unpack_from(data, offset)
+        tile = unpack_cell(data, offset + DELTA_CELL_POSITION.size, origin_x + col, origin_y + row)
+        cells.append((row, col, tile))
+        offset += DELTA_CELL_SIZE
+    return ViewDelta(origin_x, origin_y, base_version, version, cells)
+
+def apply_view_delta(player_view: PlayerView, delta: ViewDelta):
+    """Applies a view delta to a player view. Returns True on success and False if the delta was made for a different view (desync)"""
+    if not isinstance(player_view, PlayerView):
+        return False
+    if (player_view.origin_x, player_view.origin_y, player_view.version) != (delta.origin_x, delta.origin_y, delta.base_version):
+        return False
+
+    for row, col, tile in delta.cells:
+        player_view[row][col] = tile
+    player_view.version = delta.version
+    return True
+
+# ==== Map Updates ====
+#
+# Clients with a map cache (c.CAP_MAP_CACHE) get the type of every tile only once, when it first comes into their player view.
+# After that only the entity and players present of tiles that changed are sent. The client builds its player view from the cache.
+#   header       - the x and y coordinates of the top left tile of the player view, the map version, the number of new and changed tiles
+#   new tile     - x and y coordinates of the tile followed by a full cell
+#   changed tile - x and y coordinates of the tile followed by a cell without the tile type ID
+# Tiles outside of the map are never sent, the client shows empty tiles for every tile it has not received.
+
+MAP_UPDATE_HEADER = struct.Struct(">hhIHH")
+MAP_TILE_POSITION = struct.Struct(">hh")
+DYNAMIC_CELL = struct.Struct(">BBB")
+
+NEW_TILE_SIZE = MAP_TILE_POSITION.size + CELL.size
+CHANGED_TILE_SIZE = MAP_TILE_POSITION.size + DYNAMIC_CELL.size
+
+def encode_map_update(map_grid: list, player_x: int, player_y: int, known_tiles: dict, version: int, force=False):
+    """Encodes the tiles of the player view the client has not received yet and the ones that changed since it received them last.
+       known_tiles maps the (x, y) coordinates of the tiles in the client's map cache to their version and is updated.
+       Returns None if no tile has to be sent, unless force is True (the player view has moved)"""
+    origin_x, origin_y = get_view_origin(player_x, player_y)
+    first_x = max(origin_x, 0)
+    first_y = max(origin_y, 0)
+    last_x = min(origin_x + c.PLAYER_VIEW_X, len(map_grid[0]))
+    last_y = min(origin_y + c.PLAYER_VIEW_Y, len(map_grid))
+
+    new_tiles = []
+    changed_tiles = []
+    for tile_y in range(first_y, last_y):
+        row = map_grid[tile_y]
+        for tile_x in range(first_x, last_x):
+            tile = row[tile_x]
+            known_version = known_tiles.get((tile_x, tile_y))
+            if known_version is None:
+                new_tiles.append(tile)
+            elif tile.version > known_version:
+                changed_tiles.append(tile)
+            else:
+                continue
+            known_tiles[(tile_x, tile_y)] = tile.version
+
+    if not new_tiles and not changed_tiles and not force:
+        return None
+
+    buf = bytearray(MAP_UPDATE_HEADER.size + len(new_tiles) * NEW_TILE_SIZE + len(changed_tiles) * CHANGED_TILE_SIZE)
+    MAP_UPDATE_HEADER.pack_into(buf, 0, origin_x, origin_y, version, len(new_tiles), len(changed_tiles))
+
+    offset = MAP_UPDATE_HEADER.size
+    for tile in new_tiles:
+        MAP_TILE_POSITION.pack_into(buf, offset, tile.coordinate_x, tile.coordinate_y)
+        pack_cell(buf, offset + MAP_TILE_POSITION.size, tile)
+        offset += NEW_TILE_SIZE
+    for tile in changed_tiles:
+        MAP_TILE_POSITION.pack_into(buf, offset, tile.coordinate_x, tile.coordinate_y)
+        entity_byte, power = encode_entity(tile.entity)
+        DYNAMIC_CELL.pack_into(buf, offset + MAP_TILE_POSITION.size, entity_byte, power, encode_players(tile.players_present))
+        offset += CHANGED_TILE_SIZE
+    return bytes(buf)
+
+# ==== Map Deltas ====
+#
+# Spectators watching the whole map get it once in chunks (see spectators.py), after that only the tiles that changed are sent.
+#   header - the map version the spectator had (the base version), the new version and the number of tiles
+#   tile   - x and y coordinates of the tile followed by a full cell
+
+MAP_DELTA_HEADER = struct.Struct(">III")
+
+class MapDelta:
+    """A decoded map delta, cells is a list of (x, y, tile) tuples"""
+    def __init__(self, base_version, version, cells):
+        self.base_version = base_version
+        self.version = version
+        self.cells = cells
+
+def encode_map_delta(tiles: list, base_version: int, version: int):
+    """Encodes the given tiles of the map as a map delta and returns the bytes"""
+    buf = bytearray(MAP_DELTA_HEADER.size + len(tiles) * NEW_TILE_SIZE)
+    MAP_DELTA_HEADER.pack_into(buf, 0, base_version, version, len(tiles))
+
+    offset = MAP_DELTA_HEADER.size
+    for tile in tiles:
+        MAP_TILE_POSITION.pack_into(buf, offset, tile.coordinate_x, tile.coordinate_y)
+        pack_cell(buf, offset + MAP_TILE_POSITION.size, tile)
+        offset += NEW_TILE_SIZE
+    return bytes(buf)
+
+def decode_map_delta(data):
+    """Decodes a map delta encoded by encode_map_delta and returns it as a MapDelta"""
+    base_version, version, count = MAP_DELTA_HEADER.unpack_from(data, 0)
+
+    cells = []
+    offset = MAP_DELTA_HEADER.size
+    for _ in range(count):
+        tile_x, tile_y = MAP_TILE_POSITION.unpack_from(data, offset)
+        cells.append((tile_x, tile_y, unpack_cell(data, offset + MAP_TILE_POSITION.size, tile_x, tile_y)))
+        offset += NEW_TILE_SIZE
+    return MapDelta(base_version, version, cells)
+
+class MapCache:
+    """The tiles of the map a client has received through map updates"""
+    def __init__(self):
+        # Tiles by their (x, y) coordinates
+        self.tiles = {}
+
+    def apply_update(self, data):
+        """Applies a map update encoded by encode_map_update and returns the new player view as a PlayerView"""
+        origin_x, origin_y, version, new_count, changed_count = MAP_UPDATE_HEADER.unpack_from(data, 0)
+
+        offset = MAP_UPDATE_HEADER.size
+        for _ in range(new_count):
+            tile_x, tile_y = MAP_TILE_POSITION.unpack_from(data, offset)
+            self.tiles[(tile_x, tile_y)] = unpack_cell(data, offset + MAP_TILE_POSITION.size, tile_x, tile_y)
+            offset += NEW_TILE_SIZE
+
+        for _ in range(changed_count):
+            tile_x, tile_y = MAP_TILE_POSITION.unpack_from(data, offset)
+            entity_byte, power, players_mask = DYNAMIC_CELL.unpack_from(data, offset + MAP_TILE_POSITION.size)
+            cached_tile = self.tiles.get((tile_x, tile_y))
+            if cached_tile is not None:
+                tile_id = TILE_IDS[cached_tile.tile_type]
+                self.tiles[(tile_x, tile_y)] = build_tile(tile_id, entity_byte, power, players_mask, tile_x, tile_y)
+            offset += CHANGED_TILE_SIZE
+
+        return self.get_player_view(origin_x, origin_y, version)
+
+    def get_player_view(self, origin_x: int, origin_y: int, version=0):
+        """Builds the player view with a given top left tile from the cached tiles"""
+        rows = []
+        for tile_y in range(origin_y, origin_y + c.PLAYER_VIEW_Y):
+            row = []
+            for tile_x in range(origin_x, origin_x + c.PLAYER_VIEW_X):
+                tile = self.tiles.get((tile_x, tile_y))
+                row.append(tile if tile is not None else Tile("empty", tile_x, tile_y))
+            rows.append(row)
+        return PlayerView(rows, origin_x, origin_y, version)
@@ -15,6 +15,8 @@ MESSAGE_WIN_HEIGHT = 3
 
 # Size (both height and width) of the entire map
 MAP_SIZE = 15
+# Maps bigger than this are kept in a MapStore (see mapstore.py) instead of a grid of Tile objects
+COMPACT_MAP_SIZE = 256
 # Likelihood of a tile containing a room, the lower the number, the higher the chance of generation
 ROOM_LIKELIHOOD = 3
 
@@ -36,17 +38,103 @@ KEY_DIRECTIONS = {
 
 # ==== NETWORKING ====
 
+# Port the server listens on by default
+SERVER_PORT = 8080
+
+# Most worker processes of the supervisor (server.py --workers), their index must fit in the first byte of a session token
+MAX_WORKERS = 256
+# Seconds between the health reports of worker processes to the supervisor (server.py --workers)
+WORKER_REPORT_INTERVAL = 2
+# Seconds between the health summaries printed by the supervisor
+SUPERVISOR_HEALTH_INTERVAL = 30
+# Most connections passed to a worker in one message
+WORKER_MAX_FDS = 1
+
 # Must be 1 byte in size (cannot be larger than 255)
 LENGTH_PREFIX_SIZE = 4 
 
+# Initial size of the receive buffer of every connection, grows when a bigger message is received
+RECV_BUFFER_SIZE = 65536
+# Most bytes of data a received frame can have, the connection is closed when a frame header claims more
+MAX_FRAME_SIZE = 1024 * 1024
+
+# Bytes the server lets pile up in a connection's write buffer before it considers the client slow
+#   Messages for a slow client wait in its outbox, where older player view updates are replaced by newer ones
+WRITE_BUFFER_HIGH_WATER = 65536
+# Most bytes that can wait in the outbox of a slow client, the client is disconnected when it is exceeded
+OUTBOX_LIMIT = 262144
+# Seconds a client can stay slow before it is disconnected, None to never disconnect slow clients
+SLOW_CLIENT_TIMEOUT = 15
+
+# Seconds a player has for their whole turn, the turn is ended when the time runs out (None for no limit)
+TURN_TIMEOUT = 120
+# Seconds a player has to answer an "are you sure" prompt or send the item of an item request. When the time runs out the prompt
+# is declined and the turn of the player ends, like when TURN_TIMEOUT runs out. Prompts never last longer than the rest of the turn
+PROMPT_TIMEOUT = 30
+# Milliseconds the client waits for a key press during its turn before checking whether the server ended the turn
+KEY_POLL_INTERVAL = 100
+
+# Seconds between the heartbeats the client and the server send each other
+HEARTBEAT_INTERVAL = 5
+# Seconds without any message from the other side after which the server or a client considers the connection dead
+HEARTBEAT_TIMEOUT = 20
+
+# Seconds a player who lost their connection can reconnect and resume their session, their turns are skipped in the meantime
+RESUME_GRACE = 60
+# Bytes of the session token every player gets to resume their session, the first one is the index of the worker process hosting it
+SESSION_TOKEN_SIZE = 16
+
+# Least seconds between two frames sent to the spectators of a match, the changes in between are sent together
+SPECTATOR_INTERVAL = 0.1
+# Spectators written to before the fan-out gives the event loop back to the matches
+SPECTATOR_BATCH = 64
+# Rows and collumns of the chunks the whole map is sent to spectators in, at most 255 (see codec.VIEW_HEADER)
+SPECTATOR_CHUNK_SIZE = 64
+
 MSG_TYPE_STR = 0 # Used to indicate that the upcoming message is an encoded string
 MSG_TYPE_OBJ = 1 # Used to indicate that the upcoming message is a pickled list, dictionary or tuple
 MSG_TYPE_BIT = 2 # Used to indicate that the upcoming message is a True/False value
 #MSG_TYPE_INT = 3 # Used to indicate that the upcoming message is an integer
+MSG_TYPE_VIEW = 4 # Used to indicate that the upcoming message is a player view encoded by codec.py
+MSG_TYPE_VIEW_DELTA = 5 # Used to indicate that the upcoming message contains only the changed tiles of a player view
+MSG_TYPE_CAPS = 6 # Used during the handshake to indicate that the upcoming message is a bitmask of capabilities
+MSG_TYPE_STATS = 7 # Used to indicate that the upcoming message is a player stats dictionary encoded by codec.py
+MSG_TYPE_MAP_UPDATE = 8 # Used to indicate that the upcoming message contains the new and changed tiles of a player view for the client's map cache
+MSG_TYPE_CODE = 9 # Used to indicate that the upcoming message is a status code, move or action sent as its ID (see protocol.CODES)
+MSG_TYPE_INVENTORY = 10 # Used to indicate that the upcoming message is an inventory encoded by protocol.py
+MSG_TYPE_FIGHT_RESULT = 11 # Used to indicate that the upcoming message is a fight result encoded by protocol.py
+MSG_TYPE_INVENTORY_PUSH = 12 # Used to indicate that the upcoming message is the new inventory of the player, sent whenever it changes
+MSG_TYPE_HEARTBEAT = 13 # Used to indicate an empty message sent only to show that the connection is alive
+MSG_TYPE_SPECTATE = 14 # Used to indicate that the upcoming message is the match and player a spectator wants to watch
+MSG_TYPE_SESSION = 15 # Used to indicate that the upcoming message is a session token
+MSG_TYPE_SNAPSHOT = 16 # Used to indicate that the upcoming message is the state of the match sent to a resumed player
+MSG_TYPE_MAP_DELTA = 17 # Used to indicate that the upcoming message contains the tiles of the whole map that changed, sent to spectators
+
+# Set in the message type byte when the message data is compressed with the negotiated compression
+MSG_FLAG_COMPRESSED = 0x80
+
+# Capabilities negotiated during the handshake
+CAP_ZLIB = 0x01 # Compress messages with zlib
+CAP_LZMA = 0x02 # Compress messages with lzma (used only if zlib is not wanted)
+CAP_MAP_CACHE = 0x04 # The client keeps the tiles it has seen, player views are sent as map updates
+CAP_SPECTATE = 0x08 # The client watches a match instead of playing, it sends a protocol.SpectateRequest after the handshake
+CAP_RESUME = 0x10 # The client resumes a session after losing its connection, it sends its protocol.SessionToken after the handshake
+
+SERVER_CAPABILITIES = CAP_ZLIB | CAP_LZMA | CAP_MAP_CACHE | CAP_SPECTATE | CAP_RESUME # Capabilities offered by the server
+CLIENT_CAPABILITIES = CAP_ZLIB | CAP_MAP_CACHE # Capabilities the client wants to use if the server offers them
+
+# Messages smaller than this many bytes are never compressed
+COMPRESSION_THRESHOLD = 200
+# Most bytes the data of a compressed message may expand to, the server disconnects clients sending messages expanding further
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+# Seconds the server waits for a new client to answer the handshake
+HANDSHAKE_TIMEOUT = 10
 
 # ==== MISC ====
 
 LANG_DIR = "lang/"
+TILES_DIR = "tiles/"
 
 LOGO = """
   ____                        
@@ -10,10 +10,11 @@ TIER = {
 class Enemy:
     likelihood = c.ENEMY_LIKELIHOOD
     
-    def __init__(self, tier):
+    def __init__(self, tier, power=None, rng=random):
         self.entity_type = "enemy"
         self.tier = tier
-        self.power = random.randrange(TIER[tier][0], TIER[tier][1])
+        # power is only given when rebuilding an enemy received over the network, otherwise it is picked with rng
+        self.power = power if power is not None else rng.randrange(TIER[tier][0], TIER[tier][1])
         self.char = 'e' + str(self.power)
 
 class Dragon:
@@ -45,3 +46,23 @@ ENTITIES = [
 ]
 
 ENTITY_LIKELIHOODS = [entity.likelihood for entity in ENTITIES]
+
+# Numeric code of every entity class, used to send entities over the network (0 means no entity)
+ENTITY_CODES = {
+    Enemy: 1,
+    Dragon: 2,
+    Chest: 3,
+    Heal: 4
+}
+
+def create_entity(code, tier, power):
+    """Returns a new instance of the entity class specified by code, used to rebuild entities received over the network. Returns None for unknown codes"""
+    if code == ENTITY_CODES[Enemy]:
+        return Enemy(tier, power)
+    elif code == ENTITY_CODES[Dragon]:
+        return Dragon()
+    elif code == ENTITY_CODES[Chest]:
+        return Chest(tier)
+    elif code == ENTITY_CODES[Heal]:
+        return Heal()
+    return None
@@ -0,0 +1,77 @@
+import config as c
+from codec import get_view_origin
+
+# ==== Interest Management ====
+#
+# A move only changes the tiles between the previous and the current position of the player who moved.
+# Only players whose player view overlaps those tiles need an update, ViewportIndex finds them without
+# checking every player of the match.
+
+def get_viewport(player_x: int, player_y: int):
+    """Returns the area (first x, first y, last x, last y) of the player view of a player at a given position"""
+    origin_x, origin_y = get_view_origin(player_x, player_y)
+    return (origin_x, origin_y, origin_x + c.PLAYER_VIEW_X - 1, origin_y + c.PLAYER_VIEW_Y - 1)
+
+def areas_overlap(area: tuple, other_area: tuple):
+    """Returns True if two areas (first x, first y, last x, last y) have at least one tile in common"""
+    return area[0] <= other_area[2] and other_area[0] <= area[2] and area[1] <= other_area[3] and other_area[1] <= area[3]
+
+class ViewportIndex:
+    """Spatial index of the player views of all players of a match. The map is split into buckets of
+       PLAYER_VIEW_X by PLAYER_VIEW_Y tiles, every player is listed in the (at most 4) buckets their player view overlaps"""
+
+    def __init__(self, bucket_width=c.PLAYER_VIEW_X, bucket_height=c.PLAYER_VIEW_Y):
+        self.bucket_width = bucket_width
+        self.bucket_height = bucket_height
+
+        # Players by bucket coordinates
+        self.buckets = {}
+        # Viewport and bucket coordinates of every indexed player
+        self.viewports = {}
+        self.player_buckets = {}
+
+    def get_bucket_keys(self, area: tuple):
+        """Returns the coordinates of all buckets an area overlaps"""
+        first_x, first_y, last_x, last_y = area
+        return [
+            (bucket_x, bucket_y)
+            for bucket_y in range(first_y // self.bucket_height, last_y // self.bucket_height + 1)
+            for bucket_x in range(first_x // self.bucket_width, last_x // self.bucket_width + 1)
+        ]
+
+    def update(self, player):
+        """Adds a player to the index or moves them to their current position"""
+        viewport = get_viewport(player.player_x, player.player_y)
+        if self.viewports.get(player) == viewport:
+            return
+        self.viewports[player] = viewport
+
+        bucket_keys = self.get_bucket_keys(viewport)
+        if self.player_buckets.get(player) == bucket_keys:
+            return
+
+        self.remove_from_buckets(player)
+        self.player_buckets[player] = bucket_keys
+        for key in bucket_keys:
+            self.buckets.setdefault(key, set()).add(player)
+
+    def remove(self, player):
+        """Removes a player from the index"""
+        self.remove_from_buckets(player)
+        self.viewports.pop(player, None)
+
+    def remove_from_buckets(self, player):
+        for key in self.player_buckets.pop(player, []):
+            bucket = self.buckets[key]
+            bucket.discard(player)
+            if not bucket:
+                del self.buckets[key]
+
+    def get_players(self, area: tuple):
+        """Returns the set of players whose player view overlaps an area (first x, first y, last x, last y)"""
+        players = set()
+        for key in self.get_bucket_keys(area):
+            for player in self.buckets.get(key, ()):
+                if areas_overlap(self.viewports[player], area):
+                    players.add(player)
+        return players
@@ -100,3 +100,24 @@ def generate_item(tier):
     """Returns an instance of an item class generated based on tile tier"""
     new_item = random.choice(ITEM_CLASSES[tier])
     return new_item(tier)
+
+# Numeric code of every item class, used to send items over the network as a single byte
+ITEM_CODES = {
+    WeaponItem: 1,
+    HealingPotion: 2,
+    StrongHealingPotion: 3,
+    SpeedPotion: 4,
+    PowerScroll: 5,
+    Crocs: 6,
+    Sneakers: 7,
+    Key: 8
+}
+
+ITEM_CLASSES_BY_CODE = {code: item_class for item_class, code in ITEM_CODES.items()}
+
+def create_item(code, tier):
+    """Returns a new instance of the item class specified by code, used to rebuild items received over the network. Returns None for unknown codes"""
+    item_class = ITEM_CLASSES_BY_CODE.get(code)
+    if item_class is None:
+        return None
+    return item_class(tier)
@@ -0,0 +1,201 @@
+import argparse
+import asyncio
+import contextlib
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bot import Bot, STRATEGIES
+from server import start_local_server
+from network import remove_stale_socket
+from spectator import Spectator
+
+import config as c
+
+# ==== Load Test ====
+#
+# Run with: python loadtest.py -m MATCHES -n PLAYERS [-t tcp|unix|local]
+# Starts a server, plays MATCHES matches of PLAYERS bots at the same time and reports the moves per second,
+# the move latency, the bytes per move and the CPU time used by the server. The bots connect over loopback TCP,
+# a Unix domain socket or in-process (see local.py), in which case the server runs in a thread of the load test.
+
+TRANSPORTS = ("tcp", "unix", "local")
+
+def get_process_cpu(pid: int):
+    """Returns the user and system CPU time of a process and its parent pid from /proc, returns None if it can't be read"""
+    try:
+        with open(f"/proc/{pid}/stat", 'r') as f:
+            stat = f.read()
+    except OSError:
+        return None
+
+    # The process name may contain spaces, the other fields come after it
+    fields = stat[stat.rindex(')') + 2:].split()
+    cpu_seconds = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    return cpu_seconds, int(fields[1])
+
+def get_server_cpu(pid: int):
+    """Returns the CPU seconds used by the server process and its worker processes, returns None where /proc is not available"""
+    server = get_process_cpu(pid)
+    if server is None:
+        return None
+
+    cpu_seconds = server[0]
+    for name in os.listdir("/proc"):
+        if not name.isdigit() or int(name) == pid:
+            continue
+        process = get_process_cpu(int(name))
+        if process is not None and process[1] == pid:
+            cpu_seconds += process[0]
+    return cpu_seconds
+
+def get_loop_cpu(loop):
+    """Returns the CPU seconds used by the thread running the event loop loop"""
+    async def get_thread_time():
+        return time.thread_time()
+    return asyncio.run_coroutine_threadsafe(get_thread_time(), loop).result()
+
+def run_bots(addr, port, count: int, strategy: str, max_moves: int, seed: int, drop_chance=0):
+    """Plays count bots in threads of this process, returns the moves, move latencies, bytes, result and resumed sessions of every bot"""
+    bots = [Bot(strategy, max_moves, seed + i, drop_chance) for i in range(count)]
+
+    def play(bot):
+        if bot.connect(addr, port) == -1:
+            bot.result = "failed"
+            return
+        bot.play()
+
+    threads = [threading.Thread(target=play, args=(bot,)) for bot in bots]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return [(bot.moves, bot.latencies, bot.get_bytes(), bot.result, bot.resumes) for bot in bots]
+
+def percentile(values: list, p: float):
+    """Returns the p-th percentile (0 - 100) of values using the nearest rank"""
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def main(matches: int, max_players: int, max_moves: int, strategy: str, port: int, map_size: int, workers: int, processes: int, capture_dir=None, seed=None, spectator_count=0, drop_chance=0, transport="tcp"):
+    bot_count = matches * max_players
+    if capture_dir is not None:
+        capture_dir = os.path.abspath(capture_dir)
+
+    server = None
+    local_server = None
+    # The server's output is not shown, like the output of the server process
+    server_output = contextlib.ExitStack()
+    if transport == "local":
+        # The bots run in this process together with the server
+        server_output.enter_context(contextlib.redirect_stdout(open(os.devnull, 'w')))
+        if seed is not None:
+            random.seed(seed)
+        local_server = start_local_server(map_size, max_players, capture_dir)
+        addr, port = local_server, None
+        processes = 1
+    else:
+        server_args = [sys.executable, "server.py", "-n", str(max_players), "-m", str(map_size), "-w", str(workers)]
+        if transport == "unix":
+            addr, port = os.path.join(tempfile.gettempdir(), f"qaraq-loadtest-{os.getpid()}.sock"), None
+            server_args += ["--unix", addr]
+        else:
+            addr = socket.gethostbyname(socket.gethostname())
+            server_args += ["-p", str(port)]
+        if capture_dir is not None:
+            server_args += ["--capture", capture_dir]
+        if seed is not None:
+            server_args += ["--seed", str(seed)]
+        server = subprocess.Popen(server_args, cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+
+    spectators = [Spectator() for _ in range(spectator_count)]
+    spectator_threads = []
+    try:
+        # Spectators watch the first match, they connect before the bots
+        for spectator in spectators:
+            if spectator.connect(addr, port) == 0:
+                spectator_threads.append(threading.Thread(target=spectator.watch))
+        for thread in spectator_threads:
+            thread.start()
+
+        cpu_before = get_loop_cpu(local_server.loop) if local_server else get_server_cpu(server.pid)
+        started = time.perf_counter()
+
+        if local_server:
+            results = run_bots(addr, port, bot_count, strategy, max_moves, 0, drop_chance)
+        else:
+            # Every process gets an even share of the bots
+            processes = max(1, min(processes, bot_count))
+            shares = [bot_count // processes + (1 if i < bot_count % processes else 0) for i in range(processes)]
+            with ProcessPoolExecutor(processes) as executor:
+                futures = [
+                    executor.submit(run_bots, addr, port, share, strategy, max_moves, i * bot_count, drop_chance)
+                    for i, share in enumerate(shares)
+                ]
+                results = [bot_result for future in futures for bot_result in future.result()]
+
+        elapsed = time.perf_counter() - started
+        cpu_after = get_loop_cpu(local_server.loop) if local_server else get_server_cpu(server.pid)
+
+        # The server closes the spectators when the match ends
+        for thread in spectator_threads:
+            thread.join()
+    finally:
+        server_output.close()
+        if server:
+            server.terminate()
+            server.wait()
+        if transport == "unix":
+            remove_stale_socket(addr)
+
+    moves = sum(bot_moves for bot_moves, _, _, _, _ in results)
+    latencies = [latency for _, bot_latencies, _, _, _ in results for latency in bot_latencies]
+    total_bytes = sum(bot_bytes for _, _, bot_bytes, _, _ in results)
+    resumes = sum(bot_resumes for _, _, _, _, bot_resumes in results)
+    outcomes = {}
+    for _, _, _, result, _ in results:
+        outcomes[result] = outcomes.get(result, 0) + 1
+
+    print(f"bots: {bot_count} ({matches} matches of {max_players} players), strategy: {strategy}, transport: {transport}")
+    print(f"moves: {moves} in {elapsed:.2f} s ({moves / elapsed:.1f} moves/s)")
+    print(f"move latency: p50 {percentile(latencies, 50) * 1e3:.2f} ms, p99 {percentile(latencies, 99) * 1e3:.2f} ms")
+    print(f"bytes per move: {total_bytes / moves if moves else 0:.1f}")
+    if cpu_before is not None and cpu_after is not None:
+        cpu_seconds = cpu_after - cpu_before
+        print(f"server CPU: {cpu_seconds:.2f} s ({cpu_seconds / elapsed * 100:.1f}% of one core)")
+    else:
+        print("server CPU: not available")
+    if drop_chance:
+        print(f"resumed sessions: {resumes}")
+    if spectators:
+        frames = sum(spectator.frames for spectator in spectators)
+        print(f"spectators: {len(spectator_threads)} of {len(spectators)} connected, {frames / len(spectators):.1f} frames each")
+    print("results: " + ", ".join(f"{result} {count}" for result, count in sorted(outcomes.items())))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Qaraq load test")
+    parser.add_argument("-m", "--matches", type=int, default=1, help="number of concurrent matches")
+    parser.add_argument("-n", "--max-players", type=int, default=4, help="players (bots) in every match")
+    parser.add_argument("--moves", type=int, default=100, help="moves every bot makes before it leaves")
+    parser.add_argument("-s", "--strategy", choices=STRATEGIES, default="random")
+    parser.add_argument("-p", "--port", type=int, default=c.SERVER_PORT)
+    parser.add_argument("-t", "--transport", choices=TRANSPORTS, default="tcp", help="how the bots connect to the server")
+    parser.add_argument("--map-size", type=int, default=c.MAP_SIZE)
+    parser.add_argument("-w", "--workers", type=int, default=1, help="worker processes of the server")
+    parser.add_argument("--processes", type=int, default=os.cpu_count() or 1, help="processes running the bots")
+    parser.add_argument("--capture", metavar="DIR", help="let the server record the traffic of every bot to DIR (see capture.py)")
+    parser.add_argument("--spectators", type=int, default=0, help="spectators watching the first match")
+    parser.add_argument("--drop-chance", type=float, default=0, help="chance of a bot dropping its connection and resuming its session after every turn")
+    parser.add_argument("--seed", type=int, help="seed of the server, captures of a single match can be replayed against a server with the same seed")
+    args = parser.parse_args()
+
+    main(args.matches, args.max_players, args.moves, args.strategy, args.port, args.map_size, args.workers, args.processes, args.capture, args.seed, args.spectators, args.drop_chance, args.transport)
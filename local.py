@@ -0,0 +1,224 @@
+import asyncio
+import threading
+from collections import deque
+
+# ==== In-process Transport ====
+#
+# Connects clients running in threads of the server's process (bots, simulations) to the server's event loop without
+# going through the kernel. The client's end is a LocalSocket, which works like a blocking socket with send_msg and recv_msg.
+# The server's end is a LocalTransport given to the usual Connection protocol, so the server runs the same code as for TCP.
+# Buffers are handed over between the threads as they are. A frame shared by many clients (see get_cached_frame) is not copied
+# until a client reads it into its RecvBuffer.
+
+# Default high water mark of a LocalTransport, the same as the one of asyncio's socket transports
+WRITE_BUFFER_HIGH_WATER = 64 * 1024
+
+def freeze(buf):
+    """Returns a read-only memoryview of buf that is not changed by the sender reusing buf"""
+    if type(buf) != bytes:
+        buf = bytes(buf)
+    return memoryview(buf)
+
+class LocalServer:
+    """Accepts in-process connections into the event loop loop. protocol_factory creates the protocol (a Connection) of every connection"""
+
+    def __init__(self, loop, protocol_factory):
+        self.loop = loop
+        self.protocol_factory = protocol_factory
+        self.connection_count = 0
+
+    def connect(self):
+        """Opens a connection to the server from any thread and returns its LocalSocket"""
+        sock = LocalSocket(self.loop)
+        try:
+            self.loop.call_soon_threadsafe(self.accept, sock)
+        except RuntimeError:
+            raise ConnectionRefusedError("the server is not running")
+        return sock
+
+    def accept(self, sock):
+        self.connection_count += 1
+        transport = LocalTransport(self.loop, sock, self.protocol_factory(), f"local-{self.connection_count}")
+        sock.transport = transport
+        transport.protocol.connection_made(transport)
+
+class LocalSocket:
+    """Client's end of an in-process connection. Has the methods of a blocking socket that send_msg and recv_msg use
+       and counts the bytes sent and received through it"""
+
+    def __init__(self, loop):
+        self.loop = loop
+        # Set on the event loop's thread once the server accepted the connection
+        self.transport = None
+
+        # Buffers written by the server and not read yet, the first one may be partially read
+        self.incoming = deque()
+        self.incoming_size = 0
+        self.condition = threading.Condition()
+        # eof is set when the server closed the connection, the buffers it wrote before can still be read
+        self.eof = False
+        self.closed = False
+
+        self.bytes_sent = 0
+        self.bytes_received = 0
+
+    def setsockopt(self, *args):
+        """Socket options (see set_nodelay) don't apply to in-process connections"""
+
+    def sendmsg(self, buffers, *args):
+        if self.closed or self.eof:
+            raise BrokenPipeError("connection is closed")
+
+        buffers = [freeze(buf) for buf in buffers]
+        try:
+            self.loop.call_soon_threadsafe(self.deliver, buffers)
+        except RuntimeError:
+            raise BrokenPipeError("the server is not running")
+
+        size = sum(len(buf) for buf in buffers)
+        self.bytes_sent += size
+        return size
+
+    def deliver(self, buffers):
+        """Passes buffers sent by the client to the server, runs on the event loop's thread"""
+        if self.transport is not None:
+            self.transport.receive(buffers)
+
+    def recv_into(self, buffer, nbytes=0, *args):
+        """Blocks until the server wrote something and reads as much of it as fits into buffer.
+           Returns 0 when the connection was closed"""
+        buffer = memoryview(buffer).cast("B")
+        if nbytes:
+            buffer = buffer[:nbytes]
+
+        with self.condition:
+            while not self.incoming and not self.eof and not self.closed:
+                self.condition.wait()
+
+            received = 0
+            while self.incoming and received < len(buffer):
+                chunk = self.incoming[0]
+                size = min(len(chunk), len(buffer) - received)
+                buffer[received:received + size] = chunk[:size]
+                received += size
+                if size == len(chunk):
+                    self.incoming.popleft()
+                else:
+                    self.incoming[0] = chunk[size:]
+            self.incoming_size -= received
+
+        self.bytes_received += received
+        transport = self.transport
+        if received and transport is not None and transport.protocol_paused and self.incoming_size <= transport.low_water:
+            self.loop.call_soon_threadsafe(transport.maybe_resume)
+        return received
+
+    def put(self, buffers):
+        """Hands buffers written by the server to the client, runs on the event loop's thread"""
+        with self.condition:
+            if self.closed:
+                return
+            for buf in buffers:
+                buf = freeze(buf)
+                if buf:
+                    self.incoming.append(buf)
+                    self.incoming_size += len(buf)
+            self.condition.notify_all()
+
+    def on_server_closed(self, abort: bool):
+        """Runs on the event loop's thread, an aborted connection drops the buffers that were not read yet"""
+        with self.condition:
+            self.eof = True
+            if abort:
+                self.incoming.clear()
+                self.incoming_size = 0
+            self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            if self.closed:
+                return
+            self.closed = True
+            self.incoming.clear()
+            self.incoming_size = 0
+            self.condition.notify_all()
+
+        try:
+            self.loop.call_soon_threadsafe(self.on_client_closed)
+        except RuntimeError:
+            pass
+
+    def on_client_closed(self):
+        if self.transport is not None:
+            self.transport.on_client_closed()
+
+class LocalTransport(asyncio.Transport):
+    """Server's end of an in-process connection, used by the protocol like a socket transport. Pauses the protocol while
+       the client has more than the high water mark of unread bytes"""
+
+    def __init__(self, loop, sock, protocol, peername):
+        super().__init__({"peername": peername})
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+
+        self.closing = False
+        self.protocol_paused = False
+        self.high_water = WRITE_BUFFER_HIGH_WATER
+        self.low_water = WRITE_BUFFER_HIGH_WATER // 4
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        self.high_water = WRITE_BUFFER_HIGH_WATER if high is None else high
+        self.low_water = self.high_water // 4 if low is None else low
+
+    def get_write_buffer_size(self):
+        return self.sock.incoming_size
+
+    def is_closing(self):
+        return self.closing
+
+    def write(self, data):
+        self.writelines([data])
+
+    def writelines(self, buffers):
+        if self.closing:
+            return
+        self.sock.put(buffers)
+        if not self.protocol_paused and self.sock.incoming_size > self.high_water:
+            self.protocol_paused = True
+            self.protocol.pause_writing()
+
+    def maybe_resume(self):
+        """Resumes the protocol once the client read enough, see LocalSocket.recv_into"""
+        if self.protocol_paused and not self.closing and self.sock.incoming_size <= self.low_water:
+            self.protocol_paused = False
+            self.protocol.resume_writing()
+
+    def receive(self, buffers):
+        """Copies the buffers sent by the client into the protocol's receive buffer"""
+        for buf in buffers:
+            while buf and not self.closing:
+                free_space = self.protocol.get_buffer(len(buf))
+                size = min(len(free_space), len(buf))
+                free_space[:size] = buf[:size]
+                self.protocol.buffer_updated(size)
+                buf = buf[size:]
+
+    def close(self):
+        self.shutdown(False)
+
+    def abort(self):
+        self.shutdown(True)
+
+    def shutdown(self, abort: bool):
+        if self.closing:
+            return
+        self.closing = True
+        self.sock.on_server_closed(abort)
+        self.loop.call_soon(self.protocol.connection_lost, None)
+
+    def on_client_closed(self):
+        if self.closing:
+            return
+        self.closing = True
+        self.protocol.connection_lost(None)
@@ -0,0 +1,182 @@
+import array
+
+from tile import Tile, TILE_DIRECTIONS, TILE_TYPES, TILE_IDS, TILE_MASKS, ROOM_TILE_TYPES, next_version
+from entities import ENTITY_CODES, create_entity
+
+# ==== Compact Map Store ====
+#
+# A MapStore keeps the map in flat arrays with one entry per tile (index y * width + x) instead of a Tile object per tile:
+#   tile_types - tile type ID (see TILE_IDS), NO_TILE for tiles that were not generated yet
+#   tiers      - tier of the tile, 0 for tiles without a tier
+#   entities   - code of the entity on the tile (see ENTITY_CODES), 0 for none
+#   powers     - power of the entity on the tile
+# Players present and tile versions are only set for the few tiles players walked on, they are kept in dictionaries.
+# map_store[y][x] returns a StoredTile which works like a Tile, so the game uses a MapStore like the 2D list of tiles
+# it uses for small maps (see generate_map_grid). Every tile takes 5 bytes, a 4096x4096 map 80 MiB.
+
+# Tile type ID of tiles that were not generated yet
+NO_TILE = 0xFF
+
+# Direction mask of every tile type ID, NO_TILE has no directions
+TILE_ID_MASKS = bytes(TILE_MASKS[TILE_TYPES[tile_id]] if tile_id < len(TILE_TYPES) else 0 for tile_id in range(256))
+
+class MapStore:
+    """Map of width by height tiles stored in arrays"""
+
+    def __init__(self, width: int, height: int):
+        self.width = width
+        self.height = height
+
+        size = width * height
+        self.tile_types = bytearray([NO_TILE]) * size
+        self.tiers = bytearray(size)
+        self.entities = bytearray(size)
+        self.powers = array.array('h', bytes(2 * size))
+
+        # Players present and map version of the tiles that have them by tile index
+        self.players = {}
+        self.versions = {}
+
+    def __len__(self):
+        return self.height
+
+    def __getitem__(self, y: int):
+        if y < 0:
+            y += self.height
+        if not 0 <= y < self.height:
+            raise IndexError("map row out of range")
+        return MapRow(self, y)
+
+    def get_index(self, x: int, y: int):
+        return y * self.width + x
+
+    def set_tile(self, index: int, tile_type: str, tier=0):
+        self.tile_types[index] = TILE_IDS[tile_type]
+        self.tiers[index] = tier
+
+    def get_entity(self, index: int):
+        """Returns a new instance of the entity on a tile or None"""
+        code = self.entities[index]
+        if not code:
+            return None
+        return create_entity(code, self.tiers[index], self.powers[index])
+
+    def set_entity(self, index: int, entity):
+        """Stores the entity of a tile, None removes it"""
+        if entity is None:
+            self.entities[index] = 0
+            self.powers[index] = 0
+            return
+        self.entities[index] = ENTITY_CODES[type(entity)]
+        self.powers[index] = getattr(entity, "power", 0)
+
+    def fill_empty(self):
+        """Turns every tile that was not generated into an empty tile"""
+        table = bytearray(range(256))
+        table[NO_TILE] = TILE_IDS["empty"]
+        self.tile_types = self.tile_types.translate(table)
+
+    def build_tile(self, index: int):
+        """Returns a Tile object with the values of a tile, changing it does not change the store"""
+        y, x = divmod(index, self.width)
+        tile = Tile(TILE_TYPES[self.tile_types[index]], x, y)
+        tile.tier = self.tiers[index] or None
+        tile.players_present = list(self.players.get(index, ()))
+        tile.version = self.versions.get(index, 0)
+        tile.entity = self.get_entity(index)
+        tile.refresh_tile()
+        return tile
+
+    def to_tiles(self):
+        """Returns the map as a 2D list of Tile objects"""
+        return [[self.build_tile(self.get_index(x, y)) for x in range(self.width)] for y in range(self.height)]
+
+class MapRow:
+    """One row of a MapStore, map_row[x] returns the StoredTile at x or None if it was not generated yet"""
+    __slots__ = ("store", "y")
+
+    def __init__(self, store: MapStore, y: int):
+        self.store = store
+        self.y = y
+
+    def __len__(self):
+        return self.store.width
+
+    def __getitem__(self, x: int):
+        store = self.store
+        if x < 0:
+            x += store.width
+        if not 0 <= x < store.width:
+            raise IndexError("map column out of range")
+        if store.tile_types[self.y * store.width + x] == NO_TILE:
+            return None
+        return StoredTile(store, x, self.y)
+
+class StoredTile:
+    """A tile of a MapStore. Has the attributes and methods of Tile the game uses, reading and changing them reads and changes the store"""
+    __slots__ = ("store", "index", "coordinate_x", "coordinate_y")
+
+    def __init__(self, store: MapStore, x: int, y: int):
+        self.store = store
+        self.index = y * store.width + x
+        self.coordinate_x = x
+        self.coordinate_y = y
+
+    @property
+    def tile_type(self):
+        return TILE_TYPES[self.store.tile_types[self.index]]
+
+    @property
+    def directions(self):
+        return TILE_DIRECTIONS[self.tile_type]
+
+    @property
+    def is_room(self):
+        return self.tile_type in ROOM_TILE_TYPES
+
+    @property
+    def tier(self):
+        return self.store.tiers[self.index] or None
+
+    @property
+    def entity(self):
+        return self.store.get_entity(self.index)
+
+    @property
+    def players_present(self):
+        return self.store.players.get(self.index, [])
+
+    @property
+    def version(self):
+        return self.store.versions.get(self.index, 0)
+
+    def mark_changed(self):
+        """Must be called after every change that players can see, gives the tile a new version"""
+        self.store.versions[self.index] = next_version()
+
+    def add_tier(self, tier):
+        self.store.tiers[self.index] = tier
+
+    def add_entity(self, entity):
+        self.store.set_entity(self.index, entity)
+        self.mark_changed()
+
+    def remove_entity(self):
+        self.store.set_entity(self.index, None)
+        self.mark_changed()
+
+    def add_player(self, number):
+        """Adds the player specified by number to the players present on the tile"""
+        self.store.players.setdefault(self.index, []).append(number)
+        self.mark_changed()
+
+    def remove_player(self, number):
+        """Removes the player specified by number from the players present on the tile"""
+        players = self.store.players[self.index]
+        players.remove(number)
+        if not players:
+            del self.store.players[self.index]
+        self.mark_changed()
+
+    def copy(self):
+        return self.store.build_tile(self.index)
@@ -0,0 +1,583 @@
+import asyncio
+import os
+import random
+
+from utils import generate_map_grid, get_center, get_fight_result
+from network import *
+from player import Player
+from interest import ViewportIndex
+from spectators import SpectatorFeed
+from protocol import SpectateRequest, SessionToken
+
+import config as c
+import status_codes as sc
+
+class Match:
+    """One game with its own map, players and turn coordinator. Many matches can run in one server process"""
+
+    def __init__(self, match_id: int, map_size: int, max_players: int, worker_index=0):
+        self.match_id = match_id
+        self.map_size = map_size
+        self.max_players = max_players
+        # Index of the worker process hosting the match (see supervisor.py), the session tokens of its players start with it
+        self.worker_index = worker_index
+
+        # Generated in a thread by generate_map, players are only added once it is done
+        self.map_grid = None
+        self.map_task = None
+
+        # a list of Player objects
+        self.players = []
+        # Player views of all players, used to broadcast moves only to the players who can see them
+        self.viewports = ViewportIndex()
+        self.spectators = SpectatorFeed(self)
+
+        # Number of the player whose turn it is, 0 before the first turn
+        self.turn_taker = 0
+        # Set when a player resumes their session, wakes up the coordinator when it waits for disconnected players
+        self.resumed = asyncio.Event()
+
+        # asyncio task running the coordinator, created by start
+        self.task = None
+
+    def start_map_generation(self):
+        """Starts generating the map of the match in a thread of the default executor, so the other matches keep running.
+           The map gets a random number generator of its own, seeded from the random module on the event loop,
+           so a server with a seed still generates the same maps"""
+        rng = random.Random(random.getrandbits(64))
+        loop = asyncio.get_running_loop()
+        self.map_task = loop.run_in_executor(None, generate_map_grid, self.map_size, None, rng)
+
+    async def wait_for_map(self):
+        """Waits until the map of the match is generated"""
+        self.map_grid = await asyncio.shield(self.map_task)
+
+    def is_full(self):
+        return len(self.players) == self.max_players
+
+    def add_player(self, conn):
+        """Creates a new player for a given connection and sends them important information"""
+        center_x, center_y = get_center(self.map_grid)
+
+        # Create new player object and append to list of player objects
+        new_player = Player(len(self.players) + 1, conn, conn.peername, (center_x, center_y))
+        if capabilities.get(conn, 0) & c.CAP_MAP_CACHE:
+            new_player.known_tiles = {}
+        self.players.append(new_player)
+        self.viewports.update(new_player)
+
+        # Handle new connection and send important information
+        handle_new_player_connection(self.map_grid, new_player, c.LENGTH_PREFIX_SIZE, self.worker_index)
+        self.spectators.publish((center_x, center_y, center_x, center_y))
+        return new_player
+
+    def start(self):
+        """Starts the turn coordinator of the match as an asyncio task"""
+        self.task = asyncio.get_running_loop().create_task(self.run())
+        self.spectators.start()
+        return self.task
+
+    def close(self):
+        """Closes the connections of all players and spectators of the match"""
+        for player in self.players:
+            player.player_sock.close()
+        self.spectators.close()
+
+    def broadcast_view(self, player, players: list):
+        """Sends the moves of a player to the players who can see them and lets the spectators know"""
+        changed_area = broadcast_player_view(self.map_grid, players, player, self.viewports)
+        self.spectators.publish(changed_area)
+
+    async def run(self):
+        """Game coordinator, plays the turns of all players until the game ends"""
+        players = self.players
+        max_players = self.max_players
+        viewports = self.viewports
+
+        player_disconnected = False
+        disconnected_player = None
+    
+        # Game Loop
+        while True:
+            # Check if a player has disconnected
+            if player_disconnected:
+                players.remove(player)
+                player_disconnected = False
+
+            # Remove dead players and players who lost their connection and can't resume their session anymore
+            for other_player in players:
+                if self.is_gone(other_player):
+                    viewports.remove(other_player)
+            players = [player for player in players if not self.is_gone(player)]
+
+            if len(players) == 1 and max_players > 1:
+                print(f"P{players[0].number} wins!")
+                bytes_sent = send_msg(sc.WIN, players[0].player_sock)
+                break
+
+            if not players:
+                print("No players left...")
+                break
+
+            if all(player.disconnected for player in players):
+                await self.wait_for_resume(players)
+                continue
+        
+            # Each player plays on their turn
+            for player in players:
+                # Players whose connection was lost are skipped until they resume their session
+                if player.player_sock.closed:
+                    self.on_disconnect(player)
+                if player.disconnected:
+                    continue
+
+                player.remove_extras()
+            
+                print(f"P{player.number}'s turn")
+                self.turn_taker = player.number
+
+                # Tell every player who's turn it is
+                broadcast_turn_taker(players, player)
+
+                with corked(player.player_sock):
+                    # Tell player that their turn started
+                    send_msg(sc.START, player.player_sock)
+
+                    player_stats = player.get_stats()
+                    send_stats(player_stats, player.player_sock)
+
+                # Process player's amount of moves, the turn ends early when the player runs out of time
+                try:
+                    await self.play_turn(player, players, self.get_deadline(c.TURN_TIMEOUT))
+                except asyncio.TimeoutError:
+                    self.end_turn_on_timeout(player, players)
+
+    def on_disconnect(self, player):
+        """Marks a player whose connection was lost as disconnected, they can resume their session for RESUME_GRACE seconds"""
+        if player.disconnected:
+            return
+        print(f"P{player.number} disconnected")
+        player.disconnected = True
+        player.disconnected_at = asyncio.get_running_loop().time()
+
+    def can_resume(self, player):
+        """Returns True if a disconnected player can still resume their session"""
+        if player.session_token is None or c.RESUME_GRACE is None:
+            return False
+        return asyncio.get_running_loop().time() - player.disconnected_at < c.RESUME_GRACE
+
+    def is_gone(self, player):
+        """Returns True if a player is dead or lost their connection and can't resume their session anymore"""
+        return player.is_dead or (player.disconnected and not self.can_resume(player))
+
+    async def wait_for_resume(self, players: list):
+        """Waits until a player resumes their session or the grace period of the first disconnected player ends"""
+        loop = asyncio.get_running_loop()
+        grace_end = min(player.disconnected_at for player in players) + c.RESUME_GRACE
+        self.resumed.clear()
+        try:
+            await asyncio.wait_for(self.resumed.wait(), max(grace_end - loop.time(), 0))
+        except asyncio.TimeoutError:
+            pass
+
+    def resume_player(self, player, conn):
+        """Gives a player a new connection after they lost theirs and sends them a snapshot of the match.
+           Returns False if the player can't resume their session"""
+        if self.is_gone(player):
+            return False
+
+        # The old connection may not have been noticed as lost yet
+        old_sock = player.player_sock
+        player.player_sock = conn
+        player.player_addr = conn.peername
+        old_sock.close()
+
+        player.disconnected = False
+        player.disconnected_at = None
+        player.unacknowledged_timeouts = 0
+        player.known_tiles = {} if capabilities.get(conn, 0) & c.CAP_MAP_CACHE else None
+        player.reset_view()
+        self.viewports.update(player)
+
+        send_snapshot(self.map_grid, player, self.turn_taker)
+        print(f"P{player.number} resumed their session")
+        self.resumed.set()
+        return True
+
+    def get_deadline(self, timeout):
+        """Returns the event loop time timeout seconds from now or None if timeout is None (no deadline)"""
+        if timeout is None:
+            return None
+        return asyncio.get_running_loop().time() + timeout
+
+    def get_prompt_deadline(self, turn_deadline):
+        """Returns the deadline of a prompt, which never lasts longer than the rest of the turn"""
+        prompt_deadline = self.get_deadline(c.PROMPT_TIMEOUT)
+        if prompt_deadline is None or turn_deadline is None:
+            return prompt_deadline or turn_deadline
+        return min(prompt_deadline, turn_deadline)
+
+    async def recv_reply(self, player, deadline):
+        """Waits for the next message of a player until the deadline (event loop time, None for no deadline). Raises asyncio.TimeoutError
+           when the deadline passes. Messages the player sent after their last turn timed out and before they acknowledged it are skipped"""
+        while True:
+            if deadline is None:
+                msg = await player.player_sock.recv_msg()
+            else:
+                msg = await asyncio.wait_for(player.player_sock.recv_msg(), deadline - asyncio.get_running_loop().time())
+
+            if player.unacknowledged_timeouts and msg is not None:
+                if msg == sc.TIMEOUT:
+                    player.unacknowledged_timeouts -= 1
+                continue
+            return msg
+
+    def end_turn_on_timeout(self, player, players: list):
+        """Ends the turn of a player who ran out of time and tells every player. Clients before protocol version 3 don't know
+           about timeouts and are disconnected instead"""
+        print(f"P{player.number}'s turn timed out")
+
+        if protocol_versions.get(player.player_sock, 0) < 3:
+            player.player_sock.close()
+            self.on_disconnect(player)
+        else:
+            # The client acknowledges the timeout when it reads it, everything it sends until then is skipped (see recv_reply)
+            player.unacknowledged_timeouts += 1
+            with corked(player.player_sock):
+                send_msg(sc.TIMEOUT, player.player_sock)
+                # The player may have been moved back from an enemy they did not attack in time
+                send_player_view_update(self.map_grid, player)
+
+        self.broadcast_view(player, players)
+        for other_player in players:
+            if other_player != player and not other_player.disconnected and not other_player.is_dead:
+                if protocol_versions.get(other_player.player_sock, 0) >= 3:
+                    send_msg(sc.TIMEOUT, other_player.player_sock)
+
+    async def play_turn(self, player, players: list, turn_deadline):
+        """Processes the moves of one turn of a player. Raises asyncio.TimeoutError when the player does not answer before turn_deadline
+           (event loop time, None for no deadline) or a prompt deadline"""
+        map_grid = self.map_grid
+
+        # Process player's amount of moves
+        moves_left = player.get_moves()
+        while moves_left > 0:
+            print(f"moves left: {moves_left}")
+
+            # ==== Process The Received Move ====
+
+            while True:
+                # Receive move from player
+                player_move = await self.recv_reply(player, turn_deadline)
+
+                if not player_move:
+                    # The player may already have resumed their session on a new connection
+                    if player.player_sock.closed:
+                        self.on_disconnect(player)
+                    return
+
+                # If player requested their inventory
+                if player_move == sc.INVREQUEST:
+                    print("player requested inventory")
+                    send_msg(player.get_inventory(), player.player_sock)
+                    continue
+
+                # If player's player view got out of sync
+                elif player_move == sc.VIEWREQUEST:
+                    print("player requested player view")
+                    player.reset_view()
+                    send_player_view(map_grid, player)
+                    continue
+
+                # If player selected an item in their inventory
+                elif player_move == sc.ITEMREQUEST:
+                    item_index = await self.recv_reply(player, self.get_prompt_deadline(turn_deadline))
+                    if item_index is None:
+                        if player.player_sock.closed:
+                            self.on_disconnect(player)
+                        return
+
+                    item_index = int(item_index)
+                    item = player.get_item(item_index)
+                    # If player wants to remove item
+                    if item.category != "consumables":
+                        with corked(player.player_sock):
+                            send_msg(sc.AYSREQUEST, player.player_sock)
+                            send_msg("remove", player.player_sock)
+                        player_response = await self.recv_reply(player, self.get_prompt_deadline(turn_deadline))
+                        if player_response == True:
+                            player.remove_item(item_index)
+                            new_stats = player.get_stats()
+
+                            # Send new inventory and stats to player
+                            push_inventory(player)
+                            send_stats(new_stats, player.player_sock)
+
+                    # If player wants to use item (item is consumable)
+                    else:
+                        with corked(player.player_sock):
+                            send_msg(sc.AYSREQUEST, player.player_sock)
+                            send_msg("use", player.player_sock)
+                        player_response = await self.recv_reply(player, self.get_prompt_deadline(turn_deadline))
+                        if player_response == True:
+                            player.use_item(item_index)
+                            moves_left += player.extra_moves
+                            new_stats = player.get_stats()
+
+                            # Send new inventory and stats to player
+                            push_inventory(player)
+                            send_stats(new_stats, player.player_sock)
+
+                    continue
+
+                move_status = player.move_in_direction(map_grid, c.KEY_DIRECTIONS[player_move])
+
+                # If received move is valid
+                if move_status == 0:
+                    break
+                # If move is invalid
+                else:
+                    print("Received move is invalid")
+                    send_msg(sc.NEXT, player.player_sock)
+                    continue
+
+            # End player's turn if they disconnected
+            if player.disconnected:
+                break
+
+            # Check if player stepped on entity
+            if map_grid[player.player_y][player.player_x].entity:
+                # If the entity player stepped on is an enemy
+                if map_grid[player.player_y][player.player_x].entity.entity_type == "enemy":
+
+                    # Send the new player view to player and ask them if they are sure of attacking
+                    with corked(player.player_sock):
+                        send_msg(sc.AYSREQUEST, player.player_sock)
+                        send_player_view(map_grid, player)
+                    self.broadcast_view(player, players)
+
+                    try:
+                        player_response = await self.recv_reply(player, self.get_prompt_deadline(turn_deadline))
+                    except asyncio.TimeoutError:
+                        # Not answering in time declines the attack and ends the turn
+                        player.move_back(map_grid)
+                        raise
+                    print(f"Received response: {player_response}")
+                    if player_response == True:
+                        print("Player is sure")
+                        # The fight result, the new player view and the new stats are sent together
+                        with corked(player.player_sock):
+                            fight_result = get_fight_result(player, map_grid[player.player_y][player.player_x].entity)
+                            send_msg(fight_result, player.player_sock)
+
+                            # If fight was successful, add the new item to player's inventory
+                            if fight_result["success"] == True:
+                                map_grid[player.player_y][player.player_x].remove_entity()
+
+                                send_player_view(map_grid, player)
+                                self.broadcast_view(player, players)
+
+                                player.modify_inventory(fight_result["item"])
+                            # If fight was not successful
+                            else:
+                                player.health -= 1
+
+                                if player.health == 0:
+                                    player.is_dead = True
+
+                                    # Remove the dead player from the tile
+                                    map_grid[player.player_y][player.player_x].remove_player(player.number)   
+
+                                    # Send sc.DEAD message
+                                    send_msg(sc.DEAD, player.player_sock)
+                                else:
+                                    player.move_back(map_grid)
+                                    # Send the new player view to player
+                                    send_player_view(map_grid, player)
+
+                                self.broadcast_view(player, players)
+
+                            new_stats = player.get_stats()
+                            push_inventory(player)
+                            send_stats(new_stats, player.player_sock)
+
+                            break # End player's turn
+                    # If player changed their mind
+                    else:
+                        print("Player is not sure")
+                        player.move_back(map_grid)
+                        send_player_view(map_grid, player)
+                        self.broadcast_view(player, players)
+
+                        # Make this move not count
+                        continue
+
+                # If the entity is a healing place
+                elif map_grid[player.player_y][player.player_x].entity.entity_type == "heal":
+                    pass
+
+
+            # ==== Send The Results ====
+
+            with corked(player.player_sock):
+                # Send new player_view to player
+                send_player_view(map_grid, player)
+                # Broadcast the player's moves to other players to update their player_views
+                self.broadcast_view(player, players)
+
+                # Send turn_status to player
+                if moves_left == 1: # If this is was player's last move
+                    send_msg(sc.STOP, player.player_sock)
+                    break
+                else:
+                    send_msg(sc.CONTINUE, player.player_sock)
+                    moves_left -= 1
+                    continue
+
+class Lobby:
+    """Groups incoming connections into matches of max_players players. Every match gets its own map, players and coordinator,
+       all of them share one listening socket and one event loop"""
+
+    def __init__(self, map_size: int, max_players: int, capture_dir=None, worker_index=0):
+        self.map_size = map_size
+        self.max_players = max_players
+        # Directory the traffic of every connection is recorded to (see start_capture), None to not record
+        self.capture_dir = capture_dir
+        # Index of the worker process running the lobby, 0 without a supervisor
+        self.worker_index = worker_index
+        self.connection_count = 0
+
+        # Running matches by their match_id
+        self.matches = {}
+        # Match and player of every session token, see Match.resume_player
+        self.sessions = {}
+        # The match new connections join, started when it is full
+        self.forming_match = None
+        self.next_match_id = 1
+
+    def new_match(self):
+        match = Match(self.next_match_id, self.map_size, self.max_players, self.worker_index)
+        match.start_map_generation()
+        self.next_match_id += 1
+        return match
+
+    def on_connect(self, conn):
+        """Called for every new connection, starts the handshake with the client"""
+        print("NEW CLIENT!")
+        self.connection_count += 1
+        if self.capture_dir is not None:
+            # Workers of the supervisor record to the same directory
+            start_capture(conn, os.path.join(self.capture_dir, f"{os.getpid()}-{self.connection_count}.qcap"))
+        asyncio.get_running_loop().create_task(self.join(conn))
+
+    async def join(self, conn):
+        """Adds a new connection to the forming match after the handshake and starts the match when it is full"""
+        if not await accept_handshake(conn):
+            print("Handshake failed")
+            conn.close()
+            return
+
+        if capabilities[conn] & c.CAP_SPECTATE:
+            await self.add_spectator(conn)
+            return
+
+        if capabilities[conn] & c.CAP_RESUME:
+            await self.resume(conn)
+            return
+
+        while True:
+            if self.forming_match is None:
+                self.forming_match = self.new_match()
+            match = self.forming_match
+            try:
+                await match.wait_for_map()
+            except Exception as e:
+                print(f"Generating the map of match {match.match_id} failed: {e!r}")
+                if match is self.forming_match:
+                    self.forming_match = None
+                conn.close()
+                return
+            # The connections that waited for the map with this one may have filled the match in the meantime
+            if match is self.forming_match:
+                break
+
+        if conn.closed:
+            return
+        player = match.add_player(conn)
+        if player.session_token is not None:
+            self.sessions[player.session_token] = (match, player)
+
+        if match.is_full():
+            print(f"Starting match {match.match_id}")
+            self.forming_match = None
+            self.matches[match.match_id] = match
+            match.start().add_done_callback(lambda task: self.on_match_end(match, task))
+
+    async def resume(self, conn):
+        """Gives a new connection to the player whose session token it sends"""
+        try:
+            msg = await asyncio.wait_for(conn.recv_msg(), c.HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            msg = None
+
+        session = self.sessions.get(msg.token) if isinstance(msg, SessionToken) else None
+        if session is None:
+            print("Unknown session")
+            conn.close()
+            return
+
+        match, player = session
+        if not match.resume_player(player, conn):
+            print(f"P{player.number} of match {match.match_id} can't resume their session anymore")
+            conn.close()
+
+    async def add_spectator(self, conn):
+        """Adds a new connection to the spectators of the match it asks for"""
+        try:
+            request = await asyncio.wait_for(conn.recv_msg(), c.HANDSHAKE_TIMEOUT)
+        except asyncio.TimeoutError:
+            request = None
+
+        if not isinstance(request, SpectateRequest):
+            print("Spectator did not send a spectate request")
+            conn.close()
+            return
+
+        match = self.find_match(request.match_id)
+        if match is None:
+            print(f"No match {request.match_id} to spectate")
+            conn.close()
+            return
+
+        print(f"New spectator of match {match.match_id}")
+        match.spectators.add(conn, request.player_number)
+
+    def find_match(self, match_id: int):
+        """Returns the match with a given match_id or None if there is none. match_id 0 returns the forming match, which is created if needed"""
+        if match_id == 0:
+            if self.forming_match is None:
+                self.forming_match = self.new_match()
+            return self.forming_match
+
+        if self.forming_match and self.forming_match.match_id == match_id:
+            return self.forming_match
+        return self.matches.get(match_id)
+
+    def get_stats(self):
+        """Returns the number of running matches, the number of connected players (including the forming match) and the number of spectators"""
+        players = sum(len(match.players) for match in self.matches.values())
+        spectators = sum(len(match.spectators.spectators) for match in self.matches.values())
+        if self.forming_match:
+            players += len(self.forming_match.players)
+            spectators += len(self.forming_match.spectators.spectators)
+        return {"matches": len(self.matches), "players": players, "spectators": spectators}
+
+    def on_match_end(self, match, task):
+        print(f"Match {match.match_id} ended")
+        del self.matches[match.match_id]
+        for player in match.players:
+            self.sessions.pop(player.session_token, None)
+        match.close()
+
+        if not task.cancelled() and task.exception():
+            print(f"Match {match.match_id} crashed: {task.exception()!r}")
@@ -1,93 +1,938 @@
+import asyncio
+import secrets
+import select
 import socket
-import pickle
+import struct
+import threading
+import time
+import weakref
+import zlib
+import lzma
+import os
+import stat
+from collections import deque
+from contextlib import contextmanager
 
 import config as c
 import status_codes as sc
-from utils import get_player_view
+from tile import get_map_version
+from codec import encode_player_view, encode_player_view_delta, get_view_origin, encode_map_update, MapCache, encode_stats
+from local import LocalServer
+from protocol import PROTOCOL_VERSION, CODES, Capabilities, InventoryPush, Heartbeat, SessionToken, Snapshot, DECODERS, LEGACY_DECODERS, encode_message, decode_message
 
-def send_init_msg(sock):
-    """Sends a 1 byte message containing the LENGTH_PREFIX_SIZE to the connected client specified by sock"""
+# ==== Sending ====
+
+# Most buffers a single sendmsg call accepts (IOV_MAX on Linux)
+SENDMSG_MAX_BUFFERS = 1024
+
+# Message groups waiting to be sent to every corked socket as (latest_only key, buffers) tuples, see corked
+send_queues = weakref.WeakKeyDictionary()
+
+# latest_only key of player view updates, a slow client only needs the newest one
+VIEW_UPDATE = "view_update"
+# latest_only key of heartbeats
+HEARTBEAT = "heartbeat"
+
+# Capture of every socket that records its traffic, see start_capture. A Connection keeps its capture in Connection.capture
+captures = weakref.WeakKeyDictionary()
+
+# Locks of the sockets that are written to by more than one thread (the heartbeat thread of the client), see start_heartbeat
+send_locks = weakref.WeakKeyDictionary()
+
+# ==== Capabilities ====
+
+# Capabilities negotiated with every connection (bitmask of c.CAP_* flags)
+capabilities = weakref.WeakKeyDictionary()
+
+# Protocol version agreed on with every connection, connections without one use version 0 (see protocol.py)
+protocol_versions = weakref.WeakKeyDictionary()
+
+# Compression negotiated with every connection (None, "zlib" or "lzma"), see choose_compression
+compressions = weakref.WeakKeyDictionary()
+
+# Map cache of every connection to a server that sends map updates (client side), see codec.MapCache
+map_caches = weakref.WeakKeyDictionary()
+
+# Last inventory pushed by the server on every connection (client side), see push_inventory
+inventories = weakref.WeakKeyDictionary()
+
+# Session token the server gave every connection (client side), see resume_session
+session_tokens = weakref.WeakKeyDictionary()
+
+COMPRESSORS = {
+    "zlib": zlib.compress,
+    "lzma": lzma.compress
+}
+
+# Decompressor object factories, see decompress
+DECOMPRESSORS = {
+    "zlib": zlib.decompressobj,
+    "lzma": lzma.LZMADecompressor
+}
+
+def decompress(compression: str, data, max_size=c.MAX_DECOMPRESSED_SIZE):
+    """Decompresses data without letting it expand past max_size bytes. Returns None if the data is broken,
+       expands to max_size bytes or more or has data left over after the compressed stream"""
+    decompressor = DECOMPRESSORS[compression]()
     try:
-        data = c.LENGTH_PREFIX_SIZE.to_bytes(1, "big")
-        bytes_sent = sock.send(data)
-    except Exception:
-        return -1
+        decompressed = decompressor.decompress(data, max_size)
+    except (zlib.error, lzma.LZMAError):
+        return None
+    # The stream did not end within max_size bytes of output or something follows it
+    if not decompressor.eof or decompressor.unused_data:
+        return None
+    return decompressed
 
-    return bytes_sent
+def choose_compression(flags: int):
+    """Returns the compression to use based on the capabilities both sides agreed on"""
+    if flags & c.CAP_ZLIB:
+        return "zlib"
+    if flags & c.CAP_LZMA:
+        return "lzma"
+    return None
 
-def send_msg(msg, sock, length_prefix_size=c.LENGTH_PREFIX_SIZE):
-    """Sends the message specified by msg to the socket connection specified by sock. Returns the number of bytes sent on success or -1 on failure """
+def set_nodelay(sock):
+    """Disables Nagle's algorithm on sock. Small frames would otherwise wait for the ACK of the previous ones,
+       messages sent together are combined by corked instead"""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
 
-    # Status messages are strings
-    if type(msg) == str:
-        msg_type = c.MSG_TYPE_STR.to_bytes(1, "big")
-        msg_encoded = msg.encode()
-        try:
-            msg_encoded_size = len(msg_encoded).to_bytes(length_prefix_size, "big")
-        except OverflowError:
-            return -1
-        except Exception:
-            return -1
+def send_buffers(sock, buffers: list, latest_only=None):
+    """Sends a list of bytes objects to sock in one sendmsg call (more only if the socket's send buffer is full).
+       Queues them instead if sock is corked. Returns the number of bytes sent on success or -1 on failure.
+       latest_only is passed to Connection.send_latest, plain sockets send everything"""
+    total = sum(map(len, buffers))
 
-        data = msg_type + msg_encoded_size + msg_encoded
-        try:
-            bytes_sent = sock.send(data)
-        except:
-            return -1
-        
-        return bytes_sent
-    
-    # Used when sending player_view grids to players
-    elif type(msg) == list or type(msg) == dict or type(msg) == tuple:
-        msg_type = c.MSG_TYPE_OBJ.to_bytes(1, "big")
-        pickled_msg = pickle.dumps(msg)
+    queue = send_queues.get(sock)
+    if queue is not None:
+        # Groups without a key are sent as one group
+        if latest_only is None and queue and queue[-1][0] is None:
+            queue[-1][1].extend(buffers)
+        else:
+            queue.append((latest_only, list(buffers)))
+        return total
+
+    if latest_only is not None and hasattr(sock, "send_latest"):
         try:
-            pickled_msg_size = len(pickled_msg).to_bytes(length_prefix_size, "big")
-        except OverflowError:
-            print("OverflowError")
-            return -1
+            return sock.send_latest(buffers, latest_only)
         except Exception:
             return -1
 
-        data = msg_type + pickled_msg_size + pickled_msg
+    lock = send_locks.get(sock)
+    if lock is not None:
+        with lock:
+            return send_all(sock, buffers, total)
+    return send_all(sock, buffers, total)
+
+def send_all(sock, buffers: list, total: int):
+    """Sends all buffers (total bytes) with as few sendmsg calls as possible. Returns the number of bytes sent on success or -1 on failure"""
+    remaining = buffers
+    total_sent = 0
+    try:
+        while True:
+            sent = sock.sendmsg(remaining[:SENDMSG_MAX_BUFFERS])
+            total_sent += sent
+            if total_sent == total:
+                capture = captures.get(sock)
+                if capture is not None:
+                    capture.record(CAPTURE_SENT, buffers)
+                return total
+
+            # Drop the buffers that were sent and cut the one that was sent partially
+            remaining = [memoryview(buf) for buf in remaining]
+            while sent >= len(remaining[0]):
+                sent -= len(remaining[0])
+                remaining.pop(0)
+            remaining[0] = remaining[0][sent:]
+    except Exception:
+        return -1
+
+def send_queue(sock, queue: list, latest_only=None):
+    """Sends the message groups queued for a corked sock. Every group keeps its own latest_only key unless latest_only
+       is given, which is then used for all of them. Returns the number of bytes sent on success or -1 on failure"""
+    if latest_only is None and hasattr(sock, "send_groups") and any(key is not None for key, _ in queue):
         try:
-            bytes_sent = sock.send(data)
+            return sock.send_groups(queue)
         except Exception:
             return -1
-        
+    return send_buffers(sock, [buf for _, buffers in queue for buf in buffers], latest_only)
+
+def flush(sock):
+    """Sends all buffers queued for sock and uncorks it. Returns the number of bytes sent on success or -1 on failure"""
+    queue = send_queues.pop(sock, None)
+    if not queue:
+        return 0
+    return send_queue(sock, queue)
+
+@contextmanager
+def corked(sock, latest_only=None):
+    """Queues every message sent to sock inside the with block and sends them all in one sendmsg call at the end of the block.
+       Used for the messages of one protocol step. Nested blocks are sent at the end of the outermost one.
+       If latest_only is given, the messages replace older ones with the same key that a slow client has not received yet,
+       otherwise messages sent with their own latest_only key inside the block keep it"""
+    if sock in send_queues:
+        yield
+        return
+
+    send_queues[sock] = []
+    try:
+        yield
+    finally:
+        queue = send_queues.pop(sock, None)
+        if queue:
+            send_queue(sock, queue, latest_only)
+
+def make_frame(msg_type: int, data, compression=None, length_prefix_size=c.LENGTH_PREFIX_SIZE):
+    """Returns the buffers (header and data) of one frame. Data of at least COMPRESSION_THRESHOLD bytes is compressed with compression if given.
+       Raises OverflowError if the data does not fit the length prefix"""
+    if compression and len(data) >= c.COMPRESSION_THRESHOLD:
+        compressed = COMPRESSORS[compression](data)
+        if len(compressed) < len(data):
+            data = compressed
+            msg_type |= c.MSG_FLAG_COMPRESSED
+
+    header = msg_type.to_bytes(1, "big") + len(data).to_bytes(length_prefix_size, "big")
+    return [header, data]
+
+def send_frame(msg_type: int, data, sock, length_prefix_size=c.LENGTH_PREFIX_SIZE):
+    """Sends one frame (message type, length prefix and data) without copying the data. Returns the number of bytes sent on success or -1 on failure.
+       The data is compressed if compression was negotiated with sock"""
+    try:
+        buffers = make_frame(msg_type, data, compressions.get(sock), length_prefix_size)
+    except OverflowError:
+        return -1
+
+    return send_buffers(sock, buffers)
+
+def send_player_view(map_grid, player, length_prefix_size=c.LENGTH_PREFIX_SIZE):
+    """Encodes the full player view of a given player straight from the map_grid and sends it to them.
+       Clients with a map cache get a map update instead"""
+    if player.known_tiles is not None:
+        buffers = get_map_update_frame(map_grid, player, True)
+        bytes_sent = send_buffers(player.player_sock, buffers)
+        if bytes_sent == -1:
+            player.reset_view()
         return bytes_sent
 
-    elif type(msg) == bool:
-        msg_type = c.MSG_TYPE_BIT.to_bytes(1, "big")
-        msg_encoded = b"\x01" if msg else b"\x00"
-        msg_encoded_size = len(msg_encoded).to_bytes(length_prefix_size, "big")
+    version = get_map_version()
+    data = encode_player_view(map_grid, player.player_x, player.player_y, version)
+    bytes_sent = send_frame(c.MSG_TYPE_VIEW, data, player.player_sock, length_prefix_size)
 
-        data = msg_type + msg_encoded_size + msg_encoded
-        try:
-            bytes_sent = sock.send(data)
-        except Exception:
-            return -1
+    # Remember which view the player has so the next update can be a delta
+    if bytes_sent == -1:
+        player.view_origin = None
+    else:
+        player.view_origin = get_view_origin(player.player_x, player.player_y)
+        player.view_version = version
+
+    return bytes_sent
+
+def send_player_view_update(map_grid, player, encoded_views=None):
+    """Sends sc.PVUPDATE followed by only the tiles of the player's view that changed since their last view.
+       Sends the full player view instead if the player has no view yet or their view has moved. Sends nothing if nothing changed.
+       encoded_views is shared by all recipients of one broadcast so every distinct view is encoded (and compressed) only once"""
+    if encoded_views is None:
+        encoded_views = {}
+    sock = player.player_sock
 
+    # The update still waiting for a slow client gets replaced by this one, it may have been a delta so a full view is needed
+    if hasattr(sock, "has_pending") and sock.has_pending(VIEW_UPDATE):
+        player.reset_view()
+
+    # Map updates depend on what every single client has in its map cache and can't be shared
+    if player.known_tiles is not None:
+        buffers = get_map_update_frame(map_grid, player, False)
+        if buffers is None:
+            return 0
+        bytes_sent = send_buffers(sock, [get_cached_frame(sock, sc.PVUPDATE)] + buffers, VIEW_UPDATE)
+        if bytes_sent == -1:
+            player.reset_view()
         return bytes_sent
 
+    version = get_map_version()
+    origin = get_view_origin(player.player_x, player.player_y)
+    compression = compressions.get(sock)
+    protocol_version = protocol_versions.get(sock, 0)
+
+    if player.view_origin != origin:
+        key = (origin, None, compression, protocol_version)
+        if key not in encoded_views:
+            data = encode_player_view(map_grid, player.player_x, player.player_y, version)
+            encoded_views[key] = [get_cached_frame(sock, sc.PVUPDATE)] + make_frame(c.MSG_TYPE_VIEW, data, compression)
     else:
+        key = (origin, player.view_version, compression, protocol_version)
+        if key not in encoded_views:
+            data = encode_player_view_delta(map_grid, player.player_x, player.player_y, player.view_version, version)
+            encoded_views[key] = data and [get_cached_frame(sock, sc.PVUPDATE)] + make_frame(c.MSG_TYPE_VIEW_DELTA, data, compression)
+
+    buffers = encoded_views[key]
+    if buffers is None:
+        return 0
+
+    bytes_sent = send_buffers(sock, buffers, VIEW_UPDATE)
+    if bytes_sent == -1:
+        player.view_origin = None
+    else:
+        player.view_origin = origin
+        player.view_version = version
+
+    return bytes_sent
+
+def get_map_update_frame(map_grid, player, force: bool):
+    """Returns the frame of a map update with the tiles of the player's view their map cache is missing or None if nothing changed.
+       force sends the map update even if no tile changed"""
+    origin = get_view_origin(player.player_x, player.player_y)
+    force = force or player.view_origin != origin
+    data = encode_map_update(map_grid, player.player_x, player.player_y, player.known_tiles, get_map_version(), force)
+    if data is None:
+        return None
+
+    player.view_origin = origin
+    return make_frame(c.MSG_TYPE_MAP_UPDATE, data, compressions.get(player.player_sock))
+
+def get_init_data():
+    """Returns the bytes send_init_msg sends: a 1 byte message containing the LENGTH_PREFIX_SIZE
+       followed by the capabilities and the protocol version of the server"""
+    msg_type, data = encode_message(Capabilities(c.SERVER_CAPABILITIES, PROTOCOL_VERSION), 0)
+    return c.LENGTH_PREFIX_SIZE.to_bytes(1, "big") + build_frame(msg_type, data)
+
+def send_init_msg(sock):
+    """Starts the handshake with the connected client specified by sock (see get_init_data),
+       the client answers with the capabilities it wants to use"""
+    return send_buffers(sock, [get_init_data()])
+
+async def accept_handshake(conn):
+    """Performs the server side of the handshake with a new Connection. Returns True on success and False
+       if the client closed the connection or did not answer in time. The supervisor (see supervisor.py) started the handshake
+       of connections it handed over, they only need the answer"""
+    if not conn.handed_over:
+        send_init_msg(conn)
+    try:
+        answer = await asyncio.wait_for(conn.recv_msg(), c.HANDSHAKE_TIMEOUT)
+    except asyncio.TimeoutError:
+        return False
+
+    if not isinstance(answer, Capabilities):
+        return False
+
+    flags = answer.flags & c.SERVER_CAPABILITIES
+    capabilities[conn] = flags
+    compressions[conn] = choose_compression(flags)
+    protocol_versions[conn] = min(answer.version, PROTOCOL_VERSION)
+    return True
+
+# ==== Frame Cache ====
+#
+# Codes (status codes, moves and actions) and bools are sent far more often than anything else,
+# their frames are built once at import for every protocol version
+
+def build_frame(msg_type: int, data: bytes, length_prefix_size=c.LENGTH_PREFIX_SIZE):
+    """Returns a complete frame (message type, length prefix and data) as bytes"""
+    return msg_type.to_bytes(1, "big") + len(data).to_bytes(length_prefix_size, "big") + data
+
+def build_cached_frames(version: int):
+    """Returns the frames of all codes and bools in a given protocol version"""
+    cached_frames = {}
+    for msg in CODES + [True, False]:
+        msg_type, data = encode_message(msg, version)
+        cached_frames[msg] = build_frame(msg_type, data)
+    return cached_frames
+
+CACHED_FRAMES = [build_cached_frames(version) for version in range(PROTOCOL_VERSION + 1)]
+
+def get_cached_frame(sock, msg):
+    """Returns the frame of a code or bool for the protocol version of sock"""
+    return CACHED_FRAMES[protocol_versions.get(sock, 0)][msg]
+
+def send_msg(msg, sock, length_prefix_size=c.LENGTH_PREFIX_SIZE):
+    """Sends the message specified by msg to the socket connection specified by sock. Returns the number of bytes sent on success or -1 on failure.
+       The message is encoded by the first schema for its type in protocol.MESSAGE_SCHEMAS that fits it in the protocol version of sock"""
+    protocol_version = protocol_versions.get(sock, 0)
+
+    # Codes and bools
+    if (type(msg) == str or type(msg) == bool) and length_prefix_size == c.LENGTH_PREFIX_SIZE:
+        frame = CACHED_FRAMES[protocol_version].get(msg)
+        if frame is not None:
+            return send_buffers(sock, [frame])
+
+    message = encode_message(msg, protocol_version)
+    if message is None:
         return -1
 
-def recv_msg(sock, length_prefix_size=c.LENGTH_PREFIX_SIZE):
-    """Receives a message and returns it as either a string or a 2D list, returns -1 on failure"""
-    data_type = int.from_bytes(sock.recv(1), "big")
-    
-    data_len = int.from_bytes(sock.recv(length_prefix_size), "big")
-    data = sock.recv(data_len)
-    
-    if data_type == c.MSG_TYPE_STR:
-        return data.decode()
-    elif data_type == c.MSG_TYPE_OBJ:
-        return pickle.loads(data)
-    elif data_type == c.MSG_TYPE_BIT:
-        return True if data == b"\x01" else False if data == b"\x00" else -1
+    msg_type, data = message
+    return send_frame(msg_type, data, sock, length_prefix_size)
+
+def send_stats(stats: dict, sock):
+    """Sends a stats dictionary (see Player.get_stats) to sock. Skips looking up the schema in send_msg, stats are sent after
+       every change of a player. Returns the number of bytes sent on success or -1 on failure"""
+    data = encode_stats(stats)
+    if data is None:
+        return -1
+    return send_frame(c.MSG_TYPE_STATS, data, sock)
+
+HEARTBEAT_FRAME = build_frame(c.MSG_TYPE_HEARTBEAT, b"")
+
+def start_heartbeat(sock, length_prefix_size=c.LENGTH_PREFIX_SIZE):
+    """Starts a thread sending a heartbeat to sock every HEARTBEAT_INTERVAL seconds, so the server knows the client is alive while it waits
+       for the user. Stops when sock is closed. Returns the thread or None if the server does not know heartbeats"""
+    if protocol_versions.get(sock, 0) < 3:
+        return None
+
+    lock = threading.Lock()
+    send_locks[sock] = lock
+    frame = build_frame(c.MSG_TYPE_HEARTBEAT, b"", length_prefix_size)
+
+    def send_heartbeats():
+        while True:
+            # Bypasses the queue of corked, the heartbeat must not end up between the messages of another thread
+            with lock:
+                if send_all(sock, [frame], len(frame)) == -1:
+                    return
+            time.sleep(c.HEARTBEAT_INTERVAL)
+
+    thread = threading.Thread(target=send_heartbeats, daemon=True)
+    thread.start()
+    return thread
+
+# ==== Receiving ====
+
+class RecvBuffer:
+    """Receive buffer of one connection. Reads as many bytes as the kernel has ready into a reusable bytearray
+       and splits them into frames (message type, length prefix and data)"""
+
+    def __init__(self, length_prefix_size=c.LENGTH_PREFIX_SIZE, size=c.RECV_BUFFER_SIZE):
+        self.length_prefix_size = length_prefix_size
+
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0 # Index of the first byte that was not parsed yet
+        self.end = 0 # Index after the last received byte
+
+        self.closed = False
+        # time.monotonic() when fill last received something
+        self.last_received = time.monotonic()
+        # Capture recording every received byte, see start_capture
+        self.capture = None
+
+    def make_room(self, needed: int):
+        """Makes sure at least needed bytes fit after the unparsed data. Moves the unparsed data to the beginning of the buffer
+           and grows the buffer when the data does not fit even then"""
+        unparsed = self.end - self.start
+        if len(self.buf) - self.end >= needed:
+            return
+
+        if unparsed + needed > len(self.buf):
+            # Grow the buffer, the old one can't be resized while payloads point into it
+            new_buf = bytearray(max(len(self.buf) * 2, unparsed + needed))
+            new_buf[:unparsed] = self.view[self.start:self.end]
+            self.buf = new_buf
+            self.view = memoryview(self.buf)
+        else:
+            self.buf[:unparsed] = self.buf[self.start:self.end]
+
+        self.start = 0
+        self.end = unparsed
+
+    def get_free_space(self):
+        """Returns a writable memoryview of the free space after the received data, received must be called after writing into it"""
+        # Read at least a quarter of the buffer in one call to not waste syscalls on tiny reads
+        self.make_room(max(len(self.buf) // 4, 1))
+        return self.view[self.end:]
+
+    def received(self, nbytes: int):
+        """Marks nbytes written into the memoryview returned by get_free_space as received"""
+        if self.capture is not None:
+            self.capture.record(CAPTURE_RECEIVED, [self.view[self.end:self.end + nbytes]])
+        self.end += nbytes
+
+    def feed(self, data):
+        """Appends bytes that did not come from a socket"""
+        self.make_room(len(data))
+        self.view[self.end:self.end + len(data)] = data
+        self.received(len(data))
+
+    def fill(self, sock):
+        """Receives as many bytes as are available (at least 1) from sock. Returns the number of bytes received, 0 when the connection was closed"""
+        try:
+            received = sock.recv_into(self.get_free_space())
+        except OSError:
+            received = 0
+
+        if received == 0:
+            self.closed = True
+        else:
+            self.last_received = time.monotonic()
+        self.received(received)
+        return received
+
+    def read(self, size: int):
+        """Returns the next size bytes of unparsed data without a frame header or None if they were not received yet"""
+        if self.end - self.start < size:
+            return None
+        data = self.view[self.start:self.start + size]
+        self.start += size
+        return data
+
+    def next_frame(self):
+        """Returns the next complete frame as a tuple of the message type and the data or None if it was not fully received yet.
+           The data is a memoryview into the buffer which stays valid only until the next fill.
+           Returns -1 if the frame has more than MAX_FRAME_SIZE bytes of data, the connection must be closed then"""
+        header_size = 1 + self.length_prefix_size
+        if self.end - self.start < header_size:
+            return None
+
+        data_len = int.from_bytes(self.view[self.start + 1:self.start + header_size], "big")
+        # The buffer would grow to whatever size the header claims
+        if data_len > c.MAX_FRAME_SIZE:
+            return -1
+        if self.end - self.start < header_size + data_len:
+            # Make sure the rest of the frame will fit
+            self.make_room(header_size + data_len - (self.end - self.start))
+            return None
+
+        data_type = self.buf[self.start]
+        data_start = self.start + header_size
+        self.start = data_start + data_len
+        return data_type, self.view[data_start:self.start]
+
+    def recv_exact(self, sock, size: int):
+        """Receives exactly size bytes that are not part of a frame. Returns None when the connection was closed"""
+        while True:
+            data = self.read(size)
+            if data is not None:
+                return data
+            self.make_room(size)
+            if self.fill(sock) == 0:
+                return None
+
+    def recv_frame(self, sock, block=True):
+        """Receives the next frame from sock (see next_frame). Returns None when the connection was closed
+           and -1 if the frame is too large. If block is False, returns NOT_RECEIVED instead of waiting for the rest of the frame"""
+        while True:
+            frame = self.next_frame()
+            if frame is not None:
+                return frame
+            if not block and not select.select([sock], [], [], 0)[0]:
+                return NOT_RECEIVED
+            if self.fill(sock) == 0:
+                return None
+
+# Returned by recv_frame and recv_msg instead of waiting when they are not allowed to block
+NOT_RECEIVED = object()
+
+# Receive buffer of every socket, removed automatically when the socket is garbage collected
+recv_buffers = weakref.WeakKeyDictionary()
+
+def get_recv_buffer(sock, length_prefix_size=c.LENGTH_PREFIX_SIZE):
+    """Returns the receive buffer of sock, creates it on first use"""
+    buffer = recv_buffers.get(sock)
+    if buffer is None:
+        buffer = RecvBuffer(length_prefix_size)
+        recv_buffers[sock] = buffer
+    buffer.length_prefix_size = length_prefix_size
+    return buffer
+
+def recv_init_msg(sock, wanted_capabilities=c.CLIENT_CAPABILITIES):
+    """Performs the client side of the handshake started by send_init_msg. Answers with the offered capabilities that are also
+       in wanted_capabilities and returns the LENGTH_PREFIX_SIZE, returns -1 on failure"""
+    data = get_recv_buffer(sock).recv_exact(sock, 1)
+    if data is None:
+        return -1
+    length_prefix_size = data[0]
+
+    offer = recv_msg(sock, length_prefix_size)
+    if not isinstance(offer, Capabilities):
+        return -1
+
+    flags = offer.flags & wanted_capabilities
+    protocol_version = min(offer.version, PROTOCOL_VERSION)
+    send_msg(Capabilities(flags, protocol_version), sock, length_prefix_size)
+    capabilities[sock] = flags
+    protocol_versions[sock] = protocol_version
+    compressions[sock] = choose_compression(flags)
+    if flags & c.CAP_MAP_CACHE:
+        map_caches[sock] = MapCache()
+
+    return length_prefix_size
+
+def decode_msg(data_type: int, data, compression=None, map_cache=None, decoders=DECODERS):
+    """Decodes the data of a received frame based on its message type, returns -1 on failure.
+       Map updates are applied to map_cache and decoded to the new player view. decoders are passed to protocol.decode_message"""
+    if data_type & c.MSG_FLAG_COMPRESSED:
+        if compression not in DECOMPRESSORS:
+            return -1
+        data = decompress(compression, data)
+        if data is None:
+            return -1
+        data_type &= ~c.MSG_FLAG_COMPRESSED
+
+    if data_type == c.MSG_TYPE_MAP_UPDATE:
+        return map_cache.apply_update(data) if map_cache is not None else -1
+
+    return decode_message(data_type, data, decoders)
+
+def recv_msg(sock, length_prefix_size=c.LENGTH_PREFIX_SIZE, block=True):
+    """Receives a message and returns it as either a string or a 2D list, returns -1 on failure and None when the connection was closed.
+       sock is closed after a frame larger than MAX_FRAME_SIZE. Pushed inventories and session tokens are kept for sock and not returned,
+       heartbeats are skipped. If block is False, returns NOT_RECEIVED when no whole message was received yet"""
+    # Whatever is still queued for sock must be sent first, the other side may be waiting for it before answering
+    flush(sock)
+
+    while True:
+        frame = get_recv_buffer(sock, length_prefix_size).recv_frame(sock, block)
+        if frame is None or frame is NOT_RECEIVED:
+            return frame
+        if frame == -1:
+            sock.close()
+            return None
+
+        data_type, data = frame
+        # Only servers before protocol version 1 send pickled objects
+        decoders = DECODERS if protocol_versions.get(sock, 0) >= 1 else LEGACY_DECODERS
+        msg = decode_msg(data_type, data, compressions.get(sock), map_caches.get(sock), decoders)
+        if type(msg) == InventoryPush:
+            inventories[sock] = msg.inventory
+            continue
+        if type(msg) == SessionToken:
+            session_tokens[sock] = msg.token
+            continue
+        if type(msg) == Heartbeat:
+            continue
+        return msg
+
+# ==== Traffic Capture ====
+#
+# A capture file records every frame of one connection as it went over the wire. It starts with CAPTURE_HEADER
+# (magic, format version and whether it was recorded by the server), followed by one CAPTURE_RECORD per frame:
+# the direction, microseconds since the previous record, the message type and the length of the data, then the data.
+# The LENGTH_PREFIX_SIZE sent before the handshake is recorded as a CAPTURE_INIT record. See capture.py for the replayer.
+
+CAPTURE_MAGIC = b"QCAP"
+CAPTURE_FORMAT_VERSION = 1
+CAPTURE_HEADER = struct.Struct(">4sBB")
+CAPTURE_RECORD = struct.Struct(">BIBI")
+
+CAPTURE_RECEIVED = 0
+CAPTURE_SENT = 1
+# Message type of the record holding the LENGTH_PREFIX_SIZE
+CAPTURE_INIT = 0xFF
+
+class Capture:
+    """Writes the frames sent and received on one connection to a capture file. The bytes of every direction are split
+       into frames by a RecvBuffer of their own, so it does not matter how they were split into sendmsg and recv calls"""
+
+    def __init__(self, path: str, is_server: bool):
+        self.file = open(path, "wb")
+        self.file.write(CAPTURE_HEADER.pack(CAPTURE_MAGIC, CAPTURE_FORMAT_VERSION, is_server))
+        # The heartbeat thread of the client sends while the main thread receives
+        self.lock = threading.Lock()
+        self.last_time = time.perf_counter()
+
+        self.streams = {CAPTURE_RECEIVED: RecvBuffer(), CAPTURE_SENT: RecvBuffer()}
+        # The server sends the LENGTH_PREFIX_SIZE before the first frame
+        self.init_direction = CAPTURE_SENT if is_server else CAPTURE_RECEIVED
+        self.length_prefix_size = None
+
+    def record(self, direction: int, buffers: list):
+        with self.lock:
+            if self.file.closed:
+                return
+            stream = self.streams[direction]
+            for buf in buffers:
+                stream.feed(buf)
+
+            if self.length_prefix_size is None:
+                if direction != self.init_direction:
+                    return
+                data = stream.read(1)
+                if data is None:
+                    return
+                self.length_prefix_size = data[0]
+                for other_stream in self.streams.values():
+                    other_stream.length_prefix_size = self.length_prefix_size
+                self.write_record(direction, CAPTURE_INIT, bytes(data))
+
+            while True:
+                frame = stream.next_frame()
+                # The connection is closed after a frame that is too large
+                if frame is None or frame == -1:
+                    break
+                self.write_record(direction, *frame)
+
+    def write_record(self, direction: int, msg_type: int, data):
+        now = time.perf_counter()
+        delay = min(int((now - self.last_time) * 1e6), 0xFFFFFFFF)
+        self.last_time = now
+        self.file.write(CAPTURE_RECORD.pack(direction, delay, msg_type, len(data)))
+        self.file.write(data)
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+def start_capture(sock, path: str):
+    """Records every frame sent and received on sock (a socket or a Connection) to a capture file at path.
+       Must be called before the handshake. Returns the Capture on success or -1 on failure"""
+    try:
+        capture = Capture(path, isinstance(sock, Connection))
+    except OSError as e:
+        print(f"Can't open capture file {path}: {e}")
+        return -1
+
+    if isinstance(sock, Connection):
+        sock.capture = capture
+        sock.recv_buffer.capture = capture
     else:
+        captures[sock] = capture
+        get_recv_buffer(sock).capture = capture
+        weakref.finalize(sock, capture.close)
+    return capture
+
+def read_capture(path: str):
+    """Reads a capture file, returns whether it was recorded by the server and its records as (direction, seconds since the
+       start of the capture, message type, data) tuples. Returns -1 if the file is not a capture file"""
+    with open(path, "rb") as f:
+        data = f.read()
+
+    if len(data) < CAPTURE_HEADER.size:
         return -1
+    magic, version, is_server = CAPTURE_HEADER.unpack_from(data, 0)
+    if magic != CAPTURE_MAGIC or version != CAPTURE_FORMAT_VERSION:
+        return -1
+
+    records = []
+    timestamp = 0
+    offset = CAPTURE_HEADER.size
+    # A capture cut off by a crash ends with an incomplete record
+    while offset + CAPTURE_RECORD.size <= len(data):
+        direction, delay, msg_type, data_len = CAPTURE_RECORD.unpack_from(data, offset)
+        offset += CAPTURE_RECORD.size
+        if offset + data_len > len(data):
+            break
+        timestamp += delay / 1e6
+        records.append((direction, timestamp, msg_type, data[offset:offset + data_len]))
+        offset += data_len
+    return bool(is_server), records
+
+class Connection(asyncio.BufferedProtocol):
+    """Server side of one client connection in the asyncio runtime. Received bytes go straight into a RecvBuffer
+       and every complete frame is decoded into a queue of messages. Sending works like with a socket (see sendmsg),
+       so send_msg, corked and the broadcast functions can be used with a Connection.
+
+       Writes never block. When the client does not keep up (the transport's write buffer is above WRITE_BUFFER_HIGH_WATER)
+       messages wait in a bounded outbox, and the client is disconnected if it stays backed up for too long.
+       Clients that know heartbeats get one every HEARTBEAT_INTERVAL seconds and are disconnected when they don't send anything
+       for HEARTBEAT_TIMEOUT seconds.
+
+       received holds the bytes the supervisor already received from the client if it handed the connection over,
+       they are parsed like the bytes received afterwards"""
+
+    def __init__(self, on_connect=None, received=None):
+        # Called with the connection once it is established
+        self.on_connect = on_connect
+        self.received = received
+        self.handed_over = received is not None
+
+        self.transport = None
+        self.peername = None
+        self.recv_buffer = RecvBuffer()
+        self.messages = asyncio.Queue()
+        self.closed = False
+
+        # Groups of buffers waiting for the client to catch up as [latest_only key, buffers, size] lists
+        #   latest_entries maps every latest_only key to its entry in the outbox, replaced entries get None as their buffers
+        self.outbox = deque()
+        self.outbox_size = 0
+        self.latest_entries = {}
+        self.dropped_entries = 0
+        self.write_paused = False
+        self.slow_client_timer = None
+
+        # Event loop time of the last received bytes
+        self.last_received = None
+        self.heartbeat_timer = None
+
+        # Capture recording every written frame, see start_capture
+        self.capture = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peername = transport.get_extra_info("peername")
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            set_nodelay(sock)
+        transport.set_write_buffer_limits(high=c.WRITE_BUFFER_HIGH_WATER)
+
+        loop = asyncio.get_running_loop()
+        self.last_received = loop.time()
+        self.heartbeat_timer = loop.call_later(c.HEARTBEAT_INTERVAL, self.heartbeat)
+
+        if self.on_connect:
+            self.on_connect(self)
+
+        if self.received:
+            # The supervisor sent the start of the handshake
+            if self.capture:
+                self.capture.record(CAPTURE_SENT, [get_init_data()])
+            self.recv_buffer.feed(self.received)
+            self.received = None
+            self.parse_frames()
+
+    def get_buffer(self, sizehint):
+        return self.recv_buffer.get_free_space()
+
+    def buffer_updated(self, nbytes):
+        self.recv_buffer.received(nbytes)
+        self.last_received = asyncio.get_running_loop().time()
+        self.parse_frames()
+
+    def parse_frames(self):
+        """Decodes every complete frame in the receive buffer into the queue of messages"""
+        while True:
+            frame = self.recv_buffer.next_frame()
+            if frame is None:
+                break
+            if frame == -1:
+                self.drop_client("frame too large")
+                return
+            data_type, data = frame
+            if data_type & ~c.MSG_FLAG_COMPRESSED == c.MSG_TYPE_OBJ:
+                # Unpickling would run whatever code the client put into the data
+                self.drop_client("pickled object")
+                return
+            msg = decode_msg(data_type, data, compressions.get(self))
+            if data_type & c.MSG_FLAG_COMPRESSED and type(msg) == int and msg == -1:
+                # Broken compressed data or data expanding past MAX_DECOMPRESSED_SIZE (a decompression bomb)
+                self.drop_client("bad compressed frame")
+                return
+            if type(msg) != Heartbeat:
+                self.messages.put_nowait(msg)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        if self.slow_client_timer:
+            self.slow_client_timer.cancel()
+        if self.heartbeat_timer:
+            self.heartbeat_timer.cancel()
+        self.outbox.clear()
+        self.outbox_size = 0
+        self.latest_entries.clear()
+        self.dropped_entries = 0
+        if self.capture:
+            self.capture.close()
+        # Wakes up whoever is waiting for a message
+        self.messages.put_nowait(None)
+
+    def pause_writing(self):
+        """Called by the transport when the client is not keeping up, messages go to the outbox until resume_writing"""
+        self.write_paused = True
+        if c.SLOW_CLIENT_TIMEOUT is not None:
+            self.slow_client_timer = asyncio.get_running_loop().call_later(c.SLOW_CLIENT_TIMEOUT, self.drop_client, "too slow")
+
+    def resume_writing(self):
+        """Called by the transport when the client caught up, sends the outbox"""
+        self.write_paused = False
+        if self.slow_client_timer:
+            self.slow_client_timer.cancel()
+            self.slow_client_timer = None
+
+        # Writing may pause the transport again
+        while self.outbox and not self.write_paused:
+            latest_only, buffers, size = self.outbox.popleft()
+            if buffers is None:
+                self.dropped_entries -= 1
+                continue
+            if latest_only is not None:
+                del self.latest_entries[latest_only]
+            self.outbox_size -= size
+            self.write(buffers)
+
+    def drop_client(self, reason: str):
+        print(f"Disconnecting client {self.peername} ({reason})")
+        self.transport.abort()
+
+    def heartbeat(self):
+        """Sends a heartbeat to the client and disconnects it if it has been silent for too long, repeats every HEARTBEAT_INTERVAL seconds"""
+        if self.closed:
+            return
+
+        if protocol_versions.get(self, 0) >= 3:
+            if asyncio.get_running_loop().time() - self.last_received > c.HEARTBEAT_TIMEOUT:
+                self.drop_client("no heartbeat")
+                return
+            send_buffers(self, [HEARTBEAT_FRAME], HEARTBEAT)
+
+        self.heartbeat_timer = asyncio.get_running_loop().call_later(c.HEARTBEAT_INTERVAL, self.heartbeat)
+
+    def has_pending(self, latest_only):
+        """Returns True if a message group sent with the given latest_only key is still waiting in the outbox"""
+        return latest_only in self.latest_entries
+
+    def send_latest(self, buffers, latest_only=None):
+        """Writes buffers to the transport without blocking or puts them into the outbox if the client is backed up.
+           An older group with the same latest_only key still in the outbox is dropped. Returns the number of bytes"""
+        if self.closed or self.transport.is_closing():
+            raise ConnectionError("connection is closed")
+
+        size = sum(len(buf) for buf in buffers)
+        if not self.write_paused and not self.outbox:
+            self.write(buffers)
+            return size
+
+        entry = [latest_only, buffers, size]
+        if latest_only is not None:
+            old_entry = self.latest_entries.get(latest_only)
+            if old_entry:
+                self.outbox_size -= old_entry[2]
+                old_entry[1] = None
+                self.dropped_entries += 1
+            self.latest_entries[latest_only] = entry
+
+            # Remove the replaced entries once they make up most of the outbox
+            if self.dropped_entries > len(self.outbox) // 2:
+                self.outbox = deque(entry for entry in self.outbox if entry[1] is not None)
+                self.dropped_entries = 0
+
+        self.outbox.append(entry)
+        self.outbox_size += size
+        if self.outbox_size > c.OUTBOX_LIMIT:
+            self.drop_client("outbox full")
+            raise ConnectionError("client is too slow")
+
+        return size
+
+    def send_groups(self, groups: list):
+        """Sends message groups queued by corked as (latest_only key, buffers) tuples. They are written together if the client
+           keeps up, otherwise every group goes into the outbox with its own key (see send_latest). Returns the number of bytes"""
+        if not self.write_paused and not self.outbox:
+            return self.send_latest([buf for _, buffers in groups for buf in buffers])
+        return sum(self.send_latest(buffers, latest_only) for latest_only, buffers in groups)
+
+    def write(self, buffers):
+        self.transport.writelines(buffers)
+        if self.capture:
+            self.capture.record(CAPTURE_SENT, buffers)
+
+    def sendmsg(self, buffers):
+        """Socket-like write used by send_buffers, see send_latest"""
+        return self.send_latest(buffers)
+
+    async def recv_msg(self):
+        """Waits for the next message (see recv_msg), returns None when the connection was closed"""
+        # Whatever is still queued for this connection must be sent first, the client may be waiting for it before answering
+        flush(self)
+
+        if self.closed and self.messages.empty():
+            return None
+        return await self.messages.get()
+
+    def close(self):
+        if self.transport:
+            self.transport.close()
+
+# ==== Game ====
 
 def broadcast_turn_taker(players: list, sender):
     """Used to broadcast which player's turn it is"""
@@ -96,50 +941,146 @@ def broadcast_turn_taker(players: list, sender):
         if player != sender:
             if player.disconnected or player.is_dead:
                 continue
-            bytes_sent = send_msg(sc.PLAYERS[sender.number], player.player_sock)
+            send_msg(sc.PLAYERS[sender.number], player.player_sock)
         
-def broadcast_player_view(map_grid, players: list, sender):
-    """Called everytime any player makes a move. Recalculates each player's player_view and sends it to them."""
+def broadcast_player_view(map_grid, players: list, sender, viewports=None):
+    """Called everytime any player makes a move. Sends each player the tiles of their player_view that changed.
+       Players with the same view get the same encoded bytes. If viewports (an interest.ViewportIndex of the players) is given,
+       only players who can see the tiles changed by the sender are updated. Returns the area of the changed tiles (see Player.get_changed_area)"""
     print("Broadcasting player_view...")
+    changed_area = sender.get_changed_area()
+    if viewports is not None:
+        viewports.update(sender)
+        players = viewports.get_players(changed_area)
+
+    encoded_views = {}
     for player in players:
-        player_view = get_player_view(map_grid, player.player_x, player.player_y, player.number)
         if player != sender:
-            if player.disconnected or player.is_dead:
+            if player.disconnected or player.is_dead or getattr(player.player_sock, "closed", False):
                 continue
-            bytes_sent = send_msg(sc.PVUPDATE, player.player_sock)
-            bytes_sent = send_msg(player_view, player.player_sock)
+            send_player_view_update(map_grid, player, encoded_views)
+
+    return changed_area
 
+def push_inventory(player):
+    """Sends the player their inventory if it changed since it was last sent. Returns the number of bytes sent, 0 if nothing was sent
+       and -1 on failure. Clients before protocol version 2 request their inventory instead"""
+    if not player.inventory_changed or protocol_versions.get(player.player_sock, 0) < 2:
+        return 0
+
+    bytes_sent = send_msg(InventoryPush(player.get_inventory()), player.player_sock)
+    if bytes_sent != -1:
+        player.inventory_changed = False
+    return bytes_sent
 
 def get_inventory(sock, length_prefix_size=c.LENGTH_PREFIX_SIZE):
-    """Called by client to request their current inventory contents"""
+    """Called by client to get their current inventory contents. Returns the inventory last pushed by the server
+       or requests it if the server does not push it"""
+    if sock in inventories:
+        return inventories[sock]
+
     send_msg(sc.INVREQUEST, sock, length_prefix_size)
     my_inventory = recv_msg(sock, length_prefix_size)
     return my_inventory
     
-def create_socket(addr, port):
-    """Creates a socket, binds it to a given address and port and sets it to listen and then returns the created socket. Returns -1 on error."""
+def remove_stale_socket(path: str):
+    """Removes the Unix domain socket file left at path by a server that did not exit cleanly"""
+    try:
+        if stat.S_ISSOCK(os.stat(path).st_mode):
+            os.remove(path)
+    except OSError:
+        pass
+
+def create_socket(addr, port, backlog=5):
+    """Creates a socket, binds it to a given address and port and sets it to listen and then returns the created socket. Returns -1 on error.
+       If port is None, addr is the path of a Unix domain socket"""
     try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind((addr, port))
-        sock.listen(5)
+        if port is None:
+            remove_stale_socket(addr)
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.bind(addr)
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((addr, port))
+        sock.listen(backlog)
     except Exception as e:
         print(e)
         return -1
 
     return sock
 
-def handle_new_player_connection(map_grid, player, length_prefix_size=c.LENGTH_PREFIX_SIZE):
-    """Sends important information to newly connected player. Returns 0 on success and -1 on failure"""
+def connect_socket(addr, port=None, socket_class=socket.socket):
+    """Connects to a server and returns the connected socket, raises OSError on failure. addr is the server's host with port,
+       the path of a Unix domain socket without port, or a LocalServer running in this process (see local.py)"""
+    if isinstance(addr, LocalServer):
+        return addr.connect()
+
+    if port is None:
+        sock = socket_class(socket.AF_UNIX, socket.SOCK_STREAM)
+        address = addr
+    else:
+        sock = socket_class(socket.AF_INET, socket.SOCK_STREAM)
+        address = (addr, port)
+    try:
+        sock.connect(address)
+    except OSError:
+        sock.close()
+        raise
+    set_nodelay(sock)
+    return sock
+
+def handle_new_player_connection(map_grid, player, length_prefix_size=c.LENGTH_PREFIX_SIZE, worker_index=0):
+    """Sends important information to newly connected player. Returns 0 on success and -1 on failure.
+       worker_index is the index of the worker process hosting the match, the supervisor routes resumed sessions by it"""
     # Append the player to the players present on the center tile
-    map_grid[player.player_y][player.player_x].players_present.append(player.number)
+    map_grid[player.player_y][player.player_x].add_player(player.number)
 
-    # Send the length_prefix_size
-    bytes_sent = send_init_msg(player.player_sock)
-    # Send the new player's number
-    bytes_sent = send_msg(str(player.number), player.player_sock, length_prefix_size)
-    # Calculate and send the new player's view
-    player_view = get_player_view(map_grid, player.player_x, player.player_y, player.number)
-    send_msg(player_view, player.player_sock)
+    # The length_prefix_size was sent by send_init_msg during the handshake
+    with corked(player.player_sock):
+        # Send the new player's number
+        send_msg(str(player.number), player.player_sock, length_prefix_size)
+        # Calculate and send the new player's view
+        send_player_view(map_grid, player, length_prefix_size)
+        # Send the new player's (empty) inventory
+        push_inventory(player)
+        # Send the token the player needs to resume their session after losing their connection
+        if protocol_versions.get(player.player_sock, 0) >= 5:
+            player.session_token = bytes([worker_index]) + secrets.token_bytes(c.SESSION_TOKEN_SIZE - 1)
+            send_msg(SessionToken(player.session_token), player.player_sock)
 
     return 0
+
+def send_snapshot(map_grid, player, turn_taker_number: int):
+    """Sends a resumed player their number, whose turn it is, their stats, inventory and player view in one message.
+       Returns the number of bytes sent on success or -1 on failure"""
+    version = get_map_version()
+    view = encode_player_view(map_grid, player.player_x, player.player_y, version)
+    snapshot = Snapshot(player.number, turn_taker_number, player.get_stats(), player.get_inventory(), view)
+    bytes_sent = send_msg(snapshot, player.player_sock)
+    if bytes_sent == -1:
+        return -1
+
+    player.inventory_changed = False
+    # Clients with a map cache get all tiles of their next player view, the others get a delta against this one
+    if player.known_tiles is None:
+        player.view_origin = get_view_origin(player.player_x, player.player_y)
+        player.view_version = version
+    return bytes_sent
+
+def resume_session(sock, token: bytes, wanted_capabilities=c.CLIENT_CAPABILITIES):
+    """Performs the handshake on a new connection to the server and resumes the session of a given token.
+       Returns the LENGTH_PREFIX_SIZE and the Snapshot of the match, returns -1 on failure"""
+    length_prefix_size = recv_init_msg(sock, wanted_capabilities | c.CAP_RESUME)
+    if length_prefix_size == -1 or not capabilities[sock] & c.CAP_RESUME:
+        return -1
+
+    if send_msg(SessionToken(token), sock, length_prefix_size) == -1:
+        return -1
+    snapshot = recv_msg(sock, length_prefix_size)
+    if not isinstance(snapshot, Snapshot):
+        return -1
+
+    session_tokens[sock] = token
+    inventories[sock] = snapshot.inventory
+    return length_prefix_size, snapshot
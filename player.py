@@ -21,12 +21,30 @@ class Player:
 
         self.is_dead = False
         self.disconnected = False
+        # Event loop time the lost connection was noticed, the player can resume their session until RESUME_GRACE seconds later
+        self.disconnected_at = None
+        # Token to resume the session with (see Match.resume_player), None if the client can't resume
+        self.session_token = None
+        # Turn timeouts the client has not acknowledged yet (see Match.recv_reply)
+        self.unacknowledged_timeouts = 0
+
+        # Position and map version of the last player view sent to the player, used to send only the changes afterwards
+        #   view_origin is None until the player has received a full player view
+        self.view_origin = None
+        self.view_version = 0
+        # Versions of the tiles in the client's map cache by their (x, y) coordinates, None if the client has no map cache (see codec.encode_map_update)
+        self.known_tiles = None
+
+        # Position of the player at the last broadcast of their moves, the tiles between it and the current position are the ones that changed
+        self.broadcast_x, self.broadcast_y = center_coordinates
 
         self.inventory = {
             "weapons": [None, None], # For weapons, increases power by fixed amount
             "consumables": [None, None, None], # One use items, e.g. potions, scrolls, etc.
             "gear": [None, None] # Keys (to open chests), shoes (to increase moves amount)
         }
+        # Set when the inventory changed since it was last pushed to the client (see push_inventory)
+        self.inventory_changed = True
 
     def remove_extras(self):
         self.extra_power = 0
@@ -54,7 +72,7 @@ class Player:
         new_x = current_tile.coordinate_x + dx
 
         # Remove player from current tile
-        map_grid[self.player_y][self.player_x].players_present.remove(self.number)
+        map_grid[self.player_y][self.player_x].remove_player(self.number)
 
         self.last_direction = direction
 
@@ -62,10 +80,28 @@ class Player:
         self.player_y = new_y
 
         # Add player to new tile
-        map_grid[self.player_y][self.player_x].players_present.append(self.number)
+        map_grid[self.player_y][self.player_x].add_player(self.number)
         
         return 0
 
+    def reset_view(self):
+        """Forgets what the client was sent so far, the next player view sent to the player is a full one"""
+        self.view_origin = None
+        if self.known_tiles is not None:
+            self.known_tiles.clear()
+
+    def get_changed_area(self):
+        """Returns the area (first x, first y, last x, last y) of the tiles the player changed since the last broadcast of their moves
+           and starts a new one"""
+        area = (
+            min(self.broadcast_x, self.player_x),
+            min(self.broadcast_y, self.player_y),
+            max(self.broadcast_x, self.player_x),
+            max(self.broadcast_y, self.player_y)
+        )
+        self.broadcast_x, self.broadcast_y = self.player_x, self.player_y
+        return area
+
     def move_back(self, map_grid: list):
         """Moves player back to previous tile"""
         direction = get_direction_opposite(self.last_direction)
@@ -90,6 +126,7 @@ class Player:
         for index, item in enumerate(self.inventory[new_item.category]):
             if not item:
                 self.inventory[new_item.category][index] = new_item
+                self.inventory_changed = True
                 return 1
         return -1
 
@@ -102,6 +139,7 @@ class Player:
             k = key
             break
         self.inventory[k][item_index] = None
+        self.inventory_changed = True
                         
 
     def get_extra_power(self):
@@ -0,0 +1,320 @@
+import struct
+import pickle
+
+import config as c
+import status_codes as sc
+from tile import Tile
+from items import ITEM_CODES, create_item
+from codec import STATS, encode_view, decode_view, decode_view_delta, decode_map_delta, is_player_stats, encode_stats, decode_stats
+
+# ==== Protocol ====
+#
+# Every frame starts with the message type ID of its message, MESSAGE_SCHEMAS lists how every kind of message is encoded.
+# The client and the server agree on a protocol version during the handshake and only send messages both of them know,
+# so the encoding of a message can change without breaking older clients.
+#   version 0 - strings, pickled objects, bools, player views, view deltas, stats and map updates
+#   version 1 - status codes, moves and actions as a single code ID byte, inventories and fight results with fixed layouts,
+#               no more pickled objects
+#   version 2 - the server pushes the inventory whenever it changes, the client doesn't need to request it
+#   version 3 - turn timeouts (sc.TIMEOUT) and heartbeats
+#   version 4 - spectators (c.CAP_SPECTATE and spectate requests)
+#   version 5 - session tokens, resuming a session after a lost connection (c.CAP_RESUME) and snapshots
+#   version 6 - spectators of the whole map get it once and then only the tiles that changed (map deltas)
+
+PROTOCOL_VERSION = 6
+
+class Capabilities:
+    """Message of the connection handshake. The server offers its capabilities (bitmask of c.CAP_* flags) and protocol version,
+       the client answers with the capabilities it wants to use and the protocol version both of them know"""
+    def __init__(self, flags: int, version=0):
+        self.flags = flags
+        self.version = version
+
+def encode_capabilities(capabilities: Capabilities):
+    return bytes([capabilities.flags, capabilities.version])
+
+def decode_capabilities(data):
+    # Clients before protocol version 1 only send the flags
+    return Capabilities(data[0], data[1] if len(data) > 1 else 0)
+
+# ==== Codes ====
+
+# Every string with a fixed meaning the client and the server send each other. Codes are sent as their index in this list,
+# new codes must only be appended
+CODES = [
+    sc.PVUPDATE,
+    sc.PLAYERS[1],
+    sc.PLAYERS[2],
+    sc.PLAYERS[3],
+    sc.PLAYERS[4],
+    sc.DEAD,
+    sc.WIN,
+    sc.NEXT,
+    sc.START,
+    sc.CONTINUE,
+    sc.STOP,
+    sc.INVREQUEST,
+    sc.ITEMREQUEST,
+    sc.STATREQUEST,
+    sc.VIEWREQUEST,
+    sc.AYSREQUEST,
+    # Moves
+    "KEY_LEFT",
+    "KEY_UP",
+    "KEY_RIGHT",
+    "KEY_DOWN",
+    # Actions the server asks the client to confirm after sc.AYSREQUEST
+    "remove",
+    "use",
+    sc.TIMEOUT
+]
+
+CODE_IDS = {code: code_id for code_id, code in enumerate(CODES)}
+
+def is_code(msg):
+    return type(msg) == str and msg in CODE_IDS
+
+def encode_code(code: str):
+    return bytes([CODE_IDS[code]])
+
+def decode_code(data):
+    if data[0] >= len(CODES):
+        return -1
+    return CODES[data[0]]
+
+# ==== Bools ====
+
+def encode_bool(msg: bool):
+    return b"\x01" if msg else b"\x00"
+
+def decode_bool(data):
+    return True if data == b"\x01" else False if data == b"\x00" else -1
+
+# ==== Player Views ====
+
+def is_player_view(msg):
+    """Returns True if msg is a 2D grid of tiles (a player view)"""
+    return type(msg) == list and len(msg) > 0 and type(msg[0]) == list and len(msg[0]) > 0 and isinstance(msg[0][0], Tile)
+
+# ==== Inventories ====
+#
+# An inventory is sent as one byte per slot in the order of INVENTORY_SLOTS, 0 for empty slots.
+# The byte of an item is its item code (low 4 bits) and its tier (high 4 bits).
+
+INVENTORY_SLOTS = (
+    ("weapons", 2),
+    ("consumables", 3),
+    ("gear", 2)
+)
+
+def encode_item(item):
+    if not item:
+        return 0
+    return ITEM_CODES[type(item)] | (item.tier << 4)
+
+def decode_item(item_byte: int):
+    if not item_byte:
+        return None
+    return create_item(item_byte & 0x0F, item_byte >> 4)
+
+def is_inventory(msg):
+    """Returns True if msg is an inventory as returned by Player.get_inventory"""
+    return type(msg) == dict and len(msg) == len(INVENTORY_SLOTS) and all(category in msg for category, _ in INVENTORY_SLOTS)
+
+def encode_inventory(inventory: dict):
+    """Encodes an inventory and returns the bytes, returns None if it does not have the layout of INVENTORY_SLOTS"""
+    data = bytearray()
+    for category, slot_count in INVENTORY_SLOTS:
+        if len(inventory[category]) != slot_count:
+            return None
+        data.extend(encode_item(item) for item in inventory[category])
+    return bytes(data)
+
+def decode_inventory(data):
+    inventory = {}
+    offset = 0
+    for category, slot_count in INVENTORY_SLOTS:
+        inventory[category] = [decode_item(item_byte) for item_byte in data[offset:offset + slot_count]]
+        offset += slot_count
+    return inventory
+
+class InventoryPush:
+    """The new inventory of the player, pushed by the server whenever it changes. Received outside of the order of the other
+       messages, recv_msg puts it into the inventory cache of the connection instead of returning it"""
+    def __init__(self, inventory: dict):
+        self.inventory = inventory
+
+def encode_inventory_push(push: InventoryPush):
+    return encode_inventory(push.inventory)
+
+def decode_inventory_push(data):
+    return InventoryPush(decode_inventory(data))
+
+class Heartbeat:
+    """Empty message sent by both sides to show that the connection is alive, never returned by recv_msg"""
+
+# ==== Spectators ====
+
+SPECTATE_REQUEST = struct.Struct(">IB")
+
+class SpectateRequest:
+    """Sent by a spectator after the handshake. match_id 0 watches the next match to start (the one players are joining),
+       player_number 0 watches the whole map instead of the player view of one player"""
+    def __init__(self, match_id=0, player_number=0):
+        self.match_id = match_id
+        self.player_number = player_number
+
+def encode_spectate_request(request: SpectateRequest):
+    return SPECTATE_REQUEST.pack(request.match_id, request.player_number)
+
+def decode_spectate_request(data):
+    return SpectateRequest(*SPECTATE_REQUEST.unpack(data))
+
+# ==== Sessions ====
+
+class SessionToken:
+    """Token the server gives every player when they join, the client sends it back after the handshake to resume its session
+       when it lost its connection. Received outside of the order of the other messages, recv_msg keeps it instead of returning it"""
+    def __init__(self, token: bytes):
+        self.token = token
+
+# A snapshot is sent as SNAPSHOT_HEADER (player number and the number of the player whose turn it is, 0 for none),
+# the stats, the inventory and the player view
+SNAPSHOT_HEADER = struct.Struct(">BB")
+INVENTORY_SIZE = sum(slot_count for _, slot_count in INVENTORY_SLOTS)
+
+class Snapshot:
+    """Everything a resumed player needs to continue, sent instead of the messages they missed.
+       view holds the encoded player view when sent and the decoded PlayerView when received"""
+    def __init__(self, number: int, turn_taker: int, stats: dict, inventory: dict, view):
+        self.number = number
+        self.turn_taker = turn_taker
+        self.stats = stats
+        self.inventory = inventory
+        self.view = view
+
+def encode_snapshot(snapshot: Snapshot):
+    """Encodes a snapshot and returns the bytes, returns None if its stats or inventory can't be encoded"""
+    stats = encode_stats(snapshot.stats)
+    inventory = encode_inventory(snapshot.inventory)
+    if stats is None or inventory is None:
+        return None
+    return SNAPSHOT_HEADER.pack(snapshot.number, snapshot.turn_taker) + stats + inventory + snapshot.view
+
+def decode_snapshot(data):
+    number, turn_taker = SNAPSHOT_HEADER.unpack_from(data, 0)
+    offset = SNAPSHOT_HEADER.size
+    stats = decode_stats(data[offset:offset + STATS.size])
+    offset += STATS.size
+    inventory = decode_inventory(data[offset:offset + INVENTORY_SIZE])
+    offset += INVENTORY_SIZE
+    return Snapshot(number, turn_taker, stats, inventory, decode_view(data[offset:]))
+
+# ==== Fight Results ====
+#
+# A fight result (see get_fight_result) is sent as the power, the extra power, success and the item byte of the new item
+
+FIGHT_RESULT = struct.Struct(">BhBB")
+FIGHT_RESULT_KEYS = frozenset(("power", "extra_power", "success", "item"))
+
+def is_fight_result(msg):
+    return type(msg) == dict and msg.keys() == FIGHT_RESULT_KEYS
+
+def encode_fight_result(fight_result: dict):
+    """Encodes a fight result and returns the bytes, returns None if a value does not fit"""
+    try:
+        return FIGHT_RESULT.pack(fight_result["power"], fight_result["extra_power"], fight_result["success"], encode_item(fight_result["item"]))
+    except struct.error:
+        return None
+
+def decode_fight_result(data):
+    power, extra_power, success, item_byte = FIGHT_RESULT.unpack(data)
+    return {
+        "power": power,
+        "extra_power": extra_power,
+        "success": bool(success),
+        "item": decode_item(item_byte)
+    }
+
+# ==== Pickled Objects ====
+#
+# Unpickling runs whatever code the data asks for, so pickled objects are only sent by the server to clients before protocol version 1.
+# The server never unpickles anything and disconnects clients sending a pickled object (see Connection.buffer_updated)
+
+# ==== Message Schemas ====
+
+class MessageSchema:
+    """One kind of message. types are the Python types of its messages (empty if it is never sent by encode_message) and is_message
+       tells if an object of those types is this kind of message (None if all of them are). encode returns its data (None if the
+       object can't be sent this way) and decode rebuilds the object from the data. min_version is the first protocol version with the message,
+       max_version the last one (None for the message to stay in every later version)"""
+    def __init__(self, name: str, msg_type: int, types: tuple, is_message, encode, decode, min_version=0, max_version=None):
+        self.name = name
+        self.msg_type = msg_type
+        self.types = types
+        self.is_message = is_message
+        self.encode = encode
+        self.decode = decode
+        self.min_version = min_version
+        self.max_version = max_version
+
+    def is_in_version(self, version: int):
+        return self.min_version <= version and (self.max_version is None or version <= self.max_version)
+
+# Schemas for the same Python type are tried in this order when sending a message, the first one that fits is used
+MESSAGE_SCHEMAS = [
+    MessageSchema("code", c.MSG_TYPE_CODE, (str,), is_code, encode_code, decode_code, 1),
+    MessageSchema("str", c.MSG_TYPE_STR, (str,), None, str.encode, lambda data: str(data, "utf-8")),
+    MessageSchema("bool", c.MSG_TYPE_BIT, (bool,), None, encode_bool, decode_bool),
+    MessageSchema("stats", c.MSG_TYPE_STATS, (dict,), is_player_stats, encode_stats, decode_stats),
+    MessageSchema("inventory", c.MSG_TYPE_INVENTORY, (dict,), is_inventory, encode_inventory, decode_inventory, 1),
+    MessageSchema("inventory_push", c.MSG_TYPE_INVENTORY_PUSH, (InventoryPush,), None, encode_inventory_push, decode_inventory_push, 2),
+    MessageSchema("fight_result", c.MSG_TYPE_FIGHT_RESULT, (dict,), is_fight_result, encode_fight_result, decode_fight_result, 1),
+    MessageSchema("view", c.MSG_TYPE_VIEW, (list,), is_player_view, encode_view, decode_view),
+    # Only sent by send_player_view_update
+    MessageSchema("view_delta", c.MSG_TYPE_VIEW_DELTA, (), None, None, decode_view_delta),
+    # Only sent by get_map_update_frame, decoded by the map cache of the connection (see decode_msg)
+    MessageSchema("map_update", c.MSG_TYPE_MAP_UPDATE, (), None, None, None),
+    MessageSchema("heartbeat", c.MSG_TYPE_HEARTBEAT, (Heartbeat,), None, lambda msg: b"", lambda data: Heartbeat(), 3),
+    MessageSchema("spectate", c.MSG_TYPE_SPECTATE, (SpectateRequest,), None, encode_spectate_request, decode_spectate_request, 4),
+    MessageSchema("session", c.MSG_TYPE_SESSION, (SessionToken,), None, lambda msg: msg.token, lambda data: SessionToken(bytes(data)), 5),
+    MessageSchema("snapshot", c.MSG_TYPE_SNAPSHOT, (Snapshot,), None, encode_snapshot, decode_snapshot, 5),
+    # Only sent by the spectator feed of a match, see spectators.py
+    MessageSchema("map_delta", c.MSG_TYPE_MAP_DELTA, (), None, None, decode_map_delta, 6),
+    MessageSchema("capabilities", c.MSG_TYPE_CAPS, (Capabilities,), None, encode_capabilities, decode_capabilities),
+    # Only sent by the server, see Pickled Objects
+    MessageSchema("object", c.MSG_TYPE_OBJ, (list, dict, tuple), None, pickle.dumps, pickle.loads, 0, 0)
+]
+
+# Decoders of every message that is still in the current protocol version, used by the server and by clients of servers that know version 1
+DECODERS = {schema.msg_type: schema.decode for schema in MESSAGE_SCHEMAS if schema.decode and schema.max_version is None}
+# Decoders used by clients of servers before protocol version 1, which may still send pickled objects
+LEGACY_DECODERS = {schema.msg_type: schema.decode for schema in MESSAGE_SCHEMAS if schema.decode}
+
+def get_schemas_by_type(version: int):
+    """Returns the schemas of a protocol version by the Python types of their messages, each list in the order of MESSAGE_SCHEMAS"""
+    schemas_by_type = {}
+    for schema in MESSAGE_SCHEMAS:
+        if schema.is_in_version(version):
+            for msg_type in schema.types:
+                schemas_by_type.setdefault(msg_type, []).append(schema)
+    return schemas_by_type
+
+# Schemas by Python type for every protocol version, so sending a message only tries the schemas of its type
+SCHEMAS_BY_TYPE = [get_schemas_by_type(version) for version in range(PROTOCOL_VERSION + 1)]
+
+def encode_message(msg, version=PROTOCOL_VERSION):
+    """Returns the message type and the data of msg using the first schema of the protocol version that fits it, returns None if none does"""
+    for schema in SCHEMAS_BY_TYPE[version].get(type(msg), ()):
+        if schema.is_message is None or schema.is_message(msg):
+            data = schema.encode(msg)
+            if data is not None:
+                return schema.msg_type, data
+    return None
+
+def decode_message(data_type: int, data, decoders=DECODERS):
+    """Decodes the data of a message based on its message type, returns -1 for message types without a decoder in decoders"""
+    decode = decoders.get(data_type)
+    if decode is None:
+        return -1
+    return decode(data)
@@ -1,238 +1,80 @@
+import argparse
+import asyncio
+import random
 import socket
+import threading
 
-from utils import *
-from network import *
-from player import Player
+from network import Connection, remove_stale_socket
+from local import LocalServer
+from match import Lobby
+from supervisor import run_supervisor
 
 import config as c
-import status_codes as sc
 
-PORT = 8080
 addr = socket.gethostbyname(socket.gethostname())
 
-# a list of Player objects
-players = []
-
-def main(map_size):
-    global players
-    server_socket = create_socket(addr, PORT)
-
-    map_grid = generate_map_grid(map_size)
-    if map_grid == -1:
+async def serve(lobby: Lobby, port: int, unix_path=None):
+    """Accepts connections on port or on the Unix domain socket at unix_path if given"""
+    loop = asyncio.get_running_loop()
+    if unix_path is not None:
+        remove_stale_socket(unix_path)
+        server = await loop.create_unix_server(lambda: Connection(lobby.on_connect), unix_path)
+    else:
+        server = await loop.create_server(lambda: Connection(lobby.on_connect), addr, port, reuse_address=True)
+
+    async with server:
+        await server.serve_forever()
+
+def start_local_server(map_size, max_players, capture_dir=None):
+    """Runs a server in a thread of this process that only accepts in-process connections (see local.py).
+       Returns the LocalServer to connect to, the server runs until the process exits"""
+    loop = asyncio.new_event_loop()
+    lobby = Lobby(map_size, max_players, capture_dir)
+    server = LocalServer(loop, lambda: Connection(lobby.on_connect))
+    threading.Thread(target=loop.run_forever, name="local-server", daemon=True).start()
+    return server
+
+def main(map_size, port=c.SERVER_PORT, max_players=None, workers=1, capture_dir=None, seed=None, unix_path=None):
+    if map_size <= 0:
         print("MAP_SIZE must be larger than 0!")
         return
+    if workers > c.MAX_WORKERS:
+        print(f"There can be at most {c.MAX_WORKERS} workers!")
+        return
 
-    print(f"address: {addr}\nport: {PORT}")
-    while True:
+    if unix_path is not None:
+        print(f"unix socket: {unix_path}")
+    else:
+        print(f"address: {addr}\nport: {port}")
+    while max_players is None:
         max_players = int(input("Max players: "))
         if max_players < 1:
             print("Max players must be larger than 1!")
-        break
-
-    center_x, center_y = get_center(map_grid)
-
-    while len(players) != max_players:
-        new_conn, new_addr = server_socket.accept()
-        print("NEW CLIENT!")
-
-        # Create new player object and append to list of player objects
-        new_player = Player(len(players) + 1, new_conn, new_addr, (center_x, center_y))
-        players.append(new_player)
-
-        # Handle new connection and send important information
-        handle_new_player_connection(map_grid, new_player, c.LENGTH_PREFIX_SIZE)
-
-    player_disconnected = False
-    disconnected_player = None
-    
-    # Game Loop
-    while True:
-        # Check if a player has disconnected
-        if player_disconnected:
-            players.remove(player)
-            player_disconnected = False
-
-        # Remove dead and disconnected players
-        players = [player for player in players if not player.is_dead and not player.disconnected]
-
-        if len(players) == 1 and max_players > 1:
-            print(f"P{players[0].number} wins!")
-            bytes_sent = send_msg(sc.WIN, players[0].player_sock)
-            break
-
-        if not players:
-            print("No players left...")
-            break
-        
-        # Each player plays on their turn
-        for player in players:
-            player.remove_extras()
-            
-            print(f"P{player.number}'s turn")
-
-            # Tell every player who's turn it is
-            broadcast_turn_taker(players, player)
-
-            # Tell player that their turn started
-            send_msg(sc.START, player.player_sock)
-
-            player_stats = player.get_stats()
-            send_msg(player_stats, player.player_sock)
-
-            # Process player's amount of moves
-            moves_left = player.get_moves()
-            while moves_left > 0:
-                print(f"moves left: {moves_left}")
-
-                # ==== Process The Received Move ====
-                
-                while True:
-                    # Receive move from player
-                    player_move = recv_msg(player.player_sock)
-                    
-                    if not player_move:
-                        print("Player disconnected")
-                        player.disconnected = True
-                        break
-
-                    # If player requested their inventory
-                    if player_move == sc.INVREQUEST:
-                        print("player requested inventory")
-                        send_msg(player.get_inventory(), player.player_sock)
-                        continue
-
-                    # If player selected an item in their inventory
-                    elif player_move == sc.ITEMREQUEST:
-                        item_index = int(recv_msg(player.player_sock))
-
-                        item = player.get_item(item_index)
-                        # If player wants to remove item
-                        if item.category != "consumables":
-                            send_msg(sc.AYSREQUEST, player.player_sock)
-                            send_msg("remove", player.player_sock)
-                            player_response = recv_msg(player.player_sock)
-                            if player_response == True:
-                                player.remove_item(item_index)
-                                new_stats = player.get_stats()
-                                
-                                # Send new stats to player
-                                send_msg(new_stats, player.player_sock)
-                                
-                        # If player wants to use item (item is consumable)
-                        else:
-                            send_msg(sc.AYSREQUEST, player.player_sock)
-                            send_msg("use", player.player_sock)
-                            player_response = recv_msg(player.player_sock)
-                            if player_response == True:
-                                player.use_item(item_index)
-                                moves_left += player.extra_moves
-                                new_stats = player.get_stats()
-
-                                # Send new stats to player
-                                send_msg(new_stats, player.player_sock)
-                        
-                        continue
-                    
-                    move_status = player.move_in_direction(map_grid, c.KEY_DIRECTIONS[player_move])
-
-                    # If received move is valid
-                    if move_status == 0:
-                        break
-                    # If move is invalid
-                    else:
-                        print("Received move is invalid")
-                        send_msg(sc.NEXT, player.player_sock)
-                        continue
-
-                # End player's turn if they disconnected
-                if player.disconnected:
-                    break
-                
-                # Calculate new player_view
-                new_player_view = get_player_view(map_grid, player.player_x, player.player_y, player.number)
-
-                # Check if player stepped on entity
-                if map_grid[player.player_y][player.player_x].entity:
-                    # If the entity player stepped on is an enemy
-                    if map_grid[player.player_y][player.player_x].entity.entity_type == "enemy":
-
-                        # Send the new player view to player and ask them if they are sure of attacking
-                        send_msg(sc.AYSREQUEST, player.player_sock)
-                        send_msg(new_player_view, player.player_sock)
-                        broadcast_player_view(map_grid, players, player)
-
-                        player_response = recv_msg(player.player_sock)
-                        print(f"Received response: {player_response}")
-                        if player_response == True:
-                            print("Player is sure")
-                            fight_result = get_fight_result(player, map_grid[player.player_y][player.player_x].entity)
-                            send_msg(fight_result, player.player_sock)
-                            
-                            # If fight was successful, add the new item to player's inventory
-                            if fight_result["success"] == True:
-                                map_grid[player.player_y][player.player_x].remove_entity()
-
-                                new_player_view = get_player_view(map_grid, player.player_x, player.player_y, player.number)
-                                send_msg(new_player_view, player.player_sock)
-                                broadcast_player_view(map_grid, players, player)
-                                
-                                player.modify_inventory(fight_result["item"])
-                            # If fight was not successful
-                            else:
-                                player.health -= 1
-
-                                if player.health == 0:
-                                    player.is_dead = True
-                                    
-                                    # Remove the dead player from the tile
-                                    map_grid[player.player_y][player.player_x].players_present.remove(player.number)   
-
-                                    # Send sc.DEAD message
-                                    send_msg(sc.DEAD, player.player_sock)
-                                else:
-                                    player.move_back(map_grid)
-                                    new_player_view = get_player_view(map_grid, player.player_x, player.player_y, player.number)
-
-                                    # Send new_player_view to player
-                                    send_msg(new_player_view, player.player_sock)
-
-                                broadcast_player_view(map_grid, players, player)
-
-                            new_stats = player.get_stats()
-                            send_msg(new_stats, player.player_sock)
-                            
-                            break # End player's turn
-                        # If player changed their mind
-                        else:
-                            print("Player is not sure")
-                            player.move_back(map_grid)
-                            new_player_view = get_player_view(map_grid, player.player_x, player.player_y, player.number)
-                            send_msg(new_player_view, player.player_sock)
-                            broadcast_player_view(map_grid, players, player)
-
-                            # Make this move not count
-                            continue
-                            
-                    # If the entity is a healing place
-                    elif map_grid[player.player_y][player.player_x].entity.entity_type == "heal":
-                        pass
-
-                        
-                # ==== Send The Results ====
-                
-                # Send new player_view to player
-                send_msg(new_player_view, player.player_sock)
-                # Broadcast the player's moves to other players to update their player_views
-                broadcast_player_view(map_grid, players, player)
+            max_players = None
+
+    # The same seed generates the same maps and fights for the same moves, so captured games can be replayed (see capture.py)
+    if seed is not None:
+        random.seed(seed)
+
+    # Spread the matches across worker processes to use more than one core
+    if workers > 1:
+        if unix_path is not None:
+            run_supervisor(unix_path, None, map_size, max_players, workers, capture_dir)
+        else:
+            run_supervisor(addr, port, map_size, max_players, workers, capture_dir)
+        return
 
-                # Send turn_status to player
-                if moves_left == 1: # If this is was player's last move
-                    send_msg(sc.STOP, player.player_sock)
-                    break
-                else:
-                    send_msg(sc.CONTINUE, player.player_sock)
-                    moves_left -= 1
-                    continue
+    asyncio.run(serve(Lobby(map_size, max_players, capture_dir), port, unix_path))
 
 if __name__ == "__main__":
-    main(c.MAP_SIZE)
+    parser = argparse.ArgumentParser(description="Qaraq server")
+    parser.add_argument("-p", "--port", type=int, default=c.SERVER_PORT)
+    parser.add_argument("-n", "--max-players", type=int, help="players in every match (asked for if not given)")
+    parser.add_argument("-m", "--map-size", type=int, default=c.MAP_SIZE)
+    parser.add_argument("-w", "--workers", type=int, default=1, help="number of worker processes (default: 1, no supervisor)")
+    parser.add_argument("--capture", metavar="DIR", help="record the traffic of every connection to a capture file in DIR (see capture.py)")
+    parser.add_argument("--seed", type=int, help="seed of the random number generator")
+    parser.add_argument("--unix", metavar="PATH", help="listen on a Unix domain socket at PATH instead of the port, for clients on the same machine")
+    args = parser.parse_args()
+
+    main(args.map_size, args.port, args.max_players, args.workers, args.capture, args.seed, args.unix)
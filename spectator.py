@@ -0,0 +1,125 @@
+import argparse
+import socket
+import time
+
+from network import connect_socket, recv_init_msg, recv_msg, send_msg, start_heartbeat, get_recv_buffer
+from protocol import SpectateRequest
+from codec import MapDelta
+
+import config as c
+
+# ==== Spectator ====
+#
+# Run with: python spectator.py [-a ADDR] [-p PORT | -u PATH] [--match MATCH_ID] [--player PLAYER_NUMBER]
+# Watches a match without playing in it and prints every frame the server sends, see spectators.py
+# The whole map comes in chunks of SPECTATOR_CHUNK_SIZE tiles, every chunk is printed as a view of its own.
+# After that only the changed tiles come as map deltas, the chunks with changed tiles are printed again.
+
+SPECTATOR_CAPABILITIES = c.CAP_ZLIB | c.CAP_SPECTATE
+
+def render_view(view):
+    """Returns the tiles of a view as text, players are shown by their number in the middle of the tile"""
+    lines = []
+    for row in view:
+        tile_lines = [list(tile.lines) for tile in row]
+        for tile, tile_line in zip(row, tile_lines):
+            if tile.players_present:
+                line = tile_line[2]
+                tile_line[2] = line[:2] + str(tile.players_present[0]) + line[3:]
+        for i in range(len(tile_lines[0])):
+            lines.append("".join(tile_line[i] for tile_line in tile_lines))
+    return "\n".join(lines)
+
+class Spectator:
+    """Connection watching one match, counts the frames and bytes it receives"""
+
+    def __init__(self, match_id=0, player_number=0):
+        self.match_id = match_id
+        self.player_number = player_number
+
+        self.sock = None
+        self.length_prefix_size = c.LENGTH_PREFIX_SIZE
+        self.frames = 0
+        # Received views by the coordinates of their top left tile, the chunks of the whole map map deltas are applied to
+        self.views = {}
+
+    def connect(self, addr, port=None, timeout=10):
+        """Connects to a server (see connect_socket for addr and port) and asks to watch the match. Retries for up to timeout seconds
+           while the server is starting. Returns 0 on success or -1 on failure"""
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                self.sock = connect_socket(addr, port)
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    return -1
+                time.sleep(0.1)
+
+        self.length_prefix_size = recv_init_msg(self.sock, SPECTATOR_CAPABILITIES)
+        if self.length_prefix_size == -1:
+            return -1
+        start_heartbeat(self.sock, self.length_prefix_size)
+        if send_msg(SpectateRequest(self.match_id, self.player_number), self.sock, self.length_prefix_size) == -1:
+            return -1
+        return 0
+
+    def apply_map_delta(self, delta: MapDelta):
+        """Applies a map delta to the received chunks of the whole map, returns the chunks that changed"""
+        size = c.SPECTATOR_CHUNK_SIZE
+        changed_views = {}
+        for tile_x, tile_y, tile in delta.cells:
+            origin = (tile_x - tile_x % size, tile_y - tile_y % size)
+            view = self.views.get(origin)
+            if view is None:
+                continue
+            view[tile_y - view.origin_y][tile_x - view.origin_x] = tile
+            view.version = delta.version
+            changed_views[origin] = view
+        return list(changed_views.values())
+
+    def watch(self, on_view=None):
+        """Receives views until the match ends and the server closes the connection, calls on_view with every view.
+           Without on_view the views are only counted and not decoded (see loadtest.py)"""
+        if on_view is None:
+            buffer = get_recv_buffer(self.sock, self.length_prefix_size)
+            while True:
+                frame = buffer.recv_frame(self.sock)
+                if frame is None or frame == -1:
+                    break
+                if frame[0] & ~c.MSG_FLAG_COMPRESSED in (c.MSG_TYPE_VIEW, c.MSG_TYPE_MAP_DELTA):
+                    self.frames += 1
+        else:
+            while True:
+                msg = recv_msg(self.sock, self.length_prefix_size)
+                if msg is None:
+                    break
+                if type(msg) == MapDelta:
+                    self.frames += 1
+                    for view in self.apply_map_delta(msg):
+                        on_view(view)
+                elif isinstance(msg, list):
+                    self.frames += 1
+                    self.views[(msg.origin_x, msg.origin_y)] = msg
+                    on_view(msg)
+        self.sock.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Qaraq spectator")
+    parser.add_argument("-a", "--addr", default=socket.gethostbyname(socket.gethostname()))
+    parser.add_argument("-p", "--port", type=int, default=c.SERVER_PORT)
+    parser.add_argument("-u", "--unix", metavar="PATH", help="connect to the Unix domain socket at PATH (see server.py --unix)")
+    parser.add_argument("--match", type=int, default=0, help="match to watch (default: the next match to start)")
+    parser.add_argument("--player", type=int, default=0, help="player whose view to watch (default: the whole map)")
+    args = parser.parse_args()
+
+    spectator = Spectator(args.match, args.player)
+    if args.unix is not None:
+        result = spectator.connect(args.unix)
+    else:
+        result = spectator.connect(args.addr, args.port)
+    if result == -1:
+        print("Can't watch the match")
+    else:
+        spectator.watch(lambda view: print(render_view(view) + "\n"))
+        print(f"The match ended after {spectator.frames} frames")
@@ -0,0 +1,208 @@
+import asyncio
+from collections import deque
+
+from codec import encode_area, encode_player_view, encode_map_delta
+from tile import get_map_version
+from network import make_frame, send_buffers, compressions, protocol_versions
+
+import config as c
+
+# ==== Spectators ====
+#
+# Spectators watch a match without being one of its players. The game only calls SpectatorFeed.publish after a change,
+# which just wakes up the fan-out task of the match. The fan-out task encodes every watched view once, shares the frame
+# between all spectators of that view and writes it to them in batches, so hundreds of spectators don't hold up the turns.
+# Changes made while the fan-out task waits are sent together, and a spectator that falls behind only gets the newest frame.
+#
+# A spectator watching the whole map gets it once when it starts watching, as views of up to SPECTATOR_CHUNK_SIZE by
+# SPECTATOR_CHUNK_SIZE tiles (a view has at most 255 rows and collumns). The next chunk is only sent once the spectator
+# received the previous one. After that it gets map deltas with the tiles changed since the map version it has, which are
+# found through the areas the game passes to publish. Spectators before protocol version 6 get the whole map again instead.
+
+# latest_only key of the player views sent to spectators
+SPECTATOR_VIEW = "spectator_view"
+# latest_only key of the map deltas sent to spectators
+SPECTATOR_MAP = "spectator_map"
+
+def get_map_areas(map_grid):
+    """Returns the areas (origin x, origin y, rows, collumns) of the chunks the whole map is sent in"""
+    size = c.SPECTATOR_CHUNK_SIZE
+    height = len(map_grid)
+    width = len(map_grid[0])
+    return [
+        (x, y, min(size, height - y), min(size, width - x))
+        for y in range(0, height, size)
+        for x in range(0, width, size)
+    ]
+
+class SpectatorFeed:
+    """Spectators of one match and the task sending them the match"""
+
+    def __init__(self, match):
+        self.match = match
+
+        # Player number every spectator follows by connection, 0 for the whole map
+        self.spectators = {}
+        # Map version every spectator watching the whole map has by connection, spectators without one get the whole map
+        self.map_versions = {}
+        # Base version of the map delta waiting in the outbox of a slow spectator, see send_map_delta
+        self.queued_bases = {}
+        # Tasks sending the whole map to spectators by connection
+        self.loading = {}
+        # Areas (first x, first y, last x, last y) changed by the game as (map version, area) tuples, oldest first
+        self.changes = deque()
+
+        self.updated = asyncio.Event()
+        self.task = None
+
+    def add(self, conn, player_number: int):
+        """Adds a spectator following a player (0 for the whole map), it gets the current state with the next frame"""
+        self.spectators[conn] = player_number
+        self.publish()
+
+    def publish(self, area=None):
+        """Tells the fan-out task that the match changed, area is the area of the map with the changed tiles"""
+        if area is not None:
+            self.changes.append((get_map_version(), area))
+        self.updated.set()
+
+    def start(self):
+        self.task = asyncio.get_running_loop().create_task(self.run())
+
+    def close(self):
+        """Stops the fan-out task, then sends the final state of the match to the spectators and closes their connections"""
+        if self.task:
+            self.task.cancel()
+        self.task = asyncio.get_running_loop().create_task(self.finish())
+
+    async def finish(self):
+        try:
+            await self.send_frames()
+        finally:
+            for task in self.loading.values():
+                task.cancel()
+            for conn in self.spectators:
+                conn.close()
+            self.spectators.clear()
+
+    def get_player_view(self, player_number: int, version: int):
+        """Returns the encoded view of a player or None if player_number is 0 or the player left the match"""
+        for player in self.match.players:
+            if player.number == player_number and not player.is_dead and not player.disconnected:
+                return encode_player_view(self.match.map_grid, player.player_x, player.player_y, version)
+        return None
+
+    def get_changed_tiles(self, base_version: int):
+        """Returns the tiles of the map that changed after base_version"""
+        map_grid = self.match.map_grid
+        tiles = {}
+        for version, (first_x, first_y, last_x, last_y) in reversed(self.changes):
+            # Areas published at base_version or earlier only hold older changes
+            if version <= base_version:
+                break
+            for tile_y in range(first_y, last_y + 1):
+                for tile_x in range(first_x, last_x + 1):
+                    tile = map_grid[tile_y][tile_x]
+                    if tile.version > base_version:
+                        tiles[(tile_x, tile_y)] = tile
+        return list(tiles.values())
+
+    async def run(self):
+        while True:
+            await self.updated.wait()
+            self.updated.clear()
+            await self.send_frames()
+            # Changes made in the meantime are sent with the next frame
+            await asyncio.sleep(c.SPECTATOR_INTERVAL)
+
+    async def send_map(self, conn):
+        """Sends the whole map to a spectator in chunks and waits until it received each of them before sending the next one,
+           so a big map never piles up in its outbox. The changes made in the meantime are sent as a map delta afterwards"""
+        map_grid = self.match.map_grid
+        self.map_versions[conn] = get_map_version()
+        try:
+            for origin_x, origin_y, rows, cols in get_map_areas(map_grid):
+                while conn.write_paused and not conn.closed:
+                    await asyncio.sleep(c.SPECTATOR_INTERVAL)
+                if conn.closed:
+                    return
+                view = encode_area(map_grid, origin_x, origin_y, rows, cols, get_map_version())
+                send_buffers(conn, make_frame(c.MSG_TYPE_VIEW, view, compressions.get(conn)))
+                # Let the matches run between two chunks
+                await asyncio.sleep(0)
+        finally:
+            del self.loading[conn]
+        self.publish()
+
+    def send_map_delta(self, conn, version: int, frames: dict):
+        """Sends a spectator of the whole map the tiles that changed since the map version it has.
+           frames holds the map deltas already encoded for this version"""
+        base_version = self.map_versions[conn]
+        # A map delta still waiting for a slow spectator gets replaced by this one, which has to start where that one started
+        pending = conn.has_pending(SPECTATOR_MAP)
+        if pending:
+            base_version = self.queued_bases[conn]
+        else:
+            self.queued_bases[conn] = base_version
+        if base_version == version:
+            return
+
+        compression = compressions.get(conn)
+        key = ("map_delta", base_version, compression)
+        if key not in frames:
+            tiles = self.get_changed_tiles(base_version)
+            frames[key] = tiles and make_frame(c.MSG_TYPE_MAP_DELTA, encode_map_delta(tiles, base_version, version), compression)
+
+        frame = frames[key]
+        if not frame:
+            # Only tiles of other matches changed
+            if not pending:
+                self.map_versions[conn] = version
+            return
+        if send_buffers(conn, frame, SPECTATOR_MAP) != -1:
+            self.map_versions[conn] = version
+
+    def forget_changes(self):
+        """Forgets the changed areas every spectator of the whole map already got"""
+        if not self.map_versions:
+            self.changes.clear()
+            return
+        # Map deltas replacing the ones waiting for slow spectators start at the base version of those
+        oldest_version = min(self.queued_bases.get(conn, version) for conn, version in self.map_versions.items())
+        while self.changes and self.changes[0][0] <= oldest_version:
+            self.changes.popleft()
+
+    async def send_frames(self):
+        """Sends the changes of the match to every spectator, encoding every watched view and map delta only once"""
+        version = get_map_version()
+        frames = {}
+
+        for count, (conn, player_number) in enumerate(list(self.spectators.items()), 1):
+            if conn.closed:
+                self.spectators.pop(conn, None)
+                self.map_versions.pop(conn, None)
+                self.queued_bases.pop(conn, None)
+                continue
+
+            compression = compressions.get(conn)
+            key = (player_number, compression)
+            if key not in frames:
+                view = self.get_player_view(player_number, version)
+                frames[key] = view and make_frame(c.MSG_TYPE_VIEW, view, compression)
+
+            if frames[key] is not None:
+                send_buffers(conn, frames[key], SPECTATOR_VIEW)
+                # The spectator needs the whole map again if the player leaves the match
+                self.map_versions.pop(conn, None)
+                self.queued_bases.pop(conn, None)
+            elif conn in self.loading:
+                pass
+            elif conn not in self.map_versions or (protocol_versions.get(conn, 0) < 6 and self.map_versions[conn] != version):
+                self.loading[conn] = asyncio.get_running_loop().create_task(self.send_map(conn))
+            else:
+                self.send_map_delta(conn, version, frames)
+
+            if count % c.SPECTATOR_BATCH == 0:
+                await asyncio.sleep(0)
+
+        self.forget_changes()
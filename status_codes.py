@@ -10,6 +10,7 @@ PLAYERS = { # Send by server to all players to indicate which player is now taki
 
 DEAD = "/DEAD" # Sent by server to client when client's health goes down to 0
 WIN = "/WIN" # Sent tby server to the client that has won the game
+TIMEOUT = "/TIMEOUT" # Sent by server to all players when the player who's turn it currently is ran out of time (ends their turn)
 
 # ==== Making Moves ==== 
 NEXT = "/NEXT" # Sent by server to client when a move they made is invalid so they don't lose a move
@@ -21,6 +22,7 @@ STOP = "/STOP" # Sent by server to client to signalize that they have no moves l
 INVREQUEST = "/INVREQUEST" # Sent by client to server to request their inventory
 ITEMREQUEST = "/ITEMREQUEST" # Sent by client to server to use (or destroy) an item
 STATREQUEST = "/STATREQUEST" # Sent by client to server to request player's stats (power, moves, health, etc.)
+VIEWREQUEST = "/VIEWREQUEST" # Sent by client to server to request a full player view when a received view delta did not match their player view
 
 # ==== Server Requests ====
 AYSREQUEST = "/AYSREQUEST" # Are You Sure Request. Sent by server to client when asking client if they want to perform an action
@@ -0,0 +1,298 @@
+import asyncio
+import json
+import os
+import socket
+
+from network import Connection, create_socket, get_init_data, decode_msg
+from match import Lobby
+from protocol import Capabilities, Heartbeat, SessionToken
+
+import config as c
+
+# ==== Pre-forked Worker Pool ====
+#
+# The supervisor process accepts every connection on the listening socket and passes the connected socket
+# to one of its worker processes over a unix socket pair (see socket.send_fds). Each worker runs its own Lobby
+# and event loop. All players of a forming match go to the same worker, which is picked by load when the
+# first player of the match connects. Workers report their health and load back to the supervisor.
+# The listening socket is a Unix domain socket instead of a TCP socket if port is None (see create_socket).
+#
+# The supervisor starts the handshake of every connection itself and reads the client's answer before it picks a worker,
+# so only players count towards the forming match. Spectators (see spectators.py) go to the worker of the forming match.
+# Clients resuming their session go to the worker hosting it, the first byte of every session token is the index of its worker.
+# The bytes received from the client are passed along with the socket, the worker continues the handshake with them.
+
+# Most bytes a client can send before the supervisor hands its connection over
+HANDOVER_MAX_SIZE = 4096
+
+class Worker:
+    """The supervisor's record of one worker process"""
+    def __init__(self, index: int, pid: int, channel):
+        self.index = index
+        self.pid = pid
+        # Unix socket pair end used to pass connections to the worker and receive its reports
+        self.channel = channel
+
+        self.alive = True
+        # Last reported load
+        self.matches = 0
+        self.players = 0
+        # Connections passed to the worker since its last report
+        self.new_players = 0
+
+    def get_load(self):
+        return self.players + self.new_players
+
+def run_worker(index: int, channel, map_size: int, max_players: int, capture_dir=None):
+    """Entry point of a forked worker process, never returns"""
+    try:
+        asyncio.run(worker_main(index, channel, Lobby(map_size, max_players, capture_dir, index)))
+    except KeyboardInterrupt:
+        pass
+    os._exit(0)
+
+async def worker_main(index: int, channel, lobby: Lobby):
+    loop = asyncio.get_running_loop()
+    supervisor_gone = asyncio.Event()
+    channel.setblocking(False)
+
+    def receive_connections():
+        try:
+            msg, fds, _, _ = socket.recv_fds(channel, HANDOVER_MAX_SIZE, c.WORKER_MAX_FDS)
+        except BlockingIOError:
+            return
+        except OSError:
+            msg, fds = b"", []
+
+        if not msg and not fds:
+            supervisor_gone.set()
+            return
+
+        # The message holds the bytes the supervisor received from the client
+        for fd in fds:
+            sock = socket.socket(fileno=fd)
+            loop.create_task(loop.connect_accepted_socket(lambda: Connection(lobby.on_connect, msg), sock))
+
+    loop.add_reader(channel.fileno(), receive_connections)
+
+    # Report health and load until the supervisor exits
+    while not supervisor_gone.is_set():
+        report = {"worker": index, "pid": os.getpid()}
+        report.update(lobby.get_stats())
+        try:
+            channel.send(json.dumps(report).encode())
+        except BlockingIOError:
+            pass
+        except OSError:
+            break
+
+        try:
+            await asyncio.wait_for(supervisor_gone.wait(), c.WORKER_REPORT_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+class Supervisor:
+    """Forks the worker processes and spreads new matches across them by load"""
+
+    def __init__(self, addr: str, port: int, map_size: int, max_players: int, worker_count: int, capture_dir=None):
+        self.addr = addr
+        self.port = port
+        self.map_size = map_size
+        self.max_players = max_players
+        self.worker_count = worker_count
+        self.capture_dir = capture_dir
+
+        self.workers = []
+
+        # Worker that gets the connections of the forming match and how many it got so far
+        self.forming_worker = None
+        self.forming_players = 0
+
+    def start_workers(self):
+        """Forks all worker processes, must be called before the event loop of the supervisor starts"""
+        for index in range(self.worker_count):
+            parent_channel, child_channel = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            pid = os.fork()
+            if pid == 0:
+                # Worker process, the channels of the other workers are not needed
+                parent_channel.close()
+                for worker in self.workers:
+                    worker.channel.close()
+                run_worker(index, child_channel, self.map_size, self.max_players, self.capture_dir)
+
+            child_channel.close()
+            self.workers.append(Worker(index, pid, parent_channel))
+            print(f"Started worker {index} (pid {pid})")
+
+    def pick_worker(self):
+        """Returns the alive worker with the lowest load or None if all workers are dead"""
+        alive_workers = [worker for worker in self.workers if worker.alive]
+        if not alive_workers:
+            return None
+        return min(alive_workers, key=lambda worker: worker.get_load())
+
+    async def read_handshake(self, conn):
+        """Starts the handshake with a new connection and receives the client's answer and the session token of a client resuming
+           its session. Returns the answer (protocol.Capabilities), the session token (None if the client does not resume)
+           and every byte received, returns None on failure"""
+        loop = asyncio.get_running_loop()
+        await loop.sock_sendall(conn, get_init_data())
+
+        received = bytearray()
+        # Index of the first byte of the next frame in received
+        offset = 0
+        header_size = 1 + c.LENGTH_PREFIX_SIZE
+
+        async def recv_msg():
+            """Receives the next message that is not a heartbeat, returns None on failure"""
+            nonlocal offset, received
+            while True:
+                if len(received) - offset >= header_size:
+                    frame_end = offset + header_size + int.from_bytes(received[offset + 1:offset + header_size], "big")
+                    if len(received) >= frame_end:
+                        msg = decode_msg(received[offset], bytes(received[offset + header_size:frame_end]))
+                        offset = frame_end
+                        if type(msg) != Heartbeat:
+                            return msg
+                        continue
+                if len(received) >= HANDOVER_MAX_SIZE:
+                    return None
+                data = await loop.sock_recv(conn, HANDOVER_MAX_SIZE - len(received))
+                if not data:
+                    return None
+                received += data
+
+        answer = await recv_msg()
+        if not isinstance(answer, Capabilities):
+            return None
+
+        token = None
+        flags = answer.flags & c.SERVER_CAPABILITIES
+        if flags & c.CAP_RESUME and not flags & c.CAP_SPECTATE:
+            msg = await recv_msg()
+            if not isinstance(msg, SessionToken):
+                return None
+            token = msg.token
+        return answer, token, bytes(received)
+
+    def hand_over(self, worker, conn, received: bytes):
+        """Passes a connection and the bytes received from it to a worker. Returns True on success"""
+        try:
+            socket.send_fds(worker.channel, [received], [conn.fileno()])
+        except OSError:
+            self.on_worker_lost(worker)
+            return False
+        finally:
+            # The worker has its own copy of the socket now
+            conn.close()
+        return True
+
+    def get_session_worker(self, token: bytes):
+        """Returns the worker hosting the session of a token (see handle_new_player_connection) or None if it is dead or unknown"""
+        index = token[0] if token else None
+        if index is None or index >= len(self.workers) or not self.workers[index].alive:
+            return None
+        return self.workers[index]
+
+    async def dispatch(self, conn):
+        """Passes an accepted connection to a worker once the client answered the handshake. Resumed sessions go to the worker
+           hosting them, everything else goes to the worker of the forming match. Only players count towards the forming match"""
+        try:
+            handshake = await asyncio.wait_for(self.read_handshake(conn), c.HANDSHAKE_TIMEOUT)
+        except (asyncio.TimeoutError, OSError):
+            handshake = None
+        if handshake is None:
+            print("Handshake failed")
+            conn.close()
+            return
+
+        answer, token, received = handshake
+        if token is not None:
+            worker = self.get_session_worker(token)
+            if worker is None:
+                print("Unknown session")
+                conn.close()
+                return
+            self.hand_over(worker, conn, received)
+            return
+
+        if self.forming_worker is None or not self.forming_worker.alive:
+            self.forming_worker = self.pick_worker()
+            self.forming_players = 0
+            if self.forming_worker is None:
+                print("No workers left!")
+                conn.close()
+                return
+
+        worker = self.forming_worker
+        if not self.hand_over(worker, conn, received) or answer.flags & c.CAP_SPECTATE:
+            return
+        worker.new_players += 1
+        self.forming_players += 1
+
+        # The next player starts a new match, possibly on another worker
+        if self.forming_players == self.max_players:
+            self.forming_worker = None
+
+    def on_report(self, worker):
+        try:
+            data = worker.channel.recv(4096)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+
+        if not data:
+            self.on_worker_lost(worker)
+            return
+
+        report = json.loads(data)
+        worker.matches = report["matches"]
+        worker.players = report["players"]
+        worker.new_players = 0
+
+    def on_worker_lost(self, worker):
+        if not worker.alive:
+            return
+        print(f"Worker {worker.index} (pid {worker.pid}) died")
+        worker.alive = False
+        asyncio.get_running_loop().remove_reader(worker.channel.fileno())
+        try:
+            os.waitpid(worker.pid, os.WNOHANG)
+        except ChildProcessError:
+            pass
+
+    def print_health(self):
+        for worker in self.workers:
+            status = "alive" if worker.alive else "dead"
+            print(f"worker {worker.index} (pid {worker.pid}, {status}): {worker.matches} matches, {worker.players} players")
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+
+        server_socket = create_socket(self.addr, self.port, socket.SOMAXCONN)
+        if server_socket == -1:
+            return
+        server_socket.setblocking(False)
+
+        for worker in self.workers:
+            worker.channel.setblocking(False)
+            loop.add_reader(worker.channel.fileno(), self.on_report, worker)
+
+        loop.call_soon(self.print_health_periodically)
+
+        while True:
+            conn, _ = await loop.sock_accept(server_socket)
+            loop.create_task(self.dispatch(conn))
+
+    def print_health_periodically(self):
+        self.print_health()
+        asyncio.get_running_loop().call_later(c.SUPERVISOR_HEALTH_INTERVAL, self.print_health_periodically)
+
+def run_supervisor(addr: str, port: int, map_size: int, max_players: int, worker_count: int, capture_dir=None):
+    supervisor = Supervisor(addr, port, map_size, max_players, worker_count, capture_dir)
+    supervisor.start_workers()
+    try:
+        asyncio.run(supervisor.run())
+    except KeyboardInterrupt:
+        pass
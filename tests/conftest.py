@@ -0,0 +1,24 @@
+import os
+import random
+import sys
+
+import pytest
+
+# The modules live in the root of the repository and load the tiles and languages relative to it
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.chdir(ROOT)
+
+from utils import generate_map_grid, get_center
+
+# Size of the maps generated for the tests
+TEST_MAP_SIZE = 21
+
+@pytest.fixture
+def map_grid():
+    """A small map generated from a fixed seed"""
+    return generate_map_grid(TEST_MAP_SIZE, rng=random.Random(0))
+
+@pytest.fixture
+def center(map_grid):
+    return get_center(map_grid)
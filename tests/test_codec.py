@@ -0,0 +1,114 @@
+from codec import (
+    PlayerView, ViewDelta, MapCache, get_view_origin, encode_view, encode_area, encode_player_view, decode_view,
+    encode_player_view_delta, decode_view_delta, apply_view_delta, encode_map_update, encode_map_delta, decode_map_delta,
+    encode_stats, decode_stats
+)
+from tile import get_map_version
+from protocol import encode_message, decode_message, InventoryPush
+
+import config as c
+import status_codes as sc
+
+def test_player_view_round_trip(map_grid, center):
+    data = encode_player_view(map_grid, *center, 7)
+    player_view = decode_view(data)
+
+    assert isinstance(player_view, PlayerView)
+    assert (player_view.origin_x, player_view.origin_y) == get_view_origin(*center)
+    assert player_view.version == 7
+    assert len(player_view) == c.PLAYER_VIEW_Y and len(player_view[0]) == c.PLAYER_VIEW_X
+    # Decoding keeps everything that is encoded
+    assert encode_view(player_view, 7) == data
+
+def test_area_outside_of_the_map_is_empty(map_grid):
+    player_view = decode_view(encode_area(map_grid, -2, -2, 3, 3))
+
+    assert [tile.tile_type for tile in player_view[0]] == ["empty"] * 3
+    assert player_view[2][2].tile_type == map_grid[0][0].tile_type
+
+def test_view_delta_round_trip(map_grid, center):
+    base_version = get_map_version()
+    player_view = decode_view(encode_player_view(map_grid, *center, base_version))
+
+    center_x, center_y = center
+    map_grid[center_y][center_x].add_player(1)
+    map_grid[center_y][center_x + 1].add_player(2)
+    version = get_map_version()
+
+    delta = decode_view_delta(encode_player_view_delta(map_grid, *center, base_version, version))
+    assert isinstance(delta, ViewDelta)
+    assert len(delta.cells) == 2
+
+    assert apply_view_delta(player_view, delta)
+    assert player_view.version == version
+    assert encode_view(player_view, version) == encode_player_view(map_grid, *center, version)
+
+def test_view_delta_without_changes(map_grid, center):
+    version = get_map_version()
+    assert encode_player_view_delta(map_grid, *center, version, version) is None
+
+def test_view_delta_for_another_view_is_rejected(map_grid, center):
+    base_version = get_map_version()
+    center_x, center_y = center
+    player_view = decode_view(encode_player_view(map_grid, center_x + 1, center_y, base_version))
+
+    map_grid[center_y][center_x].add_player(1)
+    delta = decode_view_delta(encode_player_view_delta(map_grid, *center, base_version, get_map_version()))
+
+    assert not apply_view_delta(player_view, delta)
+    assert player_view.version == base_version
+
+def test_map_update_round_trip(map_grid, center):
+    known_tiles = {}
+    map_cache = MapCache()
+
+    version = get_map_version()
+    player_view = map_cache.apply_update(encode_map_update(map_grid, *center, known_tiles, version))
+    assert len(known_tiles) == c.PLAYER_VIEW_X * c.PLAYER_VIEW_Y
+    assert encode_view(player_view, version) == encode_player_view(map_grid, *center, version)
+
+    # Only the changed tile is sent again
+    center_x, center_y = center
+    map_grid[center_y][center_x].add_player(3)
+    version = get_map_version()
+    data = encode_map_update(map_grid, *center, known_tiles, version)
+    player_view = map_cache.apply_update(data)
+    assert encode_view(player_view, version) == encode_player_view(map_grid, *center, version)
+    assert player_view[c.PLAYER_VIEW_Y // 2][c.PLAYER_VIEW_X // 2].players_present == [3]
+
+    # Nothing changed
+    assert encode_map_update(map_grid, *center, known_tiles, version) is None
+
+def test_map_update_after_moving(map_grid, center):
+    known_tiles = {}
+    map_cache = MapCache()
+    map_cache.apply_update(encode_map_update(map_grid, *center, known_tiles, get_map_version()))
+
+    center_x, center_y = center
+    version = get_map_version()
+    player_view = map_cache.apply_update(encode_map_update(map_grid, center_x + 1, center_y, known_tiles, version, True))
+    assert encode_view(player_view, version) == encode_player_view(map_grid, center_x + 1, center_y, version)
+
+def test_map_delta_round_trip(map_grid):
+    tiles = [map_grid[0][0], map_grid[3][5]]
+    delta = decode_map_delta(encode_map_delta(tiles, 4, 9))
+
+    assert (delta.base_version, delta.version) == (4, 9)
+    assert [(tile_x, tile_y) for tile_x, tile_y, _ in delta.cells] == [(0, 0), (5, 3)]
+    for (_, _, decoded), tile in zip(delta.cells, tiles):
+        assert encode_view([[decoded]]) == encode_view([[tile]])
+
+def test_stats_round_trip():
+    stats = {"extra_power": -3, "base_moves": 2, "extra_moves": 0, "health": 5}
+    assert decode_stats(encode_stats(stats)) == stats
+    # A stat that does not fit into 16 bits
+    assert encode_stats(dict(stats, health=1 << 20)) is None
+
+def test_messages_round_trip():
+    for msg in (sc.CONTINUE, "some text", True, False, {"extra_power": 0, "base_moves": 1, "extra_moves": 2, "health": 3}):
+        msg_type, data = encode_message(msg)
+        assert decode_message(msg_type, data) == msg
+
+    inventory = {"weapons": [None, None], "consumables": [None, None, None], "gear": [None, None]}
+    msg_type, data = encode_message(InventoryPush(inventory))
+    assert decode_message(msg_type, data).inventory == inventory
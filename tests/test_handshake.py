@@ -0,0 +1,110 @@
+import asyncio
+import socket
+
+from network import (
+    Connection, build_frame, get_init_data, accept_handshake, recv_init_msg, get_recv_buffer, recv_msg, send_frame,
+    capabilities, compressions, protocol_versions, map_caches
+)
+from protocol import PROTOCOL_VERSION, Capabilities
+
+import config as c
+
+def start_server_handshake(server_sock):
+    """Performs the server side of the handshake on a Connection over server_sock in a new event loop.
+       Returns the loop, the connection and the handshake task"""
+    loop = asyncio.new_event_loop()
+    conn = Connection()
+    loop.run_until_complete(loop.connect_accepted_socket(lambda: conn, server_sock))
+    return loop, conn, loop.create_task(accept_handshake(conn))
+
+def finish_server_handshake(loop, conn, task):
+    try:
+        return loop.run_until_complete(task)
+    finally:
+        conn.close()
+        loop.run_until_complete(asyncio.sleep(0))
+        loop.close()
+
+def test_client_and_server_agree_on_the_current_version():
+    server_sock, client_sock = socket.socketpair()
+    with client_sock:
+        loop, conn, task = start_server_handshake(server_sock)
+        # Let the server send the start of the handshake
+        loop.run_until_complete(asyncio.sleep(0))
+
+        assert recv_init_msg(client_sock) == c.LENGTH_PREFIX_SIZE
+        assert protocol_versions[client_sock] == PROTOCOL_VERSION
+        assert capabilities[client_sock] == c.CLIENT_CAPABILITIES & c.SERVER_CAPABILITIES
+        assert compressions[client_sock] == "zlib"
+        assert client_sock in map_caches
+
+        assert finish_server_handshake(loop, conn, task)
+        assert protocol_versions[conn] == PROTOCOL_VERSION
+        assert capabilities[conn] == c.CLIENT_CAPABILITIES & c.SERVER_CAPABILITIES
+
+def answer_handshake(client_sock, answer: bytes):
+    """Reads the start of the handshake like an old client and sends answer as the data of its capabilities"""
+    recv_buffer = get_recv_buffer(client_sock)
+    assert recv_buffer.recv_exact(client_sock, 1)[0] == c.LENGTH_PREFIX_SIZE
+    offer = recv_msg(client_sock)
+    assert (offer.flags, offer.version) == (c.SERVER_CAPABILITIES, PROTOCOL_VERSION)
+    send_frame(c.MSG_TYPE_CAPS, answer, client_sock)
+
+def test_server_uses_the_version_of_an_older_client():
+    server_sock, client_sock = socket.socketpair()
+    with client_sock:
+        loop, conn, task = start_server_handshake(server_sock)
+        loop.run_until_complete(asyncio.sleep(0))
+
+        answer_handshake(client_sock, bytes([c.CAP_ZLIB, 2]))
+        assert finish_server_handshake(loop, conn, task)
+        assert protocol_versions[conn] == 2
+        assert compressions[conn] == "zlib"
+
+def test_server_accepts_clients_before_protocol_versions():
+    server_sock, client_sock = socket.socketpair()
+    with client_sock:
+        loop, conn, task = start_server_handshake(server_sock)
+        loop.run_until_complete(asyncio.sleep(0))
+
+        # Clients before protocol version 1 only send their capabilities
+        answer_handshake(client_sock, bytes([c.CAP_LZMA]))
+        assert finish_server_handshake(loop, conn, task)
+        assert protocol_versions[conn] == 0
+        assert compressions[conn] == "lzma"
+
+def test_server_never_uses_a_version_newer_than_its_own():
+    server_sock, client_sock = socket.socketpair()
+    with client_sock:
+        loop, conn, task = start_server_handshake(server_sock)
+        loop.run_until_complete(asyncio.sleep(0))
+
+        answer_handshake(client_sock, bytes([0, PROTOCOL_VERSION + 1]))
+        assert finish_server_handshake(loop, conn, task)
+        assert protocol_versions[conn] == PROTOCOL_VERSION
+
+def test_client_uses_the_version_of_an_older_server():
+    server_sock, client_sock = socket.socketpair()
+    with server_sock, client_sock:
+        server_sock.sendall(c.LENGTH_PREFIX_SIZE.to_bytes(1, "big") + build_frame(c.MSG_TYPE_CAPS, bytes([c.CAP_ZLIB, 3])))
+
+        assert recv_init_msg(client_sock) == c.LENGTH_PREFIX_SIZE
+        assert protocol_versions[client_sock] == 3
+        # Map caches were not offered by the server
+        assert client_sock not in map_caches
+
+        answer = recv_msg(server_sock)
+        assert isinstance(answer, Capabilities)
+        assert (answer.flags, answer.version) == (c.CAP_ZLIB, 3)
+
+def test_client_rejects_a_broken_handshake():
+    server_sock, client_sock = socket.socketpair()
+    with server_sock, client_sock:
+        server_sock.sendall(c.LENGTH_PREFIX_SIZE.to_bytes(1, "big") + build_frame(c.MSG_TYPE_STR, b"hello"))
+        assert recv_init_msg(client_sock) == -1
+
+def test_init_data_offers_the_server_capabilities():
+    data = get_init_data()
+    assert data[0] == c.LENGTH_PREFIX_SIZE
+    assert data[1] == c.MSG_TYPE_CAPS
+    assert data[-2:] == bytes([c.SERVER_CAPABILITIES, PROTOCOL_VERSION])
@@ -0,0 +1,113 @@
+import pickle
+import socket
+
+from network import (
+    RecvBuffer, NOT_RECEIVED, HEARTBEAT_FRAME, VIEW_UPDATE, build_frame, recv_msg, send_msg, send_buffers, corked, protocol_versions
+)
+
+import config as c
+import status_codes as sc
+
+FRAMES = [
+    build_frame(c.MSG_TYPE_STR, b"first"),
+    build_frame(c.MSG_TYPE_BIT, b"\x01"),
+    build_frame(c.MSG_TYPE_STR, b""),
+    build_frame(c.MSG_TYPE_STR, b"x" * 1000)
+]
+
+def get_frames(recv_buffer):
+    """Returns every complete frame in recv_buffer as (message type, data bytes) tuples"""
+    frames = []
+    while True:
+        frame = recv_buffer.next_frame()
+        if frame is None:
+            return frames
+        data_type, data = frame
+        frames.append((data_type, bytes(data)))
+
+def split_frame(frame):
+    return frame[0], frame[1 + c.LENGTH_PREFIX_SIZE:]
+
+def test_frames_received_together():
+    recv_buffer = RecvBuffer()
+    recv_buffer.feed(b"".join(FRAMES))
+    assert get_frames(recv_buffer) == [split_frame(frame) for frame in FRAMES]
+
+def test_frames_received_byte_by_byte():
+    recv_buffer = RecvBuffer(size=16)
+    frames = []
+    for byte in b"".join(FRAMES):
+        recv_buffer.feed(bytes([byte]))
+        frames += get_frames(recv_buffer)
+    assert frames == [split_frame(frame) for frame in FRAMES]
+
+def test_frame_split_across_a_full_buffer():
+    # The unparsed start of the second frame is moved to the beginning of the buffer or the buffer grows
+    recv_buffer = RecvBuffer(size=32)
+    data = build_frame(c.MSG_TYPE_STR, b"a" * 20) + build_frame(c.MSG_TYPE_STR, b"b" * 40)
+    recv_buffer.feed(data[:30])
+    assert get_frames(recv_buffer) == [(c.MSG_TYPE_STR, b"a" * 20)]
+    recv_buffer.feed(data[30:])
+    assert get_frames(recv_buffer) == [(c.MSG_TYPE_STR, b"b" * 40)]
+
+def test_frame_larger_than_max_frame_size():
+    recv_buffer = RecvBuffer()
+    recv_buffer.feed(bytes([c.MSG_TYPE_STR]) + (c.MAX_FRAME_SIZE + 1).to_bytes(c.LENGTH_PREFIX_SIZE, "big"))
+    assert recv_buffer.next_frame() == -1
+    # The buffer did not grow to the claimed size
+    assert len(recv_buffer.buf) == c.RECV_BUFFER_SIZE
+
+def test_recv_msg_over_socket():
+    server_sock, client_sock = socket.socketpair()
+    with server_sock, client_sock:
+        send_msg(sc.CONTINUE, server_sock)
+        send_msg("hello", server_sock)
+        server_sock.sendall(HEARTBEAT_FRAME)
+        send_msg(False, server_sock)
+
+        assert recv_msg(client_sock) == sc.CONTINUE
+        assert recv_msg(client_sock) == "hello"
+        # The heartbeat is skipped
+        assert recv_msg(client_sock) is False
+        assert recv_msg(client_sock, block=False) is NOT_RECEIVED
+
+        server_sock.close()
+        assert recv_msg(client_sock) is None
+
+def test_recv_msg_closes_on_large_frame():
+    server_sock, client_sock = socket.socketpair()
+    with server_sock, client_sock:
+        server_sock.sendall(bytes([c.MSG_TYPE_STR]) + (c.MAX_FRAME_SIZE + 1).to_bytes(c.LENGTH_PREFIX_SIZE, "big"))
+        assert recv_msg(client_sock) is None
+        assert client_sock.fileno() == -1
+
+def test_pickled_objects_are_not_decoded():
+    server_sock, client_sock = socket.socketpair()
+    with server_sock, client_sock:
+        # Sockets without a protocol version of 1 or later are clients of old servers, which may send pickled objects
+        server_sock.sendall(build_frame(c.MSG_TYPE_OBJ, pickle.dumps([1, 2])))
+        assert recv_msg(client_sock) == [1, 2]
+
+    server_sock, client_sock = socket.socketpair()
+    with server_sock, client_sock:
+        protocol_versions[client_sock] = 1
+        server_sock.sendall(build_frame(c.MSG_TYPE_OBJ, pickle.dumps([1, 2])))
+        assert recv_msg(client_sock) == -1
+
+class SlowConnection:
+    """Records what corked sends with its latest_only keys, like a Connection whose client is backed up"""
+    def __init__(self):
+        self.groups = []
+
+    def send_groups(self, groups):
+        self.groups += groups
+        return sum(len(buf) for _, buffers in groups for buf in buffers)
+
+def test_corked_keeps_latest_only():
+    conn = SlowConnection()
+    with corked(conn):
+        send_buffers(conn, [b"a"])
+        send_buffers(conn, [b"b"])
+        send_buffers(conn, [b"view"], VIEW_UPDATE)
+        send_buffers(conn, [b"c"])
+    assert conn.groups == [(None, [b"a", b"b"]), (VIEW_UPDATE, [b"view"]), (None, [b"c"])]
@@ -31,24 +31,112 @@ TILE_DIRECTIONS = {
     "vertical_corridor": ("up", "down")
 }
 
+# Bits of the directions in a direction mask, a 4-bit set of directions
+LEFT = 1
+UP = 2
+RIGHT = 4
+DOWN = 8
+ALL_DIRECTIONS_MASK = LEFT | UP | RIGHT | DOWN
+
+DIRECTION_BITS = {
+    "left": LEFT,
+    "up": UP,
+    "right": RIGHT,
+    "down": DOWN
+}
+
+# Direction mask of every tile type
+TILE_MASKS = {tile_type: sum(DIRECTION_BITS[direction] for direction in directions) for tile_type, directions in TILE_DIRECTIONS.items()}
+
+# Tile types of rooms, which can contain entities
+ROOM_TILE_TYPES = frozenset(tile_type for tile_type in TILE_DIRECTIONS if "room" in tile_type)
+
+# Numeric ID of every tile type, used to send tiles over the network as a single byte
+TILE_TYPES = list(TILE_DIRECTIONS)
+TILE_IDS = {tile_type: tile_id for tile_id, tile_type in enumerate(TILE_TYPES)}
+
+# Version of the latest change made to any tile, used to send players only the tiles that changed since their last view
+map_version = 0
+
+class TileTemplate:
+    """The part of a tile shared by every tile of the same tile type: the art, directions and whether it is a room.
+       Every tile type has one template (see get_template) which must not be changed"""
+    __slots__ = ("tile_type", "tile", "lines", "directions", "direction_mask", "is_room")
+
+    def __init__(self, tile_type: str, art: str):
+        self.tile_type = tile_type
+        self.tile = art
+        self.lines = tuple(art.splitlines())
+        self.directions = TILE_DIRECTIONS[tile_type]
+        self.direction_mask = TILE_MASKS[tile_type]
+        self.is_room = tile_type in ROOM_TILE_TYPES
+
+    # Copies of tiles share the template
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (get_template, (self.tile_type,))
+
+# Template of every tile type, loaded from TILES_DIR the first time a tile of the type is created
+tile_templates = {}
+
+def get_template(tile_type: str):
+    """Returns the template of a tile type"""
+    template = tile_templates.get(tile_type)
+    if template is None:
+        with open(f"{c.TILES_DIR}{tile_type}.txt", 'r') as f:
+            template = TileTemplate(tile_type, f.read())
+        tile_templates[tile_type] = template
+    return template
+
+def get_map_version():
+    """Returns the version of the latest change made to any tile"""
+    return map_version
+
+def next_version():
+    """Returns a new map version, higher than any version returned before"""
+    global map_version
+    map_version += 1
+    return map_version
+
 class Tile:
     # class variables
-    #   tile_type
+    #   template - TileTemplate of the tile type, shared with every tile of the same type
+    #   tile_type - taken from the template
     #   coordinate_x
     #   coordinate_y
-    #   directions - set containing all directions that the tile can be entered or exited from
-    #   possible_directions - used during map generation, contains possible directions to generate new tiles
+    #   directions - taken from the template, tuple containing all directions that the tile can be entered or exited from
 
     #   tile  - string of the entire tile
-    #   lines - list of lines of the tile
+    #   lines - lines of the tile, the template's tuple until an entity is drawn on the tile
 
-    #   is_room - if tile is a room (can contain entities)
+    #   is_room - taken from the template, if tile is a room (can contain entities)
     #   tier - value from 1 to 3, gets higher the farther away from the center the tile is
     #   entity - the entity the tile contains (will be an instance of an entity class specified in entities.py)
     #   players_present - list of players currently present on tile represented by their player numbers
+    #   version - map version of the last change to the entity or players_present of the tile
+    __slots__ = ("template", "coordinate_x", "coordinate_y", "tile", "lines", "tier", "entity", "players_present", "version")
+
+    @property
+    def tile_type(self):
+        return self.template.tile_type
+
+    @property
+    def directions(self):
+        return self.template.directions
+
+    @property
+    def is_room(self):
+        return self.template.is_room
 
     def clear_tile(self):
         """Clears the middle line of a tile"""
+        # The tile gets its own lines the first time they are changed
+        self.lines = list(self.lines)
         self.lines[2] = self.lines[2][:1] + "   " + self.lines[2][4:]
 
     def refresh_tile(self):
@@ -76,34 +164,38 @@ class Tile:
         self.entity = None
         self.clear_tile()
         self.refresh_tile()
+        self.mark_changed()
+
+    def mark_changed(self):
+        """Must be called after every change that players can see, gives the tile a new version"""
+        self.version = next_version()
+
+    def add_player(self, number):
+        """Adds the player specified by number to the players present on the tile"""
+        self.players_present.append(number)
+        self.mark_changed()
+
+    def remove_player(self, number):
+        """Removes the player specified by number from the players present on the tile"""
+        self.players_present.remove(number)
+        self.mark_changed()
     
     def __init__(self, tile_type, tile_x, tile_y):
         
         self.coordinate_x = tile_x
         self.coordinate_y = tile_y
-        
-        with open(f"tiles/{tile_type}.txt", 'r') as f:
-            self.tile_type = tile_type
-            self.tile = f.read()
-            self.lines = self.tile.splitlines()
-
-        # Set directions based on tile_type
-        self.directions = TILE_DIRECTIONS[tile_type]
-        self.possible_directions  = list(TILE_DIRECTIONS[tile_type])
 
-        # Is tile a room
-        if "room" in tile_type:
-            self.is_room = True
-        else:
-            self.is_room = False
+        self.template = get_template(tile_type)
+        self.tile = self.template.tile
+        self.lines = self.template.lines
 
         self.tier = None
 
         self.entity = None
 
         self.players_present = []
-        
-        self.refresh_tile()
+
+        self.version = 0
 
             
     def __str__(self):
@@ -126,6 +218,7 @@ y: {self.coordinate_y}"""
         
 
         self.refresh_tile()
+        self.mark_changed()
 
     def copy(self):
         return deepcopy(self)
@@ -368,13 +368,16 @@ class UI:
         self.main_menu.update()
         self.current_menu = self.main_menu
 
-    def are_you_sure(self, msg_action):
-        """Print a 'are you sure?' message. Returns True if the user was sure and False if the user wasn't"""
+    def are_you_sure(self, msg_action, get_key=None):
+        """Print a 'are you sure?' message. Returns True if the user was sure and False if the user wasn't.
+           get_key returns the next key press, stdscr.getkey is used if it is not given"""
         self.print_msg(self.messages["menu_options"]["are_you_sure"] + self.messages["menu_options"]["actions"][msg_action])
         self.ays_menu.position = 1
         self.ays_menu.update()
+        if get_key is None:
+            get_key = self.stdscr.getkey
         while True:
-            my_move = self.stdscr.getkey()
+            my_move = get_key()
 
             if my_move == '\t':
                 self.ays_menu.navigate(1)
@@ -467,7 +470,7 @@ class UI:
             curses.ACS_LRCORNER)
         self.bot_win.refresh()
 
-    def update_player_view(self, player_view: list):
+    def update_player_view(self, player_view: list, caller=None):
         """Updates the player view window with new data and refreshes it to display the results. caller is the number of the player who called this function to update their player_view"""
         for row in range(c.PLAYER_VIEW_Y):
             for col in range(c.PLAYER_VIEW_X):
@@ -477,12 +480,11 @@ class UI:
                     # Color entity tiles
                     if player_view[row][col].entity and type(player_view[row][col].entity) in self.entity_colors:
                         self.player_view_tile_grid[row][col].insstr(i, 0, line, self.entity_colors[type(player_view[row][col].entity)])
-                    # Color player tiles
-                    if player_view[row][col].players_present:
-                        if len(player_view[row][col].players_present) > 1:
-                            if caller in player_view[row][col].players_present:
-                                self.player_view_tile_grid[row][col].insstr(i, 0, line, self.player_colors[player_view[row][col].players_present[0]])
-                        self.player_view_tile_grid[row][col].insstr(i, 0, line, self.player_colors[player_view[row][col].players_present[0]])
+                    # Color player tiles, the caller is shown over the other players on the same tile
+                    players_present = player_view[row][col].players_present
+                    if players_present:
+                        shown_player = caller if caller in players_present else players_present[0]
+                        self.player_view_tile_grid[row][col].insstr(i, 0, line, self.player_colors[shown_player])
                     self.player_view_tile_grid[row][col].refresh()
 
     def get_language(self):
@@ -1,9 +1,11 @@
+import array
 import random
 import json
 from os import listdir
 from os.path import isfile
 
-from tile import Tile, TILE_DIRECTIONS
+from tile import Tile, TILE_DIRECTIONS, TILE_TYPES, TILE_MASKS, ROOM_TILE_TYPES, DIRECTION_BITS, LEFT, UP, RIGHT, DOWN, ALL_DIRECTIONS_MASK
+from mapstore import MapStore, TILE_ID_MASKS
 import config as c
 from entities import ENTITIES, ENTITY_LIKELIHOODS, Enemy, Dragon, Chest, Heal
 from items import generate_item
@@ -84,262 +86,205 @@ def get_direction_opposite(direction: str):
     """Returns the opposite of a given direction"""
     return "up" if direction == "down" else "down" if direction == "up" else "left" if direction == "right" else "right" if direction == "left" else "ERROR"
 
-def check_adjacent_tiles(map_grid, tile_x, tile_y):
-    """Returns a list containing the required exit directions the current tile needs to have in order to connect to the adjecent tiles"""
-        
-    required_directions = []
+def get_required_mask(map_store: MapStore, tile_x: int, tile_y: int):
+    """Returns the direction mask of the exits the tile at tile_x, tile_y needs to have in order to connect to the adjacent tiles"""
+    tile_types = map_store.tile_types
+    width = map_store.width
+    index = tile_y * width + tile_x
+    required_mask = 0
 
+    # Tiles that were not generated yet have no exits (see TILE_ID_MASKS)
     # Check the left tile
-    if tile_x > 0: # If current tile is not at the left edge
-        left_tile = map_grid[tile_y][tile_x - 1]
-        if left_tile: # If adjacent tile already exists
-            if "right" in left_tile.directions:
-                required_directions.append(get_direction_opposite("right"))
+    if tile_x > 0 and TILE_ID_MASKS[tile_types[index - 1]] & RIGHT: # If adjacent tile already exists and has an exit towards this tile
+        required_mask |= LEFT
     # Check the top tile
-    if tile_y > 0: # If current tile is not at the top edge
-        top_tile = map_grid[tile_y - 1][tile_x]
-        if top_tile:
-            if "down" in top_tile.directions:
-                required_directions.append(get_direction_opposite("down"))
+    if tile_y > 0 and TILE_ID_MASKS[tile_types[index - width]] & DOWN:
+        required_mask |= UP
     # Check the right tile
-    if tile_x < (len(map_grid[0]) - 1): # If current tile is not at the right edge
-        right_tile = map_grid[tile_y][tile_x + 1]
-        if right_tile:
-            if "left" in right_tile.directions:
-                required_directions.append(get_direction_opposite("left"))
+    if tile_x < width - 1 and TILE_ID_MASKS[tile_types[index + 1]] & LEFT:
+        required_mask |= RIGHT
     # Check the bottom tile
-    if tile_y < (len(map_grid) - 1): # If current tile is not at the bottom edge
-        bottom_tile = map_grid[tile_y + 1][tile_x]
-        if bottom_tile:
-            if "up" in bottom_tile.directions:
-                required_directions.append(get_direction_opposite("up"))
-    return required_directions
-
-def get_invalid_directions(map_grid: list, tile_x: int, tile_y: int):
-    """Checks whether a tile is at the edge of the map and returns a list of invalid directions"""
+    if tile_y < map_store.height - 1 and TILE_ID_MASKS[tile_types[index + width]] & UP:
+        required_mask |= DOWN
+    return required_mask
 
-    invalid_directions = []
+def get_invalid_mask(map_store: MapStore, tile_x: int, tile_y: int):
+    """Returns the direction mask of the directions leading out of the map from the tile at tile_x, tile_y"""
+    invalid_mask = 0
 
     if tile_x == 0: # Tile is at the left edge
-        invalid_directions.append("left")
+        invalid_mask |= LEFT
     if tile_y == 0: # Tile is at the top edge
-        invalid_directions.append("up")
-    if tile_x == (len(map_grid[0]) - 1): # Tile is at the right edge
-        invalid_directions.append("right")
-    if tile_y == (len(map_grid) - 1): # Tile is at the bottom edge
-        invalid_directions.append("down")
-
-    return invalid_directions
-
-def get_possible_new_tiles(required_directions, invalid_directions):
-    """Returns a list of possible new tiles based on given required directions and invalid directions"""
-    
-    possible_tiles = []
-    
-    for tile_type, tile_directions in TILE_DIRECTIONS.items(): # test if each tile has all the required directions, if it does, add it to the possible_tiles list
-        tile_is_valid = True
-        for required_dir in required_directions: # check if each required direction is included in the tested tile
-            if required_dir not in tile_directions:
-                tile_is_valid = False
-                break
-        for invalid_dir in invalid_directions:
-            if invalid_dir in tile_directions:
-                tile_is_valid = False
-                break
-        if tile_is_valid: 
-            possible_tiles.append(tile_type)
-    return possible_tiles
-            
-                
-def get_new_coordinates(map_grid: list, current_tile: Tile, direction: str):
-    """Returns new coordinates after moving one tile in a given direction"""
-
-    offsets = {
-        "left":  (0, -1),
-        "up":    (-1, 0),
-        "right": (0, 1),
-        "down":  (1, 0)
-    }
-
-    if direction not in offsets:
-        raise ValueError("invalid direction")
-    
-    dy, dx = offsets[direction]
-    new_y = current_tile.coordinate_y + dy
-    new_x = current_tile.coordinate_x + dx
-
-    if 0 <= new_y < len(map_grid) and 0 <= new_x < len(map_grid[0]):
-        return (new_x, new_y)
-    return None
-
-def fix_possible_directions(map_grid, tile: Tile):
-    """Takes a tile object and checks and fixes possible directions based on map edges and other already existing tiles,
-       Returns a new list of possible directions"""
-
-    possible_directions = tile.possible_directions
-    
-    tile_x = tile.coordinate_x
-    tile_y = tile.coordinate_y
-
-
-    # Check for map grid edges
-    if tile_x == 0 and "left" in possible_directions: # If tile is at the left edge
-        possible_directions.remove("left")
-    if tile_x == (len(map_grid[0]) - 1) and "right" in possible_directions: # If tile is at the right edge
-        possible_directions.remove("right")
-    if tile_y == 0 and "up" in possible_directions: # IF tile is at the top edge
-        possible_directions.remove("up")
-    if tile_y == (len(map_grid) - 1) and "down" in possible_directions: # If tile is at the bottom edge
-        possible_directions.remove("down")
-
-    # Check for adjacent tiles
-    required_directions = check_adjacent_tiles(map_grid, tile_x, tile_y)
-
-    for required_dir in required_directions:
-        if required_dir in possible_directions:
-            possible_directions.remove(required_dir)
-
-    return possible_directions
-
-def get_distance_from_center(map_grid, tile):
-    """Returns the distance of a given tile from the center tile in the map grid as a tuple of x and y values"""
-    center_x, center_y = get_center(map_grid)
-    tile_x = tile.coordinate_x
-    tile_y = tile.coordinate_y
-
-    return (abs(tile_x - center_x), abs(tile_y - center_y))
-
-def get_tier(map_grid, tile):
-    dx, dy = get_distance_from_center(map_grid, tile)
-
-    # Half the map dimensions (because center is middle)
-    half_width = len(map_grid[0]) // 2  # 20
-    half_height = len(map_grid) // 2    # 20
-
-    # Define thirds based on distance from center
-    third_x = half_width // 3     # 20 // 3 = 6
-    third_y = half_height // 3    # 20 // 3 = 6
-
-    if dx <= third_x and dy <= third_y:
-        return 1
-    elif dx <= third_x * 2 and dy <= third_y * 2:
-        return 2
-    else:
-        return 3
-
-def generate_random_entity():
-    return random.choices(ENTITIES, weights=ENTITY_LIKELIHOODS, k=1)
-    
-def backtrack(map_grid: list, steps: list):
-    """Backtracks based on coordinates specified in the steps list of tuples
-       Returns the new steps list with steps from the beginning up to the first tile that still has possible_directions"""
-    
-    while True:
-        last_step = steps[-1]
-        last_x, last_y = last_step
-        last_tile = map_grid[last_y][last_x]
-        if last_tile.possible_directions: # If tile has possible directions
-            return steps
-        steps = steps[:-1] # Remove last step (backtrack to the previous step)
-
-def generate_map_grid(size: int):
-    """Returns a 2D grid of a given size"""
+        invalid_mask |= UP
+    if tile_x == map_store.width - 1: # Tile is at the right edge
+        invalid_mask |= RIGHT
+    if tile_y == map_store.height - 1: # Tile is at the bottom edge
+        invalid_mask |= DOWN
+
+    return invalid_mask
+
+def build_new_tile_table():
+    """Returns the tile types that have all the required directions and none of the invalid directions for every combination
+       of direction masks, indexed by required_mask | invalid_mask << 4. The tile types keep the order of TILE_DIRECTIONS"""
+    table = []
+    for masks in range(1 << 8):
+        required_mask = masks & ALL_DIRECTIONS_MASK
+        invalid_mask = masks >> 4
+        table.append(tuple(
+            tile_type for tile_type, tile_mask in TILE_MASKS.items()
+            if tile_mask & required_mask == required_mask and not tile_mask & invalid_mask
+        ))
+    return table
+
+# Possible new tiles for every combination of required and invalid directions, see build_new_tile_table
+NEW_TILES = build_new_tile_table()
+
+def build_possible_direction_table():
+    """Returns the directions of every possible directions mask of every tile type in the order of the tile type's directions,
+       indexed by tile_id << 4 | possible_mask"""
+    table = []
+    for tile_type in TILE_TYPES:
+        for possible_mask in range(1 << 4):
+            table.append(tuple(direction for direction in TILE_DIRECTIONS[tile_type] if DIRECTION_BITS[direction] & possible_mask))
+    return table
+
+# Possible directions to generate new tiles for every tile type and possible directions mask, see build_possible_direction_table
+POSSIBLE_DIRECTIONS = build_possible_direction_table()
+
+# Offsets of the x and y coordinates of a move in every direction
+DIRECTION_OFFSETS = {
+    "left":  (-1, 0),
+    "up":    (0, -1),
+    "right": (1, 0),
+    "down":  (0, 1)
+}
+
+def get_tier_bands(length: int):
+    """Returns the tier of every coordinate of one side of the map, gets higher the farther away from the center the coordinate is.
+       The tier of a tile is the higher one of the tiers of its x and y coordinates"""
+    center = (length - 1) // 2
+    # Define thirds based on distance from center, half the side because the center is in the middle
+    third = length // 2 // 3
+    return bytes(1 if abs(i - center) <= third else 2 if abs(i - center) <= third * 2 else 3 for i in range(length))
+
+def generate_random_entity(rng=random):
+    return rng.choices(ENTITIES, weights=ENTITY_LIKELIHOODS, k=1)
+
+def generate_map_grid(size: int, compact=None, rng=random):
+    """Returns a 2D grid of a given size. The grid is a MapStore (see mapstore.py) if compact is True,
+       by default only for maps bigger than COMPACT_MAP_SIZE, otherwise a list of lists of tiles.
+       rng is the random number generator to use, a random.Random of its own when the map is generated in a thread"""
 
     print("Generating map...")
 
-    tier3_tiles = []
-    
     if size <= 0:
         return -1
 
-    # Create an empty 2D grid for the map
-    map_grid = [[None for _ in range(size)] for _ in range(size)]
+    if compact is None:
+        compact = size > c.COMPACT_MAP_SIZE
+
+    # The map is generated into a MapStore, tiles that were not generated yet are NO_TILE
+    map_store = MapStore(size, size)
+    tile_types = map_store.tile_types
+    # Possible directions mask of every tile, contains possible directions to generate new tiles
+    possible_masks = bytearray(size * size)
+    tier_bands = get_tier_bands(size)
+    # Indexes of the rooms of tier 3, one of them gets the dragon
+    tier3_tiles = array.array('i')
 
     # Set the starting tile
     center_x, center_y = ((size - 1) // 2, (size - 1) // 2)
-    map_grid[center_y][center_x] = Tile("crossroad_room", center_x, center_y)
-
-    current_tile = map_grid[center_y][center_x]
-    current_tile.add_entity(Heal())
+    center_index = center_y * size + center_x
+    map_store.set_tile(center_index, "crossroad_room")
+    map_store.set_entity(center_index, Heal())
+    possible_masks[center_index] = TILE_MASKS["crossroad_room"]
 
-    # List to store steps during grid generation to use when backtracking
-    steps = [(center_x, center_y)]
+    # Depth-first search over the tiles. The stack holds the indexes of the tiles from the center to the current tile and
+    # is preallocated for one entry per tile, it only grows if tiles that were replaced by other ones are on it twice
+    stack = array.array('i', [0]) * (size * size)
+    stack[0] = center_index
+    top = 1
 
     # Map generation
 
-    while map_grid[center_y][center_x].possible_directions:
-        # Check and fix current tile's possible directions
-        current_tile.possible_directions = fix_possible_directions(map_grid, current_tile)
+    while possible_masks[center_index]:
+        current_index = stack[top - 1]
+        current_y, current_x = divmod(current_index, size)
 
-        # If there are no possible directions, start backtracking
-        if not current_tile.possible_directions:
-            steps = backtrack(map_grid, steps)
-            last_step = steps[-1]
-            last_x, last_y = last_step
-            current_tile = map_grid[last_y][last_x]
-        
-        # Pick a new direction
-        new_direction = random.choice(current_tile.possible_directions)
+        # Directions leading out of the map or to adjacent tiles that are already connected to the current tile are not possible
+        blocked_mask = get_invalid_mask(map_store, current_x, current_y) | get_required_mask(map_store, current_x, current_y)
+        possible_masks[current_index] &= ~blocked_mask
+
+        # If there are no possible directions, backtrack to the last tile on the stack that still has some
+        if not possible_masks[current_index]:
+            while top and not possible_masks[stack[top - 1]]:
+                top -= 1
+            if not top:
+                break
+            current_index = stack[top - 1]
+            current_y, current_x = divmod(current_index, size)
 
-        # Remove that direction from the possible directions to generate new tiles
-        current_tile.possible_directions.remove(new_direction)
+        # Pick a new direction and remove it from the possible directions to generate new tiles
+        new_direction = rng.choice(POSSIBLE_DIRECTIONS[tile_types[current_index] << 4 | possible_masks[current_index]])
+        possible_masks[current_index] &= ~DIRECTION_BITS[new_direction]
 
         # Get new coordinates
-        new_coordinates = get_new_coordinates(map_grid, current_tile, new_direction)
-        if not new_coordinates:
+        dx, dy = DIRECTION_OFFSETS[new_direction]
+        new_x = current_x + dx
+        new_y = current_y + dy
+        if not (0 <= new_x < size and 0 <= new_y < size):
             continue
+        new_index = new_y * size + new_x
+
+        if top == len(stack):
+            stack.append(new_index)
         else:
-            new_x, new_y = new_coordinates
-        steps.append((new_x, new_y))
-            
+            stack[top] = new_index
+        top += 1
+
         # Check around the new tile for different tiles (to figure out direction requirements)
-        required_directions = check_adjacent_tiles(map_grid, new_x, new_y)
+        required_mask = get_required_mask(map_store, new_x, new_y)
 
-        # Get invalid direction based on tile position (in case tile is at the edge of the grid)
-        invalid_directions = get_invalid_directions(map_grid, new_x, new_y)
-                
-        # Pick new tile type based on the required directions
+        # Get invalid directions based on tile position (in case tile is at the edge of the grid)
+        invalid_mask = get_invalid_mask(map_store, new_x, new_y)
+
+        # Pick new tile type based on the required directions, a room is only kept with a chance of 1 in ROOM_LIKELIHOOD
+        possible_new_tiles = NEW_TILES[required_mask | invalid_mask << 4]
         while True:
-            possible_new_tiles = get_possible_new_tiles(required_directions, invalid_directions)
-            new_tile = random.choice(possible_new_tiles)
-            if "room" in new_tile:
-                if random.randrange(c.ROOM_LIKELIHOOD) == 0:
-                    break
-                else:
-                    possible_new_tiles.remove(new_tile)
-                    continue
-            break
-                    
-        # Create new tile
-        map_grid[new_y][new_x] = Tile(new_tile, new_x, new_y)
-        map_grid[new_y][new_x].possible_directions.remove(get_direction_opposite(new_direction))
-        current_tile = map_grid[new_y][new_x]
-        
-        tier = get_tier(map_grid, current_tile)
-        current_tile.add_tier(tier)
-        if tier == 3 and current_tile.is_room:
-            tier3_tiles.append(current_tile)
-        if current_tile.is_room:
-            random_entity = generate_random_entity()
+            new_tile = rng.choice(possible_new_tiles)
+            if new_tile not in ROOM_TILE_TYPES or rng.randrange(c.ROOM_LIKELIHOOD) == 0:
+                break
+
+        # Create new tile, it can replace a tile the current tile had no connection to
+        tier = max(tier_bands[new_x], tier_bands[new_y])
+        map_store.set_tile(new_index, new_tile, tier)
+        map_store.set_entity(new_index, None)
+        possible_masks[new_index] = TILE_MASKS[new_tile] & ~DIRECTION_BITS[get_direction_opposite(new_direction)]
+
+        if new_tile in ROOM_TILE_TYPES:
+            if tier == 3:
+                tier3_tiles.append(new_index)
+            random_entity = generate_random_entity(rng)
             if random_entity[0] == Heal:
-                current_tile.add_entity(random_entity[0]())
+                map_store.set_entity(new_index, random_entity[0]())
+            elif random_entity[0] == Enemy:
+                map_store.set_entity(new_index, random_entity[0](tier, rng=rng))
             else:
-                current_tile.add_entity(random_entity[0](tier))
-                
+                map_store.set_entity(new_index, random_entity[0](tier))
 
-    # Make any tiles who are still None turn into empty tile types
-    for i in range(len(map_grid)):
-        for j in range(len(map_grid[0])):
-            if map_grid[i][j] is None:
-                map_grid[i][j] = Tile("empty", i, j)
+    # Make any tiles who are still not generated turn into empty tile types
+    map_store.fill_empty()
 
-    dragon_tile = random.choice(tier3_tiles)
-    map_grid[dragon_tile.coordinate_y][dragon_tile.coordinate_x].add_entity(Dragon())
+    dragon_index = rng.choice(tier3_tiles)
+    map_store.set_entity(dragon_index, Dragon())
+    dragon_y, dragon_x = divmod(dragon_index, size)
 
-    print(f"Dragon is at: {dragon_tile.coordinate_y} {dragon_tile.coordinate_x}")
+    print(f"Dragon is at: {dragon_y} {dragon_x}")
 
     print("Done")
-    return map_grid
+    if compact:
+        return map_store
+    return map_store.to_tiles()
 
 # ===============================================
 